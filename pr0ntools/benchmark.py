@@ -4,8 +4,14 @@ Benchmarking utility
 Copyright 2010 John McMaster
 '''
 
+from pr0ntools import telemetry
+import contextlib
+import threading
 import time
 
+# StageTimes are updated from soften threads, module level so they still pickle
+_stage_lock = threading.Lock()
+
 class Benchmark:
     start_time = None
     end_time = None
@@ -67,3 +73,52 @@ class Benchmark:
         else:
             return self.time_str(time.time() - self.start_time)
 
+
+class StageTimes:
+    '''
+    Accumulates wall time spent in named stages across many calls
+
+    st = StageTimes()
+    with st.stage('match'):
+        ...
+    print st
+    Stages are also telemetry spans when a telemetry log is open
+    '''
+    def __init__(self):
+        self.totals = {}
+        self.counts = {}
+
+    def add(self, name, delta):
+        with _stage_lock:
+            self.totals[name] = self.totals.get(name, 0.0) + delta
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            with telemetry.span(name):
+                yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def merge(self, other):
+        with _stage_lock:
+            for name in other.totals:
+                self.totals[name] = self.totals.get(name, 0.0) + other.totals[name]
+                self.counts[name] = self.counts.get(name, 0) + other.counts[name]
+
+    def reset(self):
+        self.totals = {}
+        self.counts = {}
+
+    def total(self):
+        return sum(self.totals.values())
+
+    def __str__(self):
+        ret = []
+        for name in sorted(self.totals, key=lambda k: -self.totals[k]):
+            total = self.totals[name]
+            n = self.counts[name]
+            ret.append('%-8s %10.3f sec %6d calls %10.1f ms avg' % (name, total, n, 1000.0 * total / n))
+        return '\n'.join(ret)
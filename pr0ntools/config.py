@@ -48,5 +48,23 @@ class Config:
 	def super_tile_memory(self):
 		return self.getx('pr0nts.mem', None)
 
+	def blend_memory(self):
+		'''Bytes shared by concurrent supertile blends, None for part of physical RAM'''
+		return self.getx('pr0nts.blend_mem', None)
+
+	def scratch_tmpfs(self):
+		'''
+		RAM backed dir (ex: /dev/shm) for supertile intermediates, empty to always use temp_base
+		Off by default: what it holds isn't counted against the blend memory budget
+		'''
+		return self.getx('scratch.tmpfs', '')
+
+	def scratch_budget(self):
+		'''Bytes of supertile intermediates allowed in flight, None for most of the free space'''
+		return self.getx('scratch.budget', None)
+
+	def scratch_tmpfs_budget(self):
+		return self.getx('scratch.tmpfs_budget', None)
+
 config = Config()
 
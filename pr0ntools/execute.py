@@ -6,6 +6,7 @@ Licensed under a 2 clause BSD license, see COPYING for details
 
 from temp_file import ManagedTempFile
 import datetime
+import errno
 import os
 import select
 import subprocess
@@ -219,7 +220,7 @@ class Prefixer:
                 if not self.inline:
                     self.f.write(self.prefix())
                 self.f.write(s[pos:posn + 1])
-                pos = posn + 2
+                pos = posn + 1
                 self.inline = False
             else:
                 out = s[pos:]
@@ -229,64 +230,179 @@ class Prefixer:
                 self.f.write(out)
                 break
         self.f.flush()
+
+    def flush(self):
+        self.f.flush()
         
-def timestamp(args, stdout=sys.stdout, stderr=sys.stderr):
-    return prefix(args, stdout, stderr, lambda: datetime.datetime.utcnow().isoformat() + ': ')
+# Bytes per read() of child output
+READ_SIZE = 64 * 1024
 
-def prefix(args, stdout=sys.stdout, stderr=sys.stderr, prefix=lambda: ''):
-    '''Execute, prepending timestamps to newlines'''
-    subp = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
+# run() output handling
+# print: copy to stdout / stderr as it arrives
+# capture: keep combined stdout + stderr in Result.output
+# tee: both
+# discard: child writes to /dev/null, nothing is read
+OUT_PRINT = 'print'
+OUT_CAPTURE = 'capture'
+OUT_TEE = 'tee'
+OUT_DISCARD = 'discard'
+
+class Result:
+    '''What one run() invocation cost'''
+    def __init__(self, args):
+        self.args = args
+        self.rc = None
+        # Seconds
+        self.wall = None
+        self.utime = None
+        self.stime = None
+        # Peak resident set size in bytes
+        self.maxrss = None
+        # Combined stdout + stderr if captured
+        self.output = None
+
+    def cpu(self):
+        return self.utime + self.stime
+
+    def fields(self):
+        '''For the telemetry span the program ran in'''
+        return {
+            'exe': os.path.basename(self.args[0]),
+            'exe_rc': self.rc,
+            'exe_wall': self.wall,
+            'exe_cpu': self.cpu(),
+            'exe_maxrss': self.maxrss,
+            }
+
+    def __str__(self):
+        return '%s rc %s: %0.3f sec wall, %0.3f sec user, %0.3f sec sys, %0.1f MB max RSS' % (
+                os.path.basename(self.args[0]), self.rc, self.wall, self.utime, self.stime, self.maxrss / 1e6)
+
+class RingBuffer:
+    '''Keeps the last size bytes written, everything if size is None'''
+    def __init__(self, size=None):
+        self.size = size
+        self.buf = bytearray()
+
+    def write(self, s):
+        self.buf.extend(s)
+        # Trim in bulk so each byte is only moved about once
+        if self.size is not None and len(self.buf) > 2 * self.size:
+            del self.buf[:len(self.buf) - self.size]
+
+    def getvalue(self):
+        if self.size is not None and len(self.buf) > self.size:
+            return str(self.buf[len(self.buf) - self.size:])
+        return str(self.buf)
+
+def run(args, out=OUT_PRINT, stdout=None, stderr=None, prefix=None, ring=None):
+    '''
+    Execute args without a shell, returning a Result
+    Output is read as it becomes ready (poll, no fixed timeouts) in READ_SIZE chunks
+    out: OUT_PRINT, OUT_CAPTURE, OUT_TEE or OUT_DISCARD
+    prefix: function returning a string to put before each printed line
+    ring: only capture the last ring bytes
+    '''
+    # Late so redirected worker output is honored
+    if stdout is None:
+        stdout = sys.stdout
+    if stderr is None:
+        stderr = sys.stderr
+    ret = Result(args)
+    capture = None
+    if out in (OUT_CAPTURE, OUT_TEE):
+        capture = RingBuffer(ring)
+    printing = out in (OUT_PRINT, OUT_TEE)
+    if out not in (OUT_PRINT, OUT_CAPTURE, OUT_TEE, OUT_DISCARD):
+        raise ValueError('Bad output mode %s' % (out,))
+
+    devnull = open(os.devnull, 'r+b')
+    start = time.time()
     try:
-        p_stdout = Prefixer(stdout, prefix)
-        p_stderr = Prefixer(stderr, prefix)
-        while subp.poll() is None:
-            r_rdy, _w_rdy, _x_rdy = select.select([subp.stdout, subp.stderr], [], [], 0.1)
-            if subp.stdout in r_rdy:
-                p_stdout.write(os.read(subp.stdout.fileno(), 1024))
-            if subp.stderr in r_rdy:
-                p_stderr.write(os.read(subp.stderr.fileno(), 1024))
-        # Flush lingering output
-        # could move these above but afraid of race conditions losing output
-        while True:
-            s = os.read(subp.stdout.fileno(), 1024)
-            if len(s) == 0:
-                break
-            p_stdout.write(s)
+        if out == OUT_DISCARD:
+            subp = subprocess.Popen(args, stdin=devnull, stdout=devnull, stderr=devnull, shell=False, close_fds=True)
+        else:
+            subp = subprocess.Popen(args, stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False, close_fds=True)
+    finally:
+        devnull.close()
+
+    try:
+        if out != OUT_DISCARD:
+            # fd => where its output goes
+            sinks = {}
+            for f, dst in ((subp.stdout, stdout), (subp.stderr, stderr)):
+                writers = []
+                if printing:
+                    if prefix:
+                        writers.append(Prefixer(dst, prefix))
+                    else:
+                        writers.append(dst)
+                if capture:
+                    writers.append(capture)
+                sinks[f.fileno()] = writers
+            poller = select.poll()
+            for fd in sinks:
+                poller.register(fd, select.POLLIN | select.POLLPRI)
+            while sinks:
+                try:
+                    events = poller.poll()
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fd, _event in events:
+                    # Ready (or hung up) so this won't block
+                    s = os.read(fd, READ_SIZE)
+                    if not s:
+                        poller.unregister(fd)
+                        del sinks[fd]
+                        continue
+                    for w in sinks[fd]:
+                        w.write(s)
+                        if w is not capture:
+                            w.flush()
+            subp.stdout.close()
+            subp.stderr.close()
+
         while True:
-            s = os.read(subp.stderr.fileno(), 1024)
-            if len(s) == 0:
+            try:
+                _pid, status, rusage = os.wait4(subp.pid, 0)
                 break
-            p_stderr.write(s)
-    
-        return subp.returncode
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        ret.wall = time.time() - start
+        if os.WIFSIGNALED(status):
+            ret.rc = -os.WTERMSIG(status)
+        else:
+            ret.rc = os.WEXITSTATUS(status)
+        # Already reaped, keep subprocess from trying again
+        subp.returncode = ret.rc
+        ret.utime = rusage.ru_utime
+        ret.stime = rusage.ru_stime
+        # Linux reports KB
+        ret.maxrss = rusage.ru_maxrss * 1024
+        if capture:
+            ret.output = capture.getvalue()
+        return ret
     finally:
-        if subp.poll() is None:
+        if subp.returncode is None:
             try:
                 subp.kill()
+                subp.wait()
             # be careful of race conditions.  child may execute after poll
             except OSError:
                 pass
 
-def exc_ret_istr(cmd, args, print_out=True):
-    '''Execute command, returning status and output.  Optionally print as it runs'''
-    
-    p = subprocess.Popen([cmd] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE, close_fds=True)
-    output = bytearray()
-
-    def check():
-        rlist, _wlist, _xlist = select.select([p.stdout, p.stderr], [], [], 0.05)
-        for f in rlist:
-            d = f.read()
-            output.extend(d)
-            if print_out:
-                sys.stdout.write(d)
-                sys.stdout.flush()
+def timestamp(args, stdout=sys.stdout, stderr=sys.stderr):
+    return prefix(args, stdout, stderr, lambda: datetime.datetime.utcnow().isoformat() + ': ')
 
-    while p.returncode is None:
-        # Hmm how to treat stdout  vs stderror?
-        check()
-        #time.sleep(0.05)
-        p.poll()
+def prefix(args, stdout=sys.stdout, stderr=sys.stderr, prefix=lambda: ''):
+    '''Execute, prepending timestamps to newlines'''
+    return run(args, stdout=stdout, stderr=stderr, prefix=prefix).rc
 
-    check()
-    return p.returncode, str(output)
+def exc_ret_istr(cmd, args, print_out=True):
+    '''Execute command, returning status and output.  Optionally print as it runs'''
+    # stderr is echoed to stdout as before
+    ret = run([cmd] + args, out=OUT_TEE if print_out else OUT_CAPTURE, stderr=sys.stdout)
+    return ret.rc, ret.output
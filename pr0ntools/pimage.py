@@ -9,8 +9,12 @@ Licensed under a 2 clause BSD license, see COPYING for details
 '''
 
 from PIL import Image
+import io
 import os
 
+# Single die images are routinely larger than the decompression bomb limit
+Image.MAX_IMAGE_PIXELS = None
+
 # needed for PNG support
 # rarely used and PIL seems to have bugs
 PALETTES = bool(os.getenv('PR0N_PALETTES', ''))
@@ -311,6 +315,40 @@ class PImage:
     def is_image_filename(filename):
         return filename.find('.tif') > 0 or filename.find('.jpg') > 0 or filename.find('.png') > 0 or filename.find('.bmp') > 0
 
+# (file name, mtime, tw, th) => fill pixel
+_fill_cache = {}
+
+def fill_pixel(fn, tw, th):
+    '''Lower right pixel of fn, used to pad missing tiles'''
+    k = (fn, os.stat(fn).st_mtime, tw, th)
+    ret = _fill_cache.get(k)
+    if ret is None:
+        # im should in theory work but accessing pixels
+        # is for some reason causing corruption
+        ret = Image.open(fn).getpixel((tw - 1, th - 1))
+        if len(_fill_cache) > 256:
+            _fill_cache.clear()
+        _fill_cache[k] = ret
+    return ret
+
+def uniform_color(im, tol=0):
+    '''
+    Return the color of an image where every band varies by at most tol, otherwise None
+    Returned color is an int for single band images and a tuple otherwise
+    '''
+    extrema = im.getextrema()
+    if not isinstance(extrema[0], tuple):
+        lo, hi = extrema
+        if hi - lo > tol:
+            return None
+        return (lo + hi) / 2
+    ret = []
+    for lo, hi in extrema:
+        if hi - lo > tol:
+            return None
+        ret.append((lo + hi) / 2)
+    return tuple(ret)
+
 def from_fns(images_in, tw=None, th=None):
     '''
     Return an image constructed from a 2-D array of image file names
@@ -336,14 +374,16 @@ def from_fns(images_in, tw=None, th=None):
                 if not src_last:
                     continue
                 
-                # im should in theory work but accessing pixels
-                # is for some reason causing corruption
-                iml = Image.open(src_last)
-                imf = Image.new(mode, (tw, th))
                 if PALETTES:
+                    # im should in theory work but accessing pixels
+                    # is for some reason causing corruption
+                    iml = Image.open(src_last)
+                    imf = Image.new(mode, (tw, th))
                     imf.putpalette(iml.palette)
-                pix = iml.getpixel((tw - 1, th - 1))
-                imf.paste(pix, (0, 0, tw, th))
+                    pix = iml.getpixel((tw - 1, th - 1))
+                    imf.paste(pix, (0, 0, tw, th))
+                else:
+                    imf = Image.new(mode, (tw, th), fill_pixel(src_last, tw, th))
                 
                 images_in[rowi][coli] = imf
             else:
@@ -421,5 +461,70 @@ def resize(im, width, height, def_color=None):
     return ret
 
 def im_reload(im):
-    im.save('/tmp/pt_pil_tmp.png')
-    return Image.open('/tmp/pt_pil_tmp.png')
+    # In memory so that parallel workers don't share a temp file
+    buf = io.BytesIO()
+    im.save(buf, 'png')
+    buf.seek(0)
+    return Image.open(buf)
+
+def _set_size(im, size):
+    # Pillow 5.3+ made size read only
+    if hasattr(im, '_size'):
+        im._size = size
+    else:
+        im.size = size
+
+def open_band(fn, y0, y1):
+    '''
+    Return an Image of rows [y0, y1) of image file fn, decoding only that band
+    Returns None if the format can't be partially decoded (ex: JPEG, PNG, compressed TIFF)
+
+    Works for uncompressed files (TIFF, PPM, etc) by seeking to the first row
+    and for multi tile files (ex: tiled TIFF) by only decoding intersecting tiles
+    '''
+    im = Image.open(fn)
+    w, h = im.size
+    y0 = max(0, y0)
+    y1 = min(y1, h)
+    if y0 >= y1:
+        raise ValueError('Bad band %d:%d for height %d' % (y0, y1, h))
+
+    if len(im.tile) == 1:
+        decoder, extents, offset, args = im.tile[0]
+        if decoder != 'raw' or tuple(extents) != (0, 0, w, h):
+            return None
+        if not isinstance(args, tuple):
+            args = (args,)
+        args = args + (0, 1)[len(args) - 1:]
+        rawmode, stride, orientation = args[0:3]
+        # Bottom up (ex: BMP)
+        if orientation != 1:
+            return None
+        if not stride:
+            try:
+                stride = len(Image.new(im.mode, (w, 1)).tobytes('raw', rawmode))
+            except Exception:
+                return None
+        im.tile = [(decoder, (0, 0, w, y1 - y0), offset + y0 * stride, (rawmode, stride, orientation))]
+        _set_size(im, (w, y1 - y0))
+        im.load()
+        return im
+    elif len(im.tile) > 1:
+        tiles = [t for t in im.tile if t[1][1] < y1 and t[1][3] > y0]
+        # Decode whole tiles then trim
+        ty0 = min([t[1][1] for t in tiles])
+        ty1 = max([t[1][3] for t in tiles])
+        im.tile = [(t[0], (t[1][0], t[1][1] - ty0, t[1][2], t[1][3] - ty0), t[2], t[3]) for t in tiles]
+        _set_size(im, (w, ty1 - ty0))
+        im.load()
+        if (ty0, ty1) == (y0, y1):
+            return im
+        return im.crop((0, y0 - ty0, w, y1 - ty0))
+    return None
+
+def band_readable(fn):
+    '''Return True if open_band() can partially decode fn'''
+    try:
+        return open_band(fn, 0, 1) is not None
+    except Exception:
+        return False
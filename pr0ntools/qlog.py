@@ -0,0 +1,210 @@
+'''
+pr0ntools
+Copyright 2012 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+
+Queue based logging
+Callers only take a time stamp and queue the unformatted message
+A background thread per process formats, time stamps and writes in batches
+
+    qlog.open_log('pr0nts/w00.log')
+    qlog.debug('tile r%d c%d', row, col)
+    qlog.info('supertile done')
+
+stdout / stderr (print, subprocess output) are redirected through the same queue
+Messages below the level are dropped before formatting
+Without an open log (or in a forked child of the process that opened it)
+messages are printed directly
+'''
+
+import collections
+import datetime
+import os
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {
+    DEBUG: 'D',
+    INFO: 'I',
+    WARNING: 'W',
+    ERROR: 'E',
+    }
+
+class QLog(object):
+    def __init__(self, f, level=INFO, interval=0.1):
+        self.f = f
+        self.level = level
+        self.pid = os.getpid()
+        # deque append is atomic and much cheaper than Queue.put
+        self.q = collections.deque()
+        # Seconds between writes, close() and flush() don't wait for it
+        self.interval = interval
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def log(self, level, fmt, args):
+        if level < self.level:
+            return
+        self.q.append((time.time(), level, fmt, args))
+
+    def format(self, item):
+        t, level, fmt, args = item
+        if args:
+            try:
+                msg = fmt % args
+            except (TypeError, ValueError) as e:
+                msg = '%r %% %r: %s' % (fmt, args, e)
+        else:
+            msg = fmt
+        stamp = '%s %s: ' % (datetime.datetime.utcfromtimestamp(t).isoformat(), LEVEL_NAMES.get(level, level))
+        return ''.join([stamp + l + '\n' for l in msg.split('\n')])
+
+    def writer(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            out = []
+            # flush() / close() markers reached
+            markers = []
+            done = False
+            while self.q:
+                item = self.q.popleft()
+                if item is None:
+                    done = True
+                elif isinstance(item, tuple):
+                    out.append(self.format(item))
+                else:
+                    markers.append(item)
+            if out:
+                try:
+                    self.f.write(''.join(out))
+                    self.f.flush()
+                except Exception:
+                    # Nowhere left to report it
+                    pass
+            for marker in markers:
+                marker.set()
+            if done:
+                return
+
+    def flush(self):
+        '''Wait for everything queued so far to be written'''
+        marker = threading.Event()
+        self.q.append(marker)
+        self.wake.set()
+        marker.wait()
+
+    def close(self):
+        self.q.append(None)
+        self.wake.set()
+        self.thread.join()
+
+class QLogStream(object):
+    '''File like object (for sys.stdout / stderr) that queues whole lines'''
+    def __init__(self, qlog, level=INFO):
+        self.qlog = qlog
+        self.level = level
+        self.partial = ''
+
+    def write(self, data):
+        if not data:
+            return
+        data = self.partial + data
+        pos = data.rfind('\n')
+        if pos < 0:
+            self.partial = data
+            return
+        self.partial = data[pos + 1:]
+        self.qlog.log(self.level, data[0:pos], None)
+
+    def flush(self):
+        pass
+
+    def end(self):
+        '''Queue any text after the last newline (ex: print 'x',)'''
+        if self.partial:
+            self.qlog.log(self.level, self.partial, None)
+            self.partial = ''
+
+# This process's log, see open_log()
+_log = None
+# Level used without an open log
+_level = INFO
+
+def active():
+    return _log is not None and _log.pid == os.getpid()
+
+def open_log(fn, level=INFO, redirect=True):
+    '''Log this process to fn, by default also capturing stdout / stderr'''
+    global _log
+    close_log()
+    _log = QLog(open(fn, 'w'), level=level)
+    if redirect:
+        sys.stdout = QLogStream(_log, INFO)
+        sys.stderr = QLogStream(_log, WARNING)
+    return _log
+
+def close_log():
+    global _log
+    if not active():
+        _log = None
+        return
+    if isinstance(sys.stdout, QLogStream) and sys.stdout.qlog is _log:
+        sys.stdout.end()
+        sys.stdout = sys.__stdout__
+    if isinstance(sys.stderr, QLogStream) and sys.stderr.qlog is _log:
+        sys.stderr.end()
+        sys.stderr = sys.__stderr__
+    _log.close()
+    _log.f.close()
+    _log = None
+
+def timestamp():
+    '''Prefix for printed lines: a time stamp unless the log already stamps each line'''
+    if active():
+        return ''
+    return datetime.datetime.utcnow().isoformat() + ': '
+
+def set_level(level):
+    global _level
+    _level = level
+    if active():
+        _log.level = level
+
+def enabled(level):
+    '''True if a message at level would be logged, for skipping expensive arguments'''
+    if active():
+        return level >= _log.level
+    return level >= _level
+
+def log(level, fmt, *args):
+    if active():
+        _log.log(level, fmt, args)
+    elif level >= _level:
+        if args:
+            fmt = fmt % args
+        print fmt
+
+def debug(fmt, *args):
+    log(DEBUG, fmt, *args)
+
+def info(fmt, *args):
+    log(INFO, fmt, *args)
+
+def warning(fmt, *args):
+    log(WARNING, fmt, *args)
+
+def error(fmt, *args):
+    log(ERROR, fmt, *args)
+
+def flush():
+    if active():
+        _log.flush()
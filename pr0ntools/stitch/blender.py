@@ -86,61 +86,107 @@ Report bugs at <http://sourceforge.net/projects/enblend/>.
 '''
 
 from pr0ntools import execute
+from pr0ntools import qlog
+from pr0ntools import telemetry
 from pr0ntools.execute import Execute, CommandFailed
 from pr0ntools.config import config
-import fcntl
-import time
+from PIL import Image
+import ctypes
+import math
+import multiprocessing
+import os
 import sys
-import datetime
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class BlenderFailed(CommandFailed):
     pass
 
+# Rough peak bytes per remapped layer pixel while blending
+# enblend: pr0nts mem2pix (1 GB => 51 MP supertile) at about 2 layer pixels per output pixel
+# built in: RGB layers and output plus the tile working set
+BLEND_BPP = {
+    'enblend': 10,
+    'multiband': 5,
+    'feather': 4,
+    'nearest': 4,
+    }
+
+# Part of physical RAM shared by concurrent blends when there is no explicit budget
+BLEND_RAM_FRACTION = 0.5
+
+def blend_memory(blender, layer_pixels):
+    '''Estimated peak bytes to blend layers totalling layer_pixels'''
+    return layer_pixels * BLEND_BPP[blender]
+
+def default_blend_memory():
+    '''BLEND_RAM_FRACTION of physical RAM in bytes, None if it can't be found'''
+    try:
+        return int(os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') * BLEND_RAM_FRACTION)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+class MemorySemaphore(object):
+    '''
+    Counting semaphore weighted by bytes, shared with forked worker processes
+    Blends run concurrently as long as their estimates fit in total
+    A blend larger than total runs once nothing else holds memory
+    total 0 runs one blend at a time
+    '''
+    def __init__(self, total):
+        self.total = total
+        self.cond = multiprocessing.Condition()
+        self.used = multiprocessing.Value(ctypes.c_longlong, 0, lock=False)
+        self.holders = multiprocessing.Value(ctypes.c_int, 0, lock=False)
+
+    def acquire(self, nbytes):
+        with self.cond:
+            i = 0
+            while self.holders.value and self.used.value + nbytes > self.total:
+                # Can take a while, print every 10 min or so
+                if i % (10 * 60) == 0:
+                    print 'Waiting for blend memory: need %0.1f MB, %0.1f / %0.1f MB in use by %d' % (
+                            nbytes / 1e6, self.used.value / 1e6, self.total / 1e6, self.holders.value)
+                self.cond.wait(1)
+                i += 1
+            self.used.value += nbytes
+            self.holders.value += 1
+        print 'Acquired %0.1f MB blend memory' % (nbytes / 1e6,)
+
+    def release(self, nbytes):
+        with self.cond:
+            self.used.value -= nbytes
+            self.holders.value -= 1
+            self.cond.notify_all()
+
 class Enblend:
-    def __init__(self, input_files, output_file, lock=False):
+    def __init__(self, input_files, output_file):
         self.input_files = input_files
         self.output_file = output_file
         self.compression = None
         self.gpu = False
         self.additional_args = []
-        self._lock = lock
-        self._lock_fp = None
+        # execute.Result of the last run()
+        self.result = None
         def p(s=''):
-            print '%s: %s' % (datetime.datetime.utcnow().isoformat(), s)
+            print '%s%s' % (qlog.timestamp(), s)
         self.p = p
-        self.pprefix = lambda: datetime.datetime.utcnow().isoformat() + ': '
+        self.pprefix = qlog.timestamp
         self.stdout = sys.stdout
         self.stderr = sys.stderr
         
-    def lock(self):
-        if not self._lock:
-            self.p('note: Skipping enblend lock')
-            return
-        pid_file = '/tmp/pr0ntools-enblend.pid'
-        self._lock_fp = open(pid_file, 'w')
-        i = 0
-        self.p('note: Acquiring enblend lock')
-        while True:
-            try:
-                fcntl.lockf(self._lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                break
-            except IOError:
-                # Can take a while, print every 10 min or so and once at failure
-                if i % (10 * 60 * 10) == 0:
-                    self.p('Failed to acquire enblend lock, retrying (print every 10 min)')
-                time.sleep(0.1)
-            i += 1
-        self.p('Acquired enblend lock')
-        
-    def unlock(self):
-        if self._lock_fp is None:
-            self.p('Skipping enblend unlock')
-            return
-        self.p('Releasing enblend lock')
-        self._lock_fp.close()
-        self._lock_fp = None
-        
     def run(self):
+        self.result = None
+        with telemetry.span('blend', blender='enblend') as rec:
+            try:
+                self.do_run()
+            finally:
+                if self.result:
+                    rec.update(self.result.fields())
+
+    def do_run(self):
         args = ["enblend", "-o", self.output_file]
         if self.compression:
             args.append('--compression=%s' % str(self.compression))
@@ -154,15 +200,309 @@ class Enblend:
         for opt in config.enblend_opts().split():
             args.append(opt)
         
-        self.lock()
-                
         print 'Blender: executing %s' % (args,)
-        rc = execute.prefix(args, stdout=self.stdout, stderr=self.stderr, prefix=self.pprefix)
-        if not rc == 0:
+        result = execute.run(args, stdout=self.stdout, stderr=self.stderr, prefix=self.pprefix)
+        self.p('Blender: %s' % (result,))
+        # Timing / resource use for the telemetry span
+        self.result = result
+        if not result.rc == 0:
             self.p('')
             self.p('')
             self.p('')
             self.p('Failed to blend')
-            self.p('rc: %d' % rc)
+            self.p('rc: %d' % result.rc)
             self.p(args)
             raise BlenderFailed('failed to remap')
+
+class Layer:
+    '''A remapped image placed at x, y on the output canvas'''
+    def __init__(self, image, x, y, alpha=None):
+        self.image = image
+        self.x = x
+        self.y = y
+        # L mask, None if the whole rectangle is valid
+        self.alpha = alpha
+
+    def width(self):
+        return self.image.size[0]
+
+    def height(self):
+        return self.image.size[1]
+
+    def center(self):
+        return (self.x + self.width() / 2.0, self.y + self.height() / 2.0)
+
+    @staticmethod
+    def from_file(fn):
+        '''Load a cropped nona style TIFF_m layer, returning (layer, canvas size or None)'''
+        im = Image.open(fn)
+        tags = im.tag_v2
+        # Position is in resolution units
+        x = int(round(float(tags.get(286, 0)) * float(tags.get(282, 1))))
+        y = int(round(float(tags.get(287, 0)) * float(tags.get(283, 1))))
+        canvas = None
+        if 33300 in tags and 33301 in tags:
+            canvas = (int(tags[33300]), int(tags[33301]))
+        alpha = None
+        if im.mode in ('RGBA', 'LA'):
+            alpha = im.split()[-1]
+            if alpha.getextrema() == (255, 255):
+                alpha = None
+        return (Layer(im.convert('RGB'), x, y, alpha), canvas)
+
+def _blur(a):
+    '''5 tap binomial filter in both directions, edges replicated'''
+    pad = [(2, 2), (2, 2)] + [(0, 0)] * (a.ndim - 2)
+    p = numpy.pad(a, pad, mode='edge')
+    p = (p[0:-4] + 4 * p[1:-3] + 6 * p[2:-2] + 4 * p[3:-1] + p[4:]) / 16.0
+    return (p[:, 0:-4] + 4 * p[:, 1:-3] + 6 * p[:, 2:-2] + 4 * p[:, 3:-1] + p[:, 4:]) / 16.0
+
+def _down(a):
+    return _blur(a)[::2, ::2]
+
+def _up(a, shape):
+    return _blur(a.repeat(2, axis=0).repeat(2, axis=1)[0:shape[0], 0:shape[1]])
+
+class MultiBandBlender:
+    '''
+    Laplacian pyramid blender in the spirit of enblend, without temp files
+    Seams follow the overlap midline: each pixel belongs to the nearest covering layer center
+    which for a grid of translated images is the middle of each overlap
+    Blends in tiles so memory is bounded by the tile size, not the canvas
+    '''
+    def __init__(self, input_files, output_file):
+        self.input_files = input_files
+        self.output_file = output_file
+        # In memory input instead of input_files, see set_layers()
+        self.layers = None
+        self.canvas = None
+        # Max pyramid levels, reduced for small canvases
+        self.levels = 6
+        # Output pixels blended at once (plus margin)
+        self.tile = 1024
+        self.quality = 95
+        # Interface compatibility with Enblend
+        self.additional_args = []
+        self.pprefix = qlog.timestamp
+
+    def p(self, s=''):
+        print '%s%s' % (self.pprefix(), s)
+
+    def set_layers(self, layers, canvas):
+        self.layers = layers
+        self.canvas = canvas
+
+    def load(self):
+        self.layers = []
+        for fn in self.input_files:
+            layer, canvas = Layer.from_file(fn)
+            self.layers.append(layer)
+            if canvas:
+                self.canvas = canvas
+        if self.canvas is None:
+            self.canvas = (max([l.x + l.width() for l in self.layers]), max([l.y + l.height() for l in self.layers]))
+
+    def labels(self, x0, y0, x1, y1):
+        '''Index of the owning layer for each pixel in the region, -1 if uncovered'''
+        ys, xs = numpy.mgrid[y0:y1, x0:x1]
+        best = numpy.full((y1 - y0, x1 - x0), numpy.inf, dtype=numpy.float32)
+        ret = numpy.full((y1 - y0, x1 - x0), -1, dtype=numpy.int32)
+        for i, l in enumerate(self.layers):
+            cx, cy = l.center()
+            d = ((xs - cx) ** 2 + (ys - cy) ** 2).astype(numpy.float32)
+            covered = (xs >= l.x) & (xs < l.x + l.width()) & (ys >= l.y) & (ys < l.y + l.height())
+            if l.alpha is not None:
+                ax0 = max(x0, l.x)
+                ay0 = max(y0, l.y)
+                ax1 = min(x1, l.x + l.width())
+                ay1 = min(y1, l.y + l.height())
+                if ax1 > ax0 and ay1 > ay0:
+                    a = numpy.asarray(l.alpha.crop((ax0 - l.x, ay0 - l.y, ax1 - l.x, ay1 - l.y))) > 0
+                    covered[ay0 - y0:ay1 - y0, ax0 - x0:ax1 - x0] &= a
+            better = covered & (d < best)
+            best[better] = d[better]
+            ret[better] = i
+        return ret
+
+    def region(self, l, x0, y0, x1, y1):
+        '''Layer pixels for the region as float32, extended past the layer edges by replication'''
+        ix0 = min(max(x0, l.x), l.x + l.width() - 1)
+        iy0 = min(max(y0, l.y), l.y + l.height() - 1)
+        ix1 = max(min(x1, l.x + l.width()), ix0 + 1)
+        iy1 = max(min(y1, l.y + l.height()), iy0 + 1)
+        a = numpy.asarray(l.image.crop((ix0 - l.x, iy0 - l.y, ix1 - l.x, iy1 - l.y)), dtype=numpy.float32)
+        pad = ((iy0 - y0, y1 - iy1), (ix0 - x0, x1 - ix1), (0, 0))
+        return numpy.pad(a, [(max(0, p0), max(0, p1)) for (p0, p1) in pad], mode='edge')
+
+    def blend_region(self, x0, y0, x1, y1, levels):
+        '''Return uint8 RGB array for the canvas region, x0 and y0 multiples of 2 ** levels'''
+        w = x1 - x0
+        h = y1 - y0
+        labels = self.labels(x0, y0, x1, y1)
+        out = None
+        wsums = None
+        # Same without the coverage limit, for where no layer fully covers a coarse level
+        out_any = None
+        wsums_any = None
+        for i in numpy.unique(labels):
+            if i < 0:
+                continue
+            l = self.layers[i]
+            # Gaussian pyramid of the mask and coverage, Laplacian of the image
+            m = (labels == i).astype(numpy.float32)
+            c = numpy.zeros((h, w), dtype=numpy.float32)
+            c[max(0, l.y - y0):max(0, l.y + l.height() - y0), max(0, l.x - x0):max(0, l.x + l.width() - x0)] = 1
+            g = self.region(l, x0, y0, x1, y1)
+            ms = [m]
+            cs = [c]
+            ls = []
+            for _level in xrange(levels):
+                gd = _down(g)
+                ls.append(g - _up(gd, g.shape))
+                g = gd
+                ms.append(_down(ms[-1]))
+                cs.append(_down(cs[-1]))
+            ls.append(g)
+            if out is None:
+                out = [numpy.zeros(lk.shape, dtype=numpy.float32) for lk in ls]
+                wsums = [numpy.zeros(mk.shape, dtype=numpy.float32) for mk in ms]
+                out_any = [numpy.zeros(lk.shape, dtype=numpy.float32) for lk in ls]
+                wsums_any = [numpy.zeros(mk.shape, dtype=numpy.float32) for mk in ms]
+            for k in xrange(levels + 1):
+                # Replicated edge pixels only count where nothing real is available
+                mc = ms[k] * (cs[k] > 0.999)
+                out[k] += ls[k] * mc[:, :, numpy.newaxis]
+                wsums[k] += mc
+                out_any[k] += ls[k] * ms[k][:, :, numpy.newaxis]
+                wsums_any[k] += ms[k]
+        if out is None:
+            return numpy.zeros((h, w, 3), dtype=numpy.uint8)
+        for k in xrange(levels + 1):
+            fallback = wsums[k] < 1e-3
+            out[k][fallback] = out_any[k][fallback]
+            wsums[k][fallback] = wsums_any[k][fallback]
+        # Collapse, normalizing where the blurred masks don't sum to 1 (canvas / coverage edges)
+        ret = out[levels] / numpy.maximum(wsums[levels], 1e-6)[:, :, numpy.newaxis]
+        for k in xrange(levels - 1, -1, -1):
+            ret = _up(ret, out[k].shape) + out[k] / numpy.maximum(wsums[k], 1e-6)[:, :, numpy.newaxis]
+        ret[labels < 0] = 0
+        return numpy.clip(ret + 0.5, 0, 255).astype(numpy.uint8)
+
+    def pyramid_levels(self):
+        '''Pyramid depth for the whole canvas, every tile uses the same'''
+        cw, ch = self.canvas
+        return max(0, min(self.levels, int(math.log(max(1, min(cw, ch) / 8), 2))))
+
+    def margin(self, levels):
+        '''
+        Context around a tile so its pixels come out the same as in a full canvas blend
+        Each downsample reaches 2 pixels at its level and each upsample 3,
+        down the pyramid and back up that adds up to under 5 pixels of the coarsest level
+        '''
+        return 6 * 2 ** levels
+
+    def blend(self):
+        '''Return blended PIL image'''
+        if numpy is None:
+            raise BlenderFailed('%s requires numpy' % self.__class__.__name__)
+        if self.layers is None:
+            self.load()
+        cw, ch = self.canvas
+        ret = Image.new('RGB', (cw, ch))
+        levels = self.pyramid_levels()
+        margin = self.margin(levels)
+        # Regions start on the coarsest level's grid so they downsample the same pixels as the full canvas
+        align = 2 ** levels
+        for ty in xrange(0, ch, self.tile):
+            for tx in xrange(0, cw, self.tile):
+                tx1 = min(tx + self.tile, cw)
+                ty1 = min(ty + self.tile, ch)
+                rx0 = max(0, tx - margin) / align * align
+                ry0 = max(0, ty - margin) / align * align
+                rx1 = min(cw, tx1 + margin)
+                ry1 = min(ch, ty1 + margin)
+                a = self.blend_region(rx0, ry0, rx1, ry1, levels)
+                a = a[ty - ry0:ty1 - ry0, tx - rx0:tx1 - rx0]
+                ret.paste(Image.fromarray(a), (tx, ty))
+        return ret
+
+    def run(self):
+        with telemetry.span('blend', blender=self.__class__.__name__):
+            self.do_run()
+
+    def do_run(self):
+        self.p('%s: %d layers to %s' % (self.__class__.__name__, len(self.layers if self.layers is not None else self.input_files), self.output_file))
+        im = self.blend()
+        if self.output_file.lower().endswith('.jpg'):
+            im.save(self.output_file, quality=self.quality)
+        else:
+            im.save(self.output_file)
+
+class FeatherBlender(MultiBandBlender):
+    '''
+    Quick look blending: each layer weighted by distance to its own edge
+    or with nearest set, hard seams at the overlap midline
+    Single pass, no pyramids
+    '''
+    def __init__(self, input_files, output_file, nearest=False):
+        MultiBandBlender.__init__(self, input_files, output_file)
+        self.nearest = nearest
+
+    def pyramid_levels(self):
+        return 0
+
+    def margin(self, levels):
+        # Every pixel only depends on the layers under it
+        return 0
+
+    def blend_region(self, x0, y0, x1, y1, levels=0):
+        if self.nearest:
+            labels = self.labels(x0, y0, x1, y1)
+            ret = numpy.zeros((y1 - y0, x1 - x0, 3), dtype=numpy.uint8)
+            for i in numpy.unique(labels):
+                if i < 0:
+                    continue
+                sel = labels == i
+                ret[sel] = self.region(self.layers[i], x0, y0, x1, y1).astype(numpy.uint8)[sel]
+            return ret
+
+        acc = numpy.zeros((y1 - y0, x1 - x0, 3), dtype=numpy.float32)
+        wsum = numpy.zeros((y1 - y0, x1 - x0), dtype=numpy.float32)
+        for l in self.layers:
+            ix0 = max(x0, l.x)
+            iy0 = max(y0, l.y)
+            ix1 = min(x1, l.x + l.width())
+            iy1 = min(y1, l.y + l.height())
+            if ix1 <= ix0 or iy1 <= iy0:
+                continue
+            box = (ix0 - l.x, iy0 - l.y, ix1 - l.x, iy1 - l.y)
+            # Distance to the nearest layer edge, 1 on the edge pixels
+            xs = numpy.arange(box[0], box[2], dtype=numpy.float32)
+            ys = numpy.arange(box[1], box[3], dtype=numpy.float32)
+            wx = numpy.minimum(xs + 1, l.width() - xs)
+            wy = numpy.minimum(ys + 1, l.height() - ys)
+            w = numpy.minimum(wy[:, numpy.newaxis], wx[numpy.newaxis, :])
+            if l.alpha is not None:
+                w *= numpy.asarray(l.alpha.crop(box)) > 0
+            im = numpy.asarray(l.image.crop(box), dtype=numpy.float32)
+            acc[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] += im * w[:, :, numpy.newaxis]
+            wsum[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] += w
+        ret = acc / numpy.maximum(wsum, 1e-6)[:, :, numpy.newaxis]
+        return numpy.clip(ret + 0.5, 0, 255).astype(numpy.uint8)
+
+# enblend: external enblend, best seams
+# multiband: built in Laplacian pyramid blend with midline seams, no temp files when remapping in process
+# feather: distance weighted average, fast quick look
+# nearest: hard seams at the overlap midline, fastest
+BLENDERS = ('enblend', 'multiband', 'feather', 'nearest')
+
+def get_blender(blender, input_files, output_file):
+    if blender == 'enblend':
+        return Enblend(input_files, output_file)
+    elif blender == 'multiband':
+        return MultiBandBlender(input_files, output_file)
+    elif blender == 'feather':
+        return FeatherBlender(input_files, output_file)
+    elif blender == 'nearest':
+        return FeatherBlender(input_files, output_file, nearest=True)
+    raise BlenderFailed('Unknown blender %s' % blender)
@@ -6,17 +6,20 @@ Licensed under a 2 clause BSD license, see COPYING for details
 Common code for various stitching strategies
 '''
 
-from pr0ntools.image.soften import soften_composite
+from pr0ntools.image.soften import SoftenCache
 from pr0ntools.stitch.control_point import get_cp_engine, pto_unsub
+from pr0ntools.stitch.step_model import StepModel, pair_offset
 from pr0ntools.stitch.pto.project import PTOProject
 from pr0ntools.stitch.pto.util import optimize_xy_only, fixup_i_lines, fixup_p_lines
 from pr0ntools.pimage import PImage
-from pr0ntools.temp_file import ManagedTempFile
-from pr0ntools.benchmark import Benchmark
+from pr0ntools.temp_file import ManagedTempFile, TempScope
+from pr0ntools.benchmark import Benchmark, StageTimes
 
+from multiprocessing.pool import ThreadPool
 import json
 import os
 import sys
+import threading
 import traceback
 
 '''
@@ -120,6 +123,23 @@ class CommonStitch:
         self.soften_try = {0:0, 1:0, 2:0}
         # soften that worked
         self.soften_ok = {0:0, 1:0, 2:0}
+        # soften_try / soften_ok are updated from soften_all() threads
+        self.soften_lock = threading.Lock()
+        # Softened images are reused across pairs sharing an image
+        self.soften_cache = SoftenCache()
+        # Try all soften levels at once and keep the best project
+        self.soften_parallel = False
+        # Running stage step estimate used to predict pair overlap
+        self.step_model = StepModel()
+        # Extra pixels around the predicted overlap
+        self.predict_margin = 32
+        # A full overlap match after the predicted window found nothing may be this many
+        # windows (tolerance + margin) off the prediction
+        self.fallback_tol_scale = 2.0
+        # Time spent in each control point stage, shared with control_point_gen
+        self.stages = StageTimes()
+        # Per pair temp files on tmpfs, see TempScope
+        self.temp_tmpfs = False
 
     def set_dry(self, d):
         self.dry = d
@@ -167,6 +187,7 @@ class CommonStitch:
 
         # Generate control points and merge them into a master project
         self.control_point_gen = get_cp_engine()
+        self.control_point_gen.stages = self.stages
         # How many rows and cols to go to each side
         # If you hand took the pictures, this might suit you
         self.project = PTOProject.from_blank()
@@ -188,6 +209,10 @@ class CommonStitch:
             self.generate_control_points()
             print 'Soften try: %s' % (self.soften_try,)
             print 'Soften ok: %s' % (self.soften_ok,)
+            # Empty if control points were generated in worker processes
+            if self.stages.totals:
+                print 'Control point stages:'
+                print self.stages
 
             print 'Post stitch fixup...'
             optimize_xy_only(self.project)
@@ -228,22 +253,75 @@ class CommonStitch:
             print 'Stitch done in %s' % bench
 
 
-    def control_points_by_subimage(self, pair, image_fn_pair):
+    def control_points_by_subimage(self, pair, image_fn_pair, predict=None):
         '''Stitch two images together by cropping to restrict overlap'''
 
         # subimage_factor: (y, x) overlap percent tuple or none for default
         # pair: pair of row/col or coordinate positions (used to determine relative positions)
         # (0, 0) at upper left
         # image_fn_pair: pair of image file names
+        # predict: (dx, dy, tolerance) expected position of image 1 in image 0 or None
 
         print 'Preparing subimage stitch on %s:%s' % (image_fn_pair[0], image_fn_pair[1])
         '''
         Just work on the overlap section, maybe even less
         '''
 
-        images = [PImage.from_file(image_file_name) for image_file_name in image_fn_pair]
+        # One stage entry per pair: load, pick the window, cut it out
+        with self.stages.stage('crop'):
+            images = [PImage.from_file(image_file_name) for image_file_name in image_fn_pair]
+
+            crops = None
+            if predict:
+                crops = self.predicted_crops(images, predict)
+                if crops is None:
+                    print 'WARNING: predicted window %s empty, using full overlap' % (predict,)
+                else:
+                    print 'Predicted window dx %0.1f, dy %0.1f, tolerance %0.1f' % predict
+            if crops is None:
+                crops = self.overlap_crops(pair, images)
+            (box0, box1) = crops
 
+            '''
+            Note y starts at top in PIL
+            '''
+            sub_image_0 = images[0].subimage(*box0)
+            sub_image_1 = images[1].subimage(*box1)
+        sub_image_0_file = ManagedTempFile.get(None, '.jpg')
+        sub_image_1_file = ManagedTempFile.get(None, '.jpg')
+        print 'sub image 0: width=%d, height=%d, name=%s' % (sub_image_0.width(), sub_image_0.height(), sub_image_0_file.file_name)
+        print 'sub image 1: width=%d, height=%d, name=%s' % (sub_image_1.width(), sub_image_1.height(), sub_image_1_file.file_name)
+        #sys.exit(1)
+        with self.stages.stage('encode'):
+            sub_image_0.image.save(sub_image_0_file.file_name)
+            sub_image_1.image.save(sub_image_1_file.file_name)
+
+        sub_image_fn_pair = (sub_image_0_file.file_name, sub_image_1_file.file_name)
+        # subimage file name symbolic link to subimage file name
+        # this should be taken care of inside of control point actually
+        #sub_link_to_sub = dict()
+        # subimage to the image it came from
+        sub_to_real = dict()
+        sub_to_real[sub_image_0_file.file_name] = image_fn_pair[0]
+        sub_to_real[sub_image_1_file.file_name] = image_fn_pair[1]
+
+        # Returns a pto project object
+        pair_project = self.control_point_gen.generate_core(sub_image_fn_pair)
+        if pair_project is None:
+            print 'WARNING: failed to gen control points @ %s' % repr(pair)
+            return None
+
+        # all we need to do is adjust xy positions
+        # afaik above is way overcomplicated
+        final_pair_project = pto_unsub(pair_project, (sub_image_0_file, sub_image_1_file), (box0[0], box0[2]), sub_to_real, (box1[0], box1[2]))
+
+        # Filenames become absolute
+        #sys.exit(1)
+        return final_pair_project
+
+    def overlap_crops(self, pair, images):
         '''
+        Return ((x0, x1, y0, y1), (x0, x1, y0, y1)) image crops using the nominal overlap
         image_0 used as reference
         4 basic situations: left, right, up right
         8 extended: 4 basic + corners
@@ -272,56 +350,71 @@ class CommonStitch:
             sub_image_0_y_delta = int(images[0].height() * y_overlap)
             sub_image_1_y_end = int(round(images[1].height() * (1.0 - y_overlap)))
 
+        return ((sub_image_0_x_delta, images[0].width(), sub_image_0_y_delta, images[0].height()),
+                (0, sub_image_1_x_end, 0, sub_image_1_y_end))
+
+    def predicted_crops(self, images, predict):
         '''
-        print 'image 0 x delta: %d, y delta: %d' % (sub_image_0_x_delta, sub_image_0_y_delta)
-        Note y starts at top in PIL
+        Return crops like overlap_crops() but only covering the predicted overlap plus tolerance
+        Returns None if the prediction doesn't overlap
         '''
-        sub_image_0 = images[0].subimage(sub_image_0_x_delta, None, sub_image_0_y_delta, None)
-        sub_image_1 = images[1].subimage(None, sub_image_1_x_end, None, sub_image_1_y_end)
-        sub_image_0_file = ManagedTempFile.get(None, '.jpg')
-        sub_image_1_file = ManagedTempFile.get(None, '.jpg')
-        print 'sub image 0: width=%d, height=%d, name=%s' % (sub_image_0.width(), sub_image_0.height(), sub_image_0_file.file_name)
-        print 'sub image 1: width=%d, height=%d, name=%s' % (sub_image_1.width(), sub_image_1.height(), sub_image_1_file.file_name)
-        #sys.exit(1)
-        sub_image_0.image.save(sub_image_0_file.file_name)
-        sub_image_1.image.save(sub_image_1_file.file_name)
-
-        sub_image_fn_pair = (sub_image_0_file.file_name, sub_image_1_file.file_name)
-        # subimage file name symbolic link to subimage file name
-        # this should be taken care of inside of control point actually
-        #sub_link_to_sub = dict()
-        # subimage to the image it came from
-        sub_to_real = dict()
-        sub_to_real[sub_image_0_file.file_name] = image_fn_pair[0]
-        sub_to_real[sub_image_1_file.file_name] = image_fn_pair[1]
-
-        # Returns a pto project object
-        pair_project = self.control_point_gen.generate_core(sub_image_fn_pair)
-        if pair_project is None:
-            print 'WARNING: failed to gen control points @ %s' % repr(pair)
+        (dx, dy, tol) = predict
+        # Features near the crop edge match poorly, give them some room
+        margin = tol + self.predict_margin
+        w0 = images[0].width()
+        h0 = images[0].height()
+        w1 = images[1].width()
+        h1 = images[1].height()
+
+        def axis(d, size0, size1):
+            # Image 1 spans [d, d + size1) in image 0 coordinates
+            lo0 = int(max(0, d - margin))
+            hi0 = int(min(size0, d + size1 + margin))
+            lo1 = int(max(0, -d - margin))
+            hi1 = int(min(size1, size0 - d + margin))
+            return (lo0, hi0, lo1, hi1)
+
+        (x0a, x1a, x0b, x1b) = axis(dx, w0, w1)
+        (y0a, y1a, y0b, y1b) = axis(dy, h0, h1)
+        if x0a >= x1a or y0a >= y1a or x0b >= x1b or y0b >= y1b:
             return None
+        return ((x0a, x1a, y0a, y1a), (x0b, x1b, y0b, y1b))
 
-        # all we need to do is adjust xy positions
-        # afaik above is way overcomplicated
-        final_pair_project = pto_unsub(pair_project, (sub_image_0_file, sub_image_1_file), (sub_image_0_x_delta, sub_image_0_y_delta), sub_to_real)
-
-        # Filenames become absolute
-        #sys.exit(1)
-        return final_pair_project
-
-    def try_control_points_with_position(self, pair, image_fn_pair):
+    def try_control_points_with_position(self, pair, image_fn_pair, predict=None):
         '''Try to stitch two images together without any (high level) image processing other than cropping'''
         # If images are arranged in a regular grid and we are allowed to crop do it
         if self.regular and self.subimage_control_points:
-            return self.control_points_by_subimage(pair, image_fn_pair)
+            if not predict:
+                return self.control_points_by_subimage(pair, image_fn_pair)
+            ret = self.control_points_by_subimage(pair, image_fn_pair, predict)
+            if ret:
+                # An outlier would only be found again in the full overlap
+                return self.check_predict(pair, image_fn_pair, ret, predict)
+            print 'WARNING: predicted window failed, retrying with full overlap'
+            ret = self.control_points_by_subimage(pair, image_fn_pair)
+            if not ret:
+                return None
+            dx, dy, tol = predict
+            return self.check_predict(pair, image_fn_pair, ret, (dx, dy, (tol + self.predict_margin) * self.fallback_tol_scale))
         # Otherwise run stitches on the full image
         else:
             print 'Full image stitch (not partial w/ regular %d and subimage control %d)' % (self.regular, self.subimage_control_points)
             return self.control_point_gen.generate_core(image_fn_pair)
 
+    def check_predict(self, pair, image_fn_pair, project, predict):
+        '''Return project if its offset agrees with predict (dx, dy, tolerance), otherwise None'''
+        offset = pair_offset(project, image_fn_pair[0], image_fn_pair[1])
+        if not self.step_model.check(predict, offset):
+            print 'WARNING: rejecting outlier @ %s: got %s, predicted %s' % (repr(pair), offset, predict)
+            return None
+        return project
+
     # Control point generator wrapper entry
-    def generate_control_points_by_pair(self, pair, image_fn_pair):
-        ret = self.do_generate_control_points_by_pair(pair, image_fn_pair)
+    def generate_control_points_by_pair(self, pair, image_fn_pair, predict=None):
+        # Sub images and projects of every attempt are deleted together once the pair is done
+        # The returned project doesn't reference them
+        with TempScope(tmpfs=self.temp_tmpfs):
+            ret = self.do_generate_control_points_by_pair(pair, image_fn_pair, predict)
         return ret
         '''
         # If it failed and they were adjacent it is a "critical pair"
@@ -334,11 +427,12 @@ class CommonStitch:
         return ret
         '''
 
-    def do_generate_control_points_by_pair(self, pair, image_fn_pair):
+    def do_generate_control_points_by_pair(self, pair, image_fn_pair, predict=None):
         '''high level function uses by sub-stitches.  Given a pair of images make a best effort to return a .pto object'''
         '''
         pair: ImageCoordinatePair() object
         image_fn_pair: tuple of strings
+        predict: (dx, dy, tolerance) of image 1 relative to image 0 or None
 
         Algorithm:
         First try to stitch normally (either whole image or partial depending on the mode)
@@ -355,69 +449,81 @@ class CommonStitch:
         if True:
             # Try raw initially
             print 'Attempting sharp match...'
-            ret_project = self.try_control_points_with_position(pair, image_fn_pair)
+            ret_project = self.try_control_points_with_position(pair, image_fn_pair, predict)
             if ret_project:
                 return ret_project
 
         print 'WARNING: bad project, attempting soften...'
 
-        soften_image_file_0_managed = ManagedTempFile.from_same_extension(image_fn_pair[0])
-        soften_image_file_1_managed = ManagedTempFile.from_same_extension(image_fn_pair[1])
-        print 'Soften fn0: %s' % soften_image_file_0_managed.file_name
-        print 'Soften fn1: %s' % soften_image_file_1_managed.file_name
+        if self.soften_parallel:
+            ret_project = self.soften_all(pair, image_fn_pair, soften_iterations, predict)
+            if ret_project:
+                return ret_project
+        else:
+            for i in xrange(soften_iterations):
+                # And then start screwing with it
+                # Wonder if we can combine features from multiple soften passes?
+                # Or at least take the maximum
+                # Do features get much less accurate as the soften gets up there?
+                print 'Attempting soften %d / %d' % (i + 1, soften_iterations)
+                ret_project = self.try_soften(pair, image_fn_pair, i, predict)
+                # Did we win?
+                if ret_project:
+                    return ret_project
 
-        for i in xrange(soften_iterations):
+        print 'WARNING: gave up on generating control points!'
+        return None
+        #raise Exception('ERROR: still could not make a coherent project!')
+
+    def try_soften(self, pair, image_fn_pair, i, predict=None):
+        '''Try to match image_fn_pair softened i + 1 times.  Returns project using the original file names or None'''
+        with self.soften_lock:
             self.soften_try[i] += 1
 
-            # And then start screwing with it
-            # Wonder if we can combine features from multiple soften passes?
-            # Or at least take the maximum
-            # Do features get much less accurate as the soften gets up there?
+        soften_fns = self.soften_cache.get_pair(image_fn_pair, i + 1)
+        print 'Soften fn0: %s' % soften_fns[0]
+        print 'Soften fn1: %s' % soften_fns[1]
+        ret_project = self.try_control_points_with_position(pair, soften_fns, predict)
+        if not ret_project:
+            return None
 
-            print 'Attempting soften %d / %d' % (i + 1, soften_iterations)
+        # Fixup the project to reflect the correct file names
+        text = str(ret_project)
+        for soften_fn, orig_fn in zip(soften_fns, image_fn_pair):
+            print '%s => %s' % (soften_fn, orig_fn)
+            text = text.replace(soften_fn, orig_fn)
+        ret_project.set_text(text)
 
-            if i == 0:
-                soften_composite(image_fn_pair[0], soften_image_file_0_managed.file_name)
-                soften_composite(image_fn_pair[1], soften_image_file_1_managed.file_name)
-            else:
-                soften_composite(soften_image_file_0_managed.file_name)
-                soften_composite(soften_image_file_1_managed.file_name)
+        with self.soften_lock:
+            self.soften_ok[i] += 1
+            print 'Soften try: %s' % (self.soften_try,)
+            print 'Soften ok: %s' % (self.soften_ok,)
+        return ret_project
 
-            pair_soften_image_file_names = (soften_image_file_0_managed.file_name, soften_image_file_1_managed.file_name)
-            ret_project = self.try_control_points_with_position(pair, pair_soften_image_file_names)
-            # Did we win?
-            if ret_project:
-                # Fixup the project to reflect the correct file names
-                text = str(ret_project)
-                if 0:
-                    print
-                    print 'Before sub'
-                    print
-                    print str(ret_project)
-                    print
-                    print
-                    print
-                print '%s => %s' % (soften_image_file_0_managed.file_name, image_fn_pair[0])
-                text = text.replace(soften_image_file_0_managed.file_name, image_fn_pair[0])
-                print '%s => %s' % (soften_image_file_1_managed.file_name, image_fn_pair[1])
-                text = text.replace(soften_image_file_1_managed.file_name, image_fn_pair[1])
-
-                ret_project.set_text(text)
-                if 0:
-                    print
-                    print 'After sub'
-                    print
-                    print str(ret_project)
-                    print
-                    print
-                    print
-                    #sys.exit(1)
-                self.soften_ok[i] += 1
-                print 'Soften try: %s' % (self.soften_try,)
-                print 'Soften ok: %s' % (self.soften_ok,)
-                return ret_project
+    def soften_all(self, pair, image_fn_pair, soften_iterations, predict=None):
+        '''Try all soften levels concurrently, returning the project with the most control points'''
+        # Soften serially so the cache builds each level from the last
+        for i in xrange(soften_iterations):
+            self.soften_cache.get_pair(image_fn_pair, i + 1)
 
-        print 'WARNING: gave up on generating control points!'
-        return None
-        #raise Exception('ERROR: still could not make a coherent project!')
+        # Matching is spent in external processes so threads are enough
+        pool = ThreadPool(soften_iterations)
+        try:
+            projects = pool.map(lambda i: self.try_soften(pair, image_fn_pair, i, predict), range(soften_iterations))
+        finally:
+            pool.close()
+            pool.join()
+
+        best = None
+        best_n = 0
+        for i, project in enumerate(projects):
+            if not project:
+                continue
+            n = len(project.get_control_point_lines())
+            print 'Soften %d: %d control points' % (i + 1, n)
+            # Ties go to the least softened
+            if n > best_n:
+                best = project
+                best_n = n
+        return best
 
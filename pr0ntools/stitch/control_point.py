@@ -6,6 +6,7 @@ Licensed under a 2 clause BSD license, see COPYING for details
 from pr0ntools.temp_file import ManagedTempFile
 from pr0ntools.temp_file import ManagedTempDir
 from pr0ntools.execute import exc_ret_istr
+from pr0ntools.benchmark import StageTimes
 from pr0ntools.stitch.pto.project import PTOProject
 from pr0ntools.stitch.pto.util import *
 from pr0ntools.stitch.pto.control_point_line import ControlPointLine
@@ -55,6 +56,10 @@ class AutopanoSiftC:
     Example stitch command
     "autopano-sift-c" "--maxmatches" "0" "--maxdim" "10000" "out.pto" "first.png" "second.png"
     '''
+    def __init__(self):
+        # Time spent in match / parse
+        self.stages = StageTimes()
+
     def generate_core(self, image_file_names):
         project_file = ManagedTempFile.get(None, ".pto")
 
@@ -85,7 +90,8 @@ class AutopanoSiftC:
 
         # go go go
         #(rc, output) = Execute.with_output(command, args)
-        (rc, output) = (exc_ret_istr(command, args), '')
+        with self.stages.stage('match'):
+            (rc, output) = exc_ret_istr(command, args)
         if not rc == 0:
             print
             print
@@ -95,9 +101,10 @@ class AutopanoSiftC:
             raise Exception('Bad rc: %d' % rc)
 
         # We return PTO object, not string
-        return PTOProject.from_temp_file(project_file)
+        with self.stages.stage('parse'):
+            return PTOProject.from_temp_file(project_file)
 
-def pto_unsub(src_prj, sub_image_files, deltas, sub_to_real):
+def pto_unsub(src_prj, sub_image_files, deltas, sub_to_real, deltas1=(0, 0)):
     '''
     Transforms a sub-project back into original control point coordinate space using original file names
     Returns a new project file
@@ -111,6 +118,8 @@ def pto_unsub(src_prj, sub_image_files, deltas, sub_to_real):
         only has delta within relative image frame, not entire project canvas
     sub_to_real: map of project file names to target (original) project file names
         the output project must use these instead of the original names
+    deltas1: same as deltas but for the second image
+        only non-zero if the second image was cropped on its left/top
     '''
     ret = PTOProject.from_simple()
 
@@ -139,10 +148,14 @@ def pto_unsub(src_prj, sub_image_files, deltas, sub_to_real):
             # normal adjustment
             dst_cpl.set_variable('x', src_cpl.get_variable('x') + deltas[0])
             dst_cpl.set_variable('y', src_cpl.get_variable('y') + deltas[1])
+            dst_cpl.set_variable('X', src_cpl.get_variable('X') + deltas1[0])
+            dst_cpl.set_variable('Y', src_cpl.get_variable('Y') + deltas1[1])
         else:
             # they got flipped
             dst_cpl.set_variable('X', src_cpl.get_variable('X') + deltas[0])
             dst_cpl.set_variable('Y', src_cpl.get_variable('Y') + deltas[1])
+            dst_cpl.set_variable('x', src_cpl.get_variable('x') + deltas1[0])
+            dst_cpl.set_variable('y', src_cpl.get_variable('y') + deltas1[1])
         # add it
         ret.add_control_point_line(dst_cpl)
 
@@ -200,6 +213,8 @@ class ControlPointGeneratorXX:
 class PanoCP:
     def __init__(self):
         self.print_output = True
+        # Time spent in match / clean / parse
+        self.stages = StageTimes()
 
     def generate_core(self, img_fns):
         # cpfind (and likely cpclean) trashes absolute file names
@@ -238,7 +253,8 @@ class PanoCP:
 
         #(rc, output) = Execute.with_output('cpfind', args, print_output=self.print_output)
         print 'cpfind' + ' '.join(args)
-        (rc, output) = exc_ret_istr('cpfind', args, print_out=self.print_output)
+        with self.stages.stage('match'):
+            (rc, output) = exc_ret_istr('cpfind', args, print_out=self.print_output)
 
         print 'PanoCP: cpfind done'
         if not rc == 0:
@@ -259,7 +275,8 @@ class PanoCP:
         # input file
         args.append(project.file_name)
 
-        (rc, output) = exc_ret_istr('cpclean', args, print_out=self.print_output)
+        with self.stages.stage('clean'):
+            (rc, output) = exc_ret_istr('cpclean', args, print_out=self.print_output)
         print 'PanoCP: cpclean done'
         if not rc == 0:
             print
@@ -271,7 +288,8 @@ class PanoCP:
             raise Exception('Bad rc: %d' % rc)
 
 
-        project.reopen()
+        with self.stages.stage('parse'):
+            project.reopen()
         print 'Fixing image lines...'
         for il in project.image_lines:
             src = il.get_name()
@@ -0,0 +1,137 @@
+'''
+pr0ntools
+Copyright 2011 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+
+Control point engine benchmark
+Cuts one large image into an overlapping grid with known offsets
+and measures how fast and how accurately each engine matches the pairs
+'''
+
+from pr0ntools.benchmark import Benchmark, StageTimes
+from pr0ntools.pimage import PImage
+from pr0ntools.stitch.common_stitch import CommonStitch
+from pr0ntools.stitch.control_point import get_cp_engine
+from pr0ntools.stitch.image_coordinate_map import ImageCoordinateMap
+from pr0ntools.stitch.step_model import pair_offset, median
+from pr0ntools.temp_file import ManagedTempDir
+
+import math
+import os
+import random
+import traceback
+
+ENGINES = ('panocp', 'autopano-sift-c')
+
+class CPBench:
+    def __init__(self, src_fn, cols=3, rows=3, overlap=0.3, jitter=8, tile_width=None, tile_height=None, seed=None):
+        self.src_fn = src_fn
+        self.cols = cols
+        self.rows = rows
+        # Fraction of each image shared with its neighbor
+        self.overlap = overlap
+        # Random +/- pixels added to each position to look like stage error
+        self.jitter = jitter
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.rand = random.Random(seed)
+
+        self.tmp_dir = None
+        # file name => (x, y) upper left corner in source image
+        self.truth = {}
+        self.icm = None
+
+    def synthesize(self):
+        '''Write the image grid to a temp dir'''
+        src = PImage.from_file(self.src_fn)
+        tw = self.tile_width
+        th = self.tile_height
+        # Default: fill the source image
+        if tw is None:
+            tw = int((src.width() - 2 * self.jitter) / (1 + (self.cols - 1) * (1.0 - self.overlap)))
+        if th is None:
+            th = int((src.height() - 2 * self.jitter) / (1 + (self.rows - 1) * (1.0 - self.overlap)))
+        xstep = int(tw * (1.0 - self.overlap))
+        ystep = int(th * (1.0 - self.overlap))
+        if (self.cols - 1) * xstep + tw + 2 * self.jitter > src.width() or (self.rows - 1) * ystep + th + 2 * self.jitter > src.height():
+            raise Exception('Source image %dx%d too small for %dx%d grid of %dx%d images' % (src.width(), src.height(), self.cols, self.rows, tw, th))
+        print 'Synthesizing %d cols x %d rows of %dx%d images, step %d x %d' % (self.cols, self.rows, tw, th, xstep, ystep)
+
+        self.tmp_dir = ManagedTempDir.get2()
+        fns = []
+        for col in xrange(self.cols):
+            for row in xrange(self.rows):
+                x = self.jitter + col * xstep + self.rand.randint(-self.jitter, self.jitter)
+                y = self.jitter + row * ystep + self.rand.randint(-self.jitter, self.jitter)
+                fn = os.path.join(self.tmp_dir.file_name, 'c%03d_r%03d.jpg' % (col, row))
+                src.subimage(x, x + tw, y, y + th).save(fn, quality=95)
+                self.truth[fn] = (x, y)
+                fns.append(fn)
+        self.icm = ImageCoordinateMap.from_tagged_file_names(fns)
+
+    def run_engine(self, engine):
+        '''Match every 4 neighbor pair with engine, returning a result dict'''
+        stitcher = CommonStitch()
+        stitcher.set_regular(True)
+        # CommonStitch crops to the last (1 - x_overlap) of the image
+        stitcher.x_overlap = 1.0 - self.overlap
+        stitcher.y_overlap = 1.0 - self.overlap
+        stitcher.control_point_gen = get_cp_engine(engine)
+        stitcher.control_point_gen.print_output = False
+        stitcher.stages = StageTimes()
+        stitcher.control_point_gen.stages = stitcher.stages
+
+        pairs = list(self.icm.gen_pairs(1, 1))
+        errors = []
+        failed = 0
+        bench = Benchmark()
+        for pair in pairs:
+            fns = self.icm.get_images_from_pair(pair)
+            try:
+                project = stitcher.try_control_points_with_position(pair, fns)
+            except Exception:
+                traceback.print_exc()
+                project = None
+            offset = None
+            if project:
+                offset = pair_offset(project, fns[0], fns[1])
+            if offset is None:
+                failed += 1
+                continue
+            (x0, y0) = self.truth[fns[0]]
+            (x1, y1) = self.truth[fns[1]]
+            errors.append(math.hypot(offset[0] - (x1 - x0), offset[1] - (y1 - y0)))
+        bench.stop()
+
+        ret = {
+            'engine': engine,
+            'pairs': len(pairs),
+            'failed': failed,
+            'seconds': bench.delta_s(),
+            'pairs_per_sec': len(pairs) / max(bench.delta_s(), 0.000001),
+            'error_median': None,
+            'error_max': None,
+            'stages': stitcher.stages,
+            }
+        if errors:
+            ret['error_median'] = median(errors)
+            ret['error_max'] = max(errors)
+        return ret
+
+    def run(self, engines=ENGINES):
+        if not self.icm:
+            self.synthesize()
+        return [self.run_engine(engine) for engine in engines]
+
+def print_results(results):
+    for r in results:
+        print
+        print '%s' % r['engine']
+        print '  Pairs: %d, failed: %d' % (r['pairs'], r['failed'])
+        print '  Time: %0.3f sec, %0.3f pairs / sec' % (r['seconds'], r['pairs_per_sec'])
+        if r['error_median'] is None:
+            print '  Error: N/A'
+        else:
+            print '  Error: median %0.2f pix, max %0.2f pix' % (r['error_median'], r['error_max'])
+        for l in str(r['stages']).split('\n'):
+            print '  ' + l
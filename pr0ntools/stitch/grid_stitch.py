@@ -19,8 +19,11 @@ import common_stitch
 import time
 import shutil
 import multiprocessing
+import collections
+from pr0ntools.stitch.step_model import pair_offset
 
-from pr0ntools.util import IOTimestamp
+from pr0ntools import qlog
+from pr0ntools import telemetry
 
 class Worker(object):
     def __init__(self, i, log_fn):
@@ -41,13 +44,15 @@ class Worker(object):
         self.running.wait(1)
 
     def run(self):
-        _outlog = open(self.log_fn, 'w')
-        sys.stdout = _outlog
-        sys.stderr = _outlog
-
-        _outdate = IOTimestamp(sys, 'stdout')
-        _errdate = IOTimestamp(sys, 'stderr')
+        # Formatting and writing happens in a background thread, see qlog
+        qlog.open_log(self.log_fn)
+        try:
+            telemetry.open_log(telemetry.log_fn(os.path.dirname(self.log_fn), 'w%02d' % self.i), proc='w%02d' % self.i)
+            self.loop()
+        finally:
+            qlog.close_log()
 
+    def loop(self):
         self.running.set()
         while self.running.is_set():
             try:
@@ -58,26 +63,22 @@ class Worker(object):
             self.idle = False
 
             try:
-                (pair, pair_fns) = task
+                (pair, pair_fns, predict) = task
 
-                print
-                print
-                print
-                print
-                print
-                print '*' * 80
-                print 'w%d: task rx' % self.i
+                qlog.debug('*' * 80)
+                qlog.info('w%d: task rx %s', self.i, pair)
 
-                pto = self.generate_control_points_by_pair(pair, pair_fns)
+                with telemetry.span('pair', pair='c%d_r%d:c%d_r%d' % (pair.first.col, pair.first.row, pair.second.col, pair.second.row)):
+                    pto = self.generate_control_points_by_pair(pair, pair_fns, predict)
 
                 if not pto:
-                    print 'WARNING: bad project @ %s, %s' % (repr(pair), pair_fns)
+                    qlog.warning('bad project @ %r, %s', pair, pair_fns)
                 else:
                     if len(pto.get_text().strip()) == 0:
                         raise Exception('Generated empty pair project')
 
                 self.qo.put(('done', (task, pto)))
-                print 'w%d: task done, pto: %s' % (self.i, pto)
+                qlog.info('w%d: task done, pto: %s', self.i, pto)
 
             except Exception as e:
                 traceback.print_exc()
@@ -94,6 +95,12 @@ class GridStitch(common_stitch.CommonStitch):
         self.threads = 1
         self.workers = []
         self.workers_p = []
+        # Restrict matching to the overlap predicted from already solved pairs
+        self.predict_windows = True
+        # Which neighbors to match, see image_coordinate_map.PAIRINGS
+        self.pairing = 'grid4'
+        # tree pairing: link rows every this many cols
+        self.loop_spacing = 4
 
     @staticmethod
     def from_tagged_file_names(image_file_names):
@@ -126,8 +133,8 @@ class GridStitch(common_stitch.CommonStitch):
         #temp_projects = list()
 
         print
-        n_pairs = len(list(self.coordinate_map.gen_pairs(1, 1)))
-        print '***Pairs: %d***' % n_pairs
+        n_pairs = len(list(self.coordinate_map.gen_pairs_pairing(self.pairing, self.loop_spacing)))
+        print '***Pairs: %d (%s)***' % (n_pairs, self.pairing)
         print
         pair_submit = 0
         pair_complete = 0
@@ -144,6 +151,7 @@ class GridStitch(common_stitch.CommonStitch):
                 print '!' * 80
                 raise e
 
+        telemetry.open_log(telemetry.log_fn(self.log_dir, 'm'), proc='m')
         print 'Initializing %d workers' % self.threads
         for ti in xrange(self.threads):
             w = Worker(ti, os.path.join(self.log_dir, 'w%02d.log' % ti))
@@ -152,7 +160,11 @@ class GridStitch(common_stitch.CommonStitch):
             w.start()
 
         try:
-            coord_pairs = self.coordinate_map.gen_pairs(1, 1)
+            coord_pairs = self.coordinate_map.gen_pairs_pairing(self.pairing, self.loop_spacing)
+            # Pairs queued in response to failures, tried before continuing with coord_pairs
+            self.extra_pairs = collections.deque()
+            self.pairs_seen = set()
+            coord_pairs_done = False
 
             all_allocated = False
 
@@ -185,11 +197,17 @@ class GridStitch(common_stitch.CommonStitch):
                         print task
                         #print pto
 
-                        (_pair, pair_fns) = task
+                        (pair, pair_fns, _predict) = task
                         if pto:
                             self.failures.add_success(pair_fns)
+                            if self.predict_windows:
+                                self.step_model.add(pair, pair_offset(pto, pair_fns[0], pair_fns[1]))
+                                print 'Step model: %s' % self.step_model
                         else:
                             self.failures.add_failure(pair_fns)
+                            n_pairs += self.queue_fallback(pair)
+                            if self.extra_pairs:
+                                all_allocated = False
 
                         fn = os.path.join(self.log_dir, 'stat.txt')
                         open(fn + '.tmp', 'w').write(prog + '\n')
@@ -223,7 +241,8 @@ class GridStitch(common_stitch.CommonStitch):
                 # Merge projects
                 if len(final_pair_projects):
                     print 'Merging %d projects' % len(final_pair_projects)
-                    self.project.merge_into(final_pair_projects)
+                    with telemetry.span('merge'):
+                        self.project.merge_into(final_pair_projects)
 
                 # Any workers need more work?
                 for wi, worker in enumerate(self.workers):
@@ -231,9 +250,20 @@ class GridStitch(common_stitch.CommonStitch):
                         break
                     if worker.qi.empty():
                         while True:
-                            try:
-                                pair = coord_pairs.next()
-                            except  StopIteration:
+                            pair = None
+                            if self.extra_pairs:
+                                # Already marked seen when queued
+                                pair = self.extra_pairs.popleft()
+                            elif not coord_pairs_done:
+                                try:
+                                    pair = coord_pairs.next()
+                                except  StopIteration:
+                                    coord_pairs_done = True
+                                    continue
+                                if pair.key() in self.pairs_seen:
+                                    continue
+                                self.pairs_seen.add(pair.key())
+                            if pair is None:
                                 print 'All tasks allocated'
                                 all_allocated = True
                                 break
@@ -248,9 +278,14 @@ class GridStitch(common_stitch.CommonStitch):
                             print 'pair images: ' + repr(pair_images)
                             if pair_images[0] is None or pair_images[1] is None:
                                 print 'WARNING: skipping missing image'
+                                # Sparse pairings need another route around the hole
+                                n_pairs += self.queue_fallback(pair)
                                 continue
 
-                            worker.qi.put((pair, pair_images))
+                            predict = None
+                            if self.predict_windows:
+                                predict = self.step_model.predict(pair)
+                            worker.qi.put((pair, pair_images, predict))
                             pair_submit += 1
                             break
 
@@ -304,8 +339,22 @@ class GridStitch(common_stitch.CommonStitch):
             print
         '''
 
-    def do_generate_control_points_by_pair(self, pair, image_fn_pair):
-        ret = common_stitch.CommonStitch.do_generate_control_points_by_pair(self, pair, image_fn_pair)
+    def queue_fallback(self, pair):
+        '''Queue extra pairs to make up for a failed pair, returning the number added'''
+        added = 0
+        for extra in self.coordinate_map.fallback_pairs(pair, self.pairing):
+            if extra.key() in self.pairs_seen:
+                continue
+            # May also be coming up in coord_pairs, pairs_seen filters that one
+            self.pairs_seen.add(extra.key())
+            self.extra_pairs.append(extra)
+            added += 1
+        if added:
+            print 'Queued %d fallback pairs for %s' % (added, repr(pair))
+        return added
+
+    def do_generate_control_points_by_pair(self, pair, image_fn_pair, predict=None):
+        ret = common_stitch.CommonStitch.do_generate_control_points_by_pair(self, pair, image_fn_pair, predict)
         if ret is None and pair.adjacent():
             print 'WARNING: last ditch effort, increasing field of view'
 
@@ -4,13 +4,52 @@ Copyright 2011 John McMaster <JohnDMcMaster@gmail.com>
 Licensed under a 2 clause BSD license, see COPYING for details
 '''
 
+import hashlib
+import json
 import math
 import os
+import re
 from pr0ntools.pimage import PImage
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 class MissingImage(Exception):
     pass
 
+# Directories with fewer images than this aren't worth caching
+ICM_CACHE_MIN = 1024
+
+def icm_cache_fn(dir):
+    '''Cache file kept next to (not in) dir so it doesn't show up as a tile'''
+    # abspath so '.' doesn't become '..icm.json'
+    return os.path.abspath(dir) + '.icm.json'
+
+def names_key(names):
+    '''Cache key for a directory listing, the map only depends on the names'''
+    return hashlib.sha1('\n'.join(sorted(names))).hexdigest()
+
+def iter_dir(dir):
+    '''Yield entry names in dir, streaming with scandir when available'''
+    if scandir is None:
+        for f in os.listdir(dir):
+            yield f
+    else:
+        for entry in scandir(dir):
+            yield entry.name
+
+# Strategies for picking which neighbors get feature matched
+# grid4: left/right and up/down neighbors
+# grid8: grid4 plus diagonals
+# grid4-fallback: grid4, diagonals only around a failed pair
+# tree: rows chained plus vertical links every few cols, grid4 around a failed pair
+PAIRINGS = ('grid4', 'grid8', 'grid4-fallback', 'tree')
+
 '''
 Grid coordinates
 Not an actual image
@@ -58,13 +97,34 @@ class ImageCoordinatePair:
     def __repr__(self):
         return '%s vs %s' % (self.first, self.second)
 
+    def key(self):
+        '''Hashable ((col, row), (col, row)) identifying the pair'''
+        return ((self.first.col, self.first.row), (self.second.col, self.second.row))
+
+    @staticmethod
+    def from_cr(col0, row0, col1, row1):
+        return ImageCoordinatePair(ImageCoordinateMapPairing(col0, row0), ImageCoordinateMapPairing(col1, row1))
+
     @staticmethod
     def from_spatial_points(first, second):
         return ImageCoordinatePair(ImageCoordinateMapPairing(first.coordinates[1], first.coordinates[0]), ImageCoordinateMapPairing(second.coordinates[1], second.coordinates[0]))
 
+# Common case: c0012_r0034.jpg, r0034_c0012.jpg, x12_y34.png
+_ROW_COL_RE = re.compile(r'^([cxry])([0-9]+)_([cxry])([0-9]+)(\.|$)')
+
 def get_row_col(file_name):
     '''Return (row, col) tuple identify file name position'''
-        
+    m = _ROW_COL_RE.match(os.path.basename(file_name))
+    if m:
+        k0, v0, k1, v1 = m.group(1, 2, 3, 4)
+        col0 = k0 in 'cx'
+        # Same axis twice falls through to get a proper error
+        if col0 != (k1 in 'cx'):
+            if col0:
+                return (int(v1), int(v0))
+            else:
+                return (int(v0), int(v1))
+
     row = None
     col = None
     
@@ -189,9 +249,62 @@ class ImageCoordinateMap:
         return file_names
     
     @staticmethod
-    def from_dir_tagged_file_names(dir, rows=None, cols=None):
-        return ImageCoordinateMap.from_tagged_file_names([os.path.join(dir, f) for f in os.listdir(dir)], rows, cols)
-        
+    def from_dir_tagged_file_names(dir, rows=None, cols=None, cache=True):
+        '''
+        Map all files in dir
+        Large directories are cached to dir.icm.json and reused while the file names are unchanged
+        Maps sized by rows / cols hints are neither cached nor loaded from the cache
+        '''
+        names = list(iter_dir(dir))
+        # Only the unhinted map is cached
+        cache = cache and rows is None and cols is None
+        cache_fn = icm_cache_fn(dir)
+        key = None
+        if cache:
+            key = names_key(names)
+            ret = ImageCoordinateMap.from_cache(cache_fn, dir, key)
+            if ret:
+                return ret
+
+        ret = ImageCoordinateMap.from_tagged_file_names([os.path.join(dir, f) for f in names], rows, cols)
+        if cache and ret.n_images() >= ICM_CACHE_MIN:
+            try:
+                ret.save_cache(cache_fn, dir, key)
+            except (IOError, OSError) as e:
+                # Read only parent dir or similar, not important
+                print 'WARNING: failed to save map cache %s: %s' % (cache_fn, e)
+        return ret
+
+    @staticmethod
+    def from_cache(cache_fn, dir, key):
+        '''Return map cached by save_cache() or None if missing / stale'''
+        try:
+            j = json.load(open(cache_fn))
+        except (IOError, ValueError):
+            return None
+        if j.get('version') != 2 or j.get('key') != key:
+            print 'Map cache %s stale' % cache_fn
+            return None
+        print 'Loaded %d images from map cache %s' % (len(j['layout']), cache_fn)
+        ret = ImageCoordinateMap(j['cols'], j['rows'])
+        for (col, row, f) in j['layout']:
+            ret.layout[(col, row)] = os.path.join(dir, f)
+        return ret
+
+    def save_cache(self, cache_fn, dir, key):
+        # Store basenames so the directory can be moved along with its cache
+        layout = [(col, row, os.path.relpath(fn, dir)) for (col, row), fn in self.layout.iteritems()]
+        j = {
+            'version': 2,
+            'key': key,
+            'cols': self.cols,
+            'rows': self.rows,
+            'layout': layout,
+            }
+        tmp_fn = cache_fn + '.tmp'
+        json.dump(j, open(tmp_fn, 'w'))
+        os.rename(tmp_fn, cache_fn)
+
     @staticmethod
     def from_tagged_file_names(file_names, rows=None, cols=None, partial=False, check_bounds=True):
         '''Partial: if set will allow gaps and consider it a smaller set'''
@@ -206,13 +319,16 @@ class ImageCoordinateMap:
         if rows is None and not cols is None:
             cols = math.ceil(len(file_names) / rows)
         
+        # Parse each name once
+        # Sort for deterministic results on duplicate positions
+        parsed = [(file_name, get_row_col(file_name)) for file_name in sorted(file_names)]
+
         if rows is None or cols is None:
             print 'Row / col hints insufficient, guessing row / col layout from file names'
             row_parts = set([0])
             col_parts = set([0])
             
-            for fn in file_names:
-                (row, col) = get_row_col(fn)
+            for (_fn, (row, col)) in parsed:
                 row_parts.add(row)
                 col_parts.add(col)
             
@@ -226,10 +342,8 @@ class ImageCoordinateMap:
         print 'initial cols / X dim / width: %d, rows / Y dim / height: %d' % (cols, rows)
         
         ret = ImageCoordinateMap(cols, rows)
-        file_names = sorted(file_names)
-        for file_name in file_names:
+        for (file_name, (row, col)) in parsed:
             # Not canonical, but resolved well enough
-            (row, col) = get_row_col(file_name)
             if row is None or col is None:
                 raise Exception('Bad file name %s' % file_name)
             ret.set_image_rc(row, col, file_name, check_bounds=check_bounds)
@@ -259,6 +373,83 @@ class ImageCoordinateMap:
                         to_yield = ImageCoordinatePair(ImageCoordinateMapPairing(col_1, row_1), ImageCoordinateMapPairing(col_0, row_0))
                         yield to_yield
 
+    def gen_pairs_grid8(self):
+        '''Like gen_pairs(1, 1) but also pair diagonal neighbors'''
+        for pair in self.gen_pairs(1, 1):
+            yield pair
+        for col in range(0, self.cols - 1):
+            for row in range(0, self.rows - 1):
+                yield ImageCoordinatePair.from_cr(col, row, col + 1, row + 1)
+                yield ImageCoordinatePair.from_cr(col + 1, row, col, row + 1)
+
+    def gen_pairs_tree(self, loop_spacing=4):
+        '''
+        Returns a generator of ImageCoordinatePair's linking every image with few pairs
+        Each row is chained left to right and rows are linked by vertical pairs
+        every loop_spacing cols (and the last col)
+        The extra vertical pairs close loops so the optimizer can't bend rows independently
+        '''
+        for row in range(0, self.rows):
+            for col in range(0, self.cols - 1):
+                yield ImageCoordinatePair.from_cr(col, row, col + 1, row)
+        link_cols = set(range(0, self.cols, max(1, loop_spacing)))
+        link_cols.add(self.cols - 1)
+        for col in sorted(link_cols):
+            for row in range(0, self.rows - 1):
+                yield ImageCoordinatePair.from_cr(col, row, col, row + 1)
+
+    def gen_pairs_pairing(self, pairing='grid4', loop_spacing=4):
+        '''Returns a generator of ImageCoordinatePair's for a named strategy (see PAIRINGS)'''
+        if pairing in ('grid4', 'grid4-fallback'):
+            return self.gen_pairs(1, 1)
+        elif pairing == 'grid8':
+            return self.gen_pairs_grid8()
+        elif pairing == 'tree':
+            return self.gen_pairs_tree(loop_spacing)
+        else:
+            raise Exception('Bad pairing %s' % pairing)
+
+    def neighbor_pairs(self, col, row, straight=True, diagonal=True):
+        '''Returns a list of in bounds ImageCoordinatePair's between (col, row) and its neighbors'''
+        ret = []
+        for dcol in (-1, 0, 1):
+            for drow in (-1, 0, 1):
+                if dcol == 0 and drow == 0:
+                    continue
+                if dcol and drow:
+                    if not diagonal:
+                        continue
+                elif not straight:
+                    continue
+                ocol = col + dcol
+                orow = row + drow
+                if ocol < 0 or ocol >= self.cols or orow < 0 or orow >= self.rows:
+                    continue
+                # Same ordering as gen_pairs: upper image first, left first within a row
+                if (orow, ocol) < (row, col):
+                    ret.append(ImageCoordinatePair.from_cr(ocol, orow, col, row))
+                else:
+                    ret.append(ImageCoordinatePair.from_cr(col, row, ocol, orow))
+        return ret
+
+    def fallback_pairs(self, pair, pairing='grid4'):
+        '''
+        Returns a list of ImageCoordinatePair's to try after pair failed to match
+        grid4-fallback: diagonals around both images
+        tree: the 4 neighbor pairs the tree skipped
+        Caller is responsible for removing pairs that were already tried
+        '''
+        if pairing == 'grid4-fallback':
+            straight, diagonal = False, True
+        elif pairing == 'tree':
+            straight, diagonal = True, False
+        else:
+            return []
+        ret = []
+        for p in (pair.first, pair.second):
+            ret += self.neighbor_pairs(p.col, p.row, straight=straight, diagonal=diagonal)
+        return ret
+
     def __repr__(self):
         ret = ''
         for row in range(0, self.rows):
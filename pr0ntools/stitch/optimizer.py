@@ -1130,10 +1130,14 @@ def chaos_opt(project, icm):
             open_set.remove(pref)
 
 def pto2icm(pto):
-    fns = []
-    for il in pto.get_image_lines():
-        fns.append(il.get_name())
-    return ImageCoordinateMap.from_tagged_file_names(fns)
+    fns = tuple([il.get_name() for il in pto.get_image_lines()])
+    # Optimizers call this repeatedly on the same project
+    cached = getattr(pto, '_icm_cache', None)
+    if cached and cached[0] == fns:
+        return cached[1]
+    ret = ImageCoordinateMap.from_tagged_file_names(fns)
+    pto._icm_cache = (fns, ret)
+    return ret
 
 '''
 Assumes images are in a grid to simplify workflow management
@@ -0,0 +1,115 @@
+'''
+pr0ntools
+Copyright 2012 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+
+Quick low resolution preview of a .pto without running nona / enblend
+Assumes a translation only (d/e) layout like the CNC grid scans
+'''
+
+from PIL import Image, ImageChops
+import itertools
+import multiprocessing
+import os
+
+def _load_scaled(args):
+    '''Return (mode, size, data) of fn shrunk to size, decoding at reduced scale where possible'''
+    fn, size = args
+    im = Image.open(fn)
+    # JPEG decodes directly at 1/2, 1/4 or 1/8 scale
+    im.draft('RGB', size)
+    if im.mode not in ('RGB', 'L'):
+        im = im.convert('RGB')
+    im = im.resize(size, Image.ANTIALIAS)
+    return (im.mode, im.size, im.tobytes())
+
+def feather_mask(size, feather):
+    '''L mask ramping from 0 at the edges to 255 feather pixels in'''
+    w, h = size
+
+    def ramp(n):
+        return [min(255, 255 * (i + 1) / feather, 255 * (n - i) / feather) for i in xrange(n)]
+
+    mx = Image.new('L', (w, 1))
+    mx.putdata(ramp(w))
+    my = Image.new('L', (1, h))
+    my.putdata(ramp(h))
+    return ImageChops.darker(mx.resize((w, h)), my.resize((w, h)))
+
+class Preview(object):
+    def __init__(self, pto, max_size=2000, scale=None, feather=8, threads=1):
+        self.pto = pto
+        # Longest output side if scale isn't given
+        self.max_size = max_size
+        self.scale = scale
+        # Blend width in output pixels, 0 to paste with hard edges
+        self.feather = feather
+        self.threads = threads
+
+    def image_fn(self, il):
+        fn = il.get_name()
+        if not os.path.isabs(fn) and self.pto.file_name:
+            fn = os.path.join(os.path.dirname(self.pto.file_name), fn)
+        return fn
+
+    def layout(self):
+        '''Return list of (file name, x, y, w, h) in panorama pixels'''
+        ret = []
+        for il in self.pto.get_image_lines():
+            if il.getv('d') is None or il.getv('e') is None:
+                raise Exception('%s: missing position, optimize first' % il.get_name())
+            # d/e are positive up left, see optimizer.get_rms()
+            ret.append((self.image_fn(il), -il.getv('d'), -il.getv('e'), il.width(), il.height()))
+        return ret
+
+    def run(self):
+        layout = self.layout()
+        if not layout:
+            raise Exception('No images')
+        xmin = min([x for (_fn, x, _y, _w, _h) in layout])
+        ymin = min([y for (_fn, _x, y, _w, _h) in layout])
+        xmax = max([x + w for (_fn, x, _y, w, _h) in layout])
+        ymax = max([y + h for (_fn, _x, y, _w, h) in layout])
+        scale = self.scale
+        if scale is None:
+            scale = min(1.0, 1.0 * self.max_size / max(xmax - xmin, ymax - ymin))
+        size = (max(1, int((xmax - xmin) * scale)), max(1, int((ymax - ymin) * scale)))
+        print 'Preview: %d images, %dw x %dh => %dw x %dh (scale %0.4f)' % (len(layout), xmax - xmin, ymax - ymin, size[0], size[1], scale)
+
+        tasks = [(fn, (max(1, int(round(w * scale))), max(1, int(round(h * scale))))) for (fn, _x, _y, w, h) in layout]
+        pool = None
+        if self.threads > 1:
+            pool = multiprocessing.Pool(self.threads)
+            results = pool.imap(_load_scaled, tasks)
+        else:
+            results = itertools.imap(_load_scaled, tasks)
+
+        dst = None
+        # 255 where something has already been pasted
+        coverage = Image.new('L', size)
+        masks = {}
+        try:
+            for (fn, x, y, _w, _h), (mode, im_size, data) in itertools.izip(layout, results):
+                im = Image.frombytes(mode, im_size, data)
+                if dst is None:
+                    dst = Image.new(im.mode, size)
+                elif im.mode != dst.mode:
+                    im = im.convert(dst.mode)
+                pos = (int(round((x - xmin) * scale)), int(round((y - ymin) * scale)))
+                box = (pos[0], pos[1], pos[0] + im_size[0], pos[1] + im_size[1])
+                if self.feather:
+                    mask = masks.get(im_size)
+                    if mask is None:
+                        mask = feather_mask(im_size, self.feather)
+                        masks[im_size] = mask
+                    # Only blend where there is something to blend with
+                    mask = ImageChops.lighter(mask, ImageChops.invert(coverage.crop(box)))
+                    dst.paste(im, pos, mask)
+                else:
+                    dst.paste(im, pos)
+                coverage.paste(255, box)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        return dst
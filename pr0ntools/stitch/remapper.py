@@ -72,7 +72,11 @@ panotools wiki says that hugin should be able to output cropped but I don't see
 
 #from pr0ntools.execute import Execute, CommandFailed
 from pr0ntools import execute
-import datetime
+from pr0ntools import qlog
+from pr0ntools import telemetry
+from PIL import Image, TiffImagePlugin, TiffTags
+from fractions import Fraction
+import math
 import os
 import sys
 
@@ -108,6 +112,8 @@ class Nona:
         #self.image_type = Remapper.TIFF_MULTILAYER
         self.image_type = Nona.TIFF_SINGLE
         self.output_files = None
+        # execute.Result of the last remap()
+        self.result = None
         # panotools wiki says enblend 2.4+ supports this
         self.output_cropped = True
         self.compression_opt = "c:LZW"
@@ -115,9 +121,9 @@ class Nona:
         self.args = None
 
         def p(s=''):
-            print '%s: %s' % (datetime.datetime.utcnow().isoformat(), s)
+            print '%s%s' % (qlog.timestamp(), s)
         self.p = p
-        self.pprefix = lambda: datetime.datetime.utcnow().isoformat() + ': '
+        self.pprefix = qlog.timestamp
         self.stdout = sys.stdout
         self.stderr = sys.stderr
         self.start_hook = start_hook
@@ -137,6 +143,15 @@ class Nona:
     '''
         
     def remap(self):
+        self.result = None
+        with telemetry.span('remap', remapper='nona') as rec:
+            try:
+                self.do_remap()
+            finally:
+                if self.result:
+                    rec.update(self.result.fields())
+
+    def do_remap(self):
         old_files = get_nona_files(self.output_prefix, len(self.pto_project.get_image_lines()))
         # For my purposes right now I think this will always be 0
         if len(old_files) != 0:
@@ -177,8 +192,11 @@ class Nona:
         # p w2673 h2056 f0 v76 n"TIFF_m r:CROP c:LZW" E0.0 R0 S"276,2673,312,2056"
         # m line unchanged
         print 'Remapper: executing %s' % (args,)
-        rc = execute.prefix(args, stdout=self.stdout, stderr=self.stderr, prefix=self.pprefix)
-        if not rc == 0:
+        result = execute.run(args, stdout=self.stdout, stderr=self.stderr, prefix=self.pprefix)
+        self.p('Remapper: %s' % (result,))
+        # Timing / resource use for the telemetry span
+        self.result = result
+        if not result.rc == 0:
             self.p()
             self.p()
             self.p()
@@ -202,3 +220,184 @@ class Nona:
         return self.output_files
         
 
+
+# Image variables that must be at their default for a pure shift remap
+# Geometry: yaw, pitch, roll, radial distortion, shear, mosaic translation
+# Photometric: response curve, vignetting
+TRANSLATE_DEFAULTS = {
+    'y': 0, 'p': 0, 'r': 0,
+    'a': 0, 'b': 0, 'c': 0, 'g': 0, 't': 0,
+    'TrX': 0, 'TrY': 0, 'TrZ': 0, 'Tpy': 0, 'Tpp': 0,
+    'Ra': 0, 'Rb': 0, 'Rc': 0, 'Rd': 0, 'Re': 0,
+    'Va': 1, 'Vb': 0, 'Vc': 0, 'Vd': 0,
+    'Eb': 1, 'Er': 1,
+}
+
+def focal_pixels(w, v):
+    '''Rectilinear focal length in pixels for width w and horizontal field of view v degrees'''
+    return w / (2.0 * math.tan(math.radians(v) / 2.0))
+
+def translate_unsupported(pto):
+    '''Return why pto can't be remapped by TranslateRemapper or None if it can'''
+    pl = pto.get_panorama_line()
+    if pl.getv('f') not in (None, 0):
+        return 'panorama projection f%s' % pl.getv('f')
+    if not pl.getv('w') or not pl.getv('h') or not pl.getv('v'):
+        return 'panorama missing size or field of view'
+    fp = focal_pixels(pl.getv('w'), pl.getv('v'))
+    # Exposure is corrected relative to the panorama
+    eev = pl.getv('E') or 0
+    for il in pto.get_image_lines():
+        if il.getv('f') not in (None, 0):
+            return '%s: lens f%s' % (il.get_name(), il.getv('f'))
+        for k, default in TRANSLATE_DEFAULTS.iteritems():
+            v = il.getv(k)
+            if v is not None and v != default:
+                return '%s: %s%s' % (il.get_name(), k, v)
+        if il.getv('d') is None or il.getv('e') is None or not il.getv('w') or not il.getv('v'):
+            return '%s: missing position, size or field of view' % il.get_name()
+        if (il.getv('Eev') or 0) != eev:
+            return '%s: Eev%s vs panorama E%s' % (il.get_name(), il.getv('Eev'), eev)
+        # Scaling would need resampling, not just a shift
+        if abs(focal_pixels(il.getv('w'), il.getv('v')) - fp) > fp * 1e-6:
+            return '%s: scale differs from panorama' % il.get_name()
+    return None
+
+def image_position(pl, il):
+    '''Return panorama (left, top) of il's upper left pixel assuming a translation only layout'''
+    # d/e shift the image center
+    return ((pl.getv('w') - il.getv('w')) / 2.0 - il.getv('d'), (pl.getv('h') - il.getv('h')) / 2.0 - il.getv('e'))
+
+class TranslateRemapper:
+    '''
+    In process replacement for Nona on flat translation only projects (see translate_unsupported())
+    Writes the same cropped TIFF_m layers: RGBA, position and canvas size tags for enblend
+    Only images that intersect the crop are opened
+    '''
+    def __init__(self, pto_project, output_prefix="nonaout"):
+        if output_prefix is None or len(output_prefix) == 0 or output_prefix == '.' or output_prefix == '..':
+            raise RemapperFailed('Bad output file base "%s"' % str(output_prefix))
+        self.pto_project = pto_project
+        self.output_prefix = output_prefix
+        self.output_files = None
+        # Unused, interface compatibility with Nona
+        self.args = None
+        self.pprefix = qlog.timestamp
+
+    def image_fn(self, il):
+        fn = il.get_name()
+        if not os.path.isabs(fn) and self.pto_project.file_name:
+            fn = os.path.join(os.path.dirname(self.pto_project.file_name), fn)
+        return fn
+
+    def remap_image(self, il, crop):
+        '''Return (RGB image, x, y) of il's part of crop relative to the crop or None if it doesn't intersect'''
+        (cl, cr, ct, cb) = crop
+        pl = self.pto_project.get_panorama_line()
+        w = il.getv('w')
+        h = il.getv('h')
+        left, top = image_position(pl, il)
+        # Panorama pixels whose centers land inside the image
+        x0 = max(cl, int(math.ceil(left)))
+        x1 = min(cr, int(math.floor(left + w - 1)) + 1)
+        y0 = max(ct, int(math.ceil(top)))
+        y1 = min(cb, int(math.floor(top + h - 1)) + 1)
+        if x1 <= x0 or y1 <= y0:
+            return None
+
+        im = Image.open(self.image_fn(il))
+        if im.size != (w, h):
+            raise RemapperFailed('%s: expected %dw x %dh, got %dw x %dh' % (il.get_name(), w, h, im.size[0], im.size[1]))
+        if im.mode != 'RGB':
+            im = im.convert('RGB')
+        # Layer pixel (0, 0) in image coordinates
+        sx = x0 - left
+        sy = y0 - top
+        size = (x1 - x0, y1 - y0)
+        if sx == int(sx) and sy == int(sy):
+            layer = im.crop((int(sx), int(sy), int(sx) + size[0], int(sy) + size[1]))
+        else:
+            layer = im.transform(size, Image.AFFINE, (1, 0, sx, 0, 1, sy), resample=Image.BILINEAR)
+        return (layer, x0 - cl, y0 - ct)
+
+    def write_layer(self, layer, x, y, crop, out_fn):
+        (cl, cr, ct, cb) = crop
+        layer = layer.copy()
+        layer.putalpha(255)
+        info = TiffImagePlugin.ImageFileDirectory_v2()
+        # Position within the crop in resolution units
+        info[282] = Fraction(1)
+        info[283] = Fraction(1)
+        info[296] = 1
+        info[286] = Fraction(x)
+        info.tagtype[286] = TiffTags.RATIONAL
+        info[287] = Fraction(y)
+        info.tagtype[287] = TiffTags.RATIONAL
+        # PIXAR_IMAGEFULLWIDTH / PIXAR_IMAGEFULLLENGTH: canvas size
+        info[33300] = cr - cl
+        info.tagtype[33300] = TiffTags.LONG
+        info[33301] = cb - ct
+        info.tagtype[33301] = TiffTags.LONG
+        layer.save(out_fn, tiffinfo=info)
+
+    def canvas_size(self):
+        (cl, cr, ct, cb) = self.pto_project.get_panorama_line().get_crop_ez()
+        return (cr - cl, cb - ct)
+
+    def layers(self):
+        '''Return [(RGB image, x, y)] for the images intersecting the crop, without writing anything'''
+        with telemetry.span('remap', remapper='translate'):
+            return self.do_layers()
+
+    def do_layers(self):
+        crop = self.pto_project.get_panorama_line().get_crop_ez()
+        ret = []
+        for il in self.pto_project.get_image_lines():
+            layer = self.remap_image(il, crop)
+            if layer:
+                ret.append(layer)
+        print '%sTranslateRemapper: %d / %d images intersect crop' % (self.pprefix(), len(ret), len(self.pto_project.get_image_lines()))
+        if not ret:
+            raise RemapperFailed('No images in crop')
+        return ret
+
+    def remap(self):
+        with telemetry.span('remap', remapper='translate'):
+            self.do_remap()
+
+    def do_remap(self):
+        ils = self.pto_project.get_image_lines()
+        old_files = get_nona_files(self.output_prefix, len(ils))
+        if len(old_files) != 0:
+            print old_files
+            raise RemapperFailed('Found some old files')
+
+        pl = self.pto_project.get_panorama_line()
+        crop = pl.get_crop_ez()
+        self.output_files = []
+        for i, il in enumerate(ils):
+            layer = self.remap_image(il, crop)
+            if layer:
+                out_fn = '%s%04d.tif' % (self.output_prefix, i)
+                self.write_layer(layer[0], layer[1], layer[2], crop, out_fn)
+                self.output_files.append(out_fn)
+        print '%sTranslateRemapper: %d / %d images intersect crop' % (self.pprefix(), len(self.output_files), len(ils))
+        if not self.output_files:
+            raise RemapperFailed('No images in crop')
+
+    def get_output_files(self):
+        return self.output_files
+
+def get_remapper(pto_project, output_prefix, remapper='nona'):
+    '''
+    remapper: nona, translate, or auto to use translate when the project allows it
+    '''
+    if remapper == 'nona':
+        return Nona(pto_project, output_prefix)
+    reason = translate_unsupported(pto_project)
+    if reason is None:
+        return TranslateRemapper(pto_project, output_prefix)
+    if remapper == 'translate':
+        raise RemapperFailed('Translate remapper unsupported: %s' % reason)
+    print 'Remapper: using nona, %s' % reason
+    return Nona(pto_project, output_prefix)
@@ -0,0 +1,324 @@
+'''
+pr0ntools
+Copyright 2012 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+
+Render supertiles on other machines
+The Tiler master serves supertile bounds over XML-RPC (same pattern as capture/cf/server.py)
+Remote workers render them with ordinary tiler Workers and send the supertile image back
+The master keeps the closed list and cuts the tiles, so the output is the same as a local run
+
+Only the socket is shared: the project goes out over it and supertiles come back over it
+Source images must be readable by the workers, at the same paths or moved with image_dir
+
+    master:  pr0nts --serve 0.0.0.0:28786 out.pto
+    workers: pr0nts --worker http://master:28786
+'''
+
+from pr0ntools.stitch.blender import MemorySemaphore
+from pr0ntools.stitch.pto.project import PTOProject
+from pr0ntools.stitch.tiler import Worker, save_st_jpg
+from pr0ntools.temp_file import ManagedTempFile
+
+from SimpleXMLRPCServer import SimpleXMLRPCServer
+from xmlrpclib import Binary, ServerProxy, ProtocolError
+import itertools
+import os
+import Queue
+import socket
+import threading
+import time
+import traceback
+
+# ord('pr') = 28786
+PORT = 28786
+# Seconds before a job handed out is given to someone else
+# Also about when the master reports a stalled run
+JOB_TIMEOUT = 4 * 60 * 60
+# Seconds between job requests while the master has nothing to hand out
+POLL = 1.0
+# Seconds between checks on local workers
+WORKER_POLL = 0.1
+# Supertile image types accepted from workers
+ST_EXTS = ('.tif', '.jpg', '.png')
+
+def parse_addr(s):
+    '''[host:]port => (host, port)'''
+    if ':' in s:
+        host, port = s.rsplit(':', 1)
+        return (host, int(port))
+    return ('localhost', int(s))
+
+class Job(object):
+    def __init__(self, task, client):
+        # (st_bounds, scratch_dir) as queued by the Tiler
+        self.task = task
+        self.client = client
+        # so can timeout clients that don't complete jobs
+        self.tstart = time.time()
+
+class TileServer(object):
+    '''
+    Looks like one more Worker to the Tiler master loop: tasks in qi, results out qo
+    Remote workers pull the tasks over XML-RPC
+    '''
+    def __init__(self, bind='localhost', port=PORT, verbose=False):
+        self.bind = bind
+        self.port = port
+        self.verbose = verbose
+        self.timeout = JOB_TIMEOUT
+
+        self.qi = Queue.Queue()
+        self.qo = Queue.Queue()
+        self.st_fns = Queue.Queue()
+        self.running = threading.Event()
+        # Serving thread, named for Tiler.wkill()
+        self.process = None
+        # Renders elsewhere, doesn't use the master's scratch space
+        self.remote = True
+
+        # Settings workers need, see setup()
+        self.config = None
+        self.st_dir = None
+        self.server = None
+        # Job id => Job
+        # Touched by both the RPC thread and the master loop (want_task), hold lock
+        self.outstanding = {}
+        self.lock = threading.Lock()
+        self.job_ids = itertools.count()
+        # Client name => worker threads
+        self.clients = {}
+
+    def setup(self, tiler):
+        self.st_dir = tiler.st_dir
+        self.config = {
+                'pto': tiler.pto.get_text(),
+                'nona_args': tiler.nona_args,
+                'enblend_args': tiler.enblend_args,
+                'remapper': tiler.remapper,
+                'blender': tiler.blender,
+                'ignore_errors': tiler.ignore_errors,
+                }
+
+    def start(self):
+        self.server = SimpleXMLRPCServer((self.bind, self.port), logRequests=self.verbose, allow_none=True)
+        # Port 0 binds any free port
+        self.port = self.server.server_address[1]
+        print 'TileServer: listening on %s:%d' % (self.bind, self.port)
+        # Lets the thread notice running being cleared
+        self.server.timeout = 0.1
+        self.server.register_introspection_functions()
+        self.server.register_function(self.config_req, "config_req")
+        self.server.register_function(self.job_req, "job_req")
+        self.server.register_function(self.job_done, "job_done")
+        self.process = threading.Thread(target=self.run)
+        self.process.daemon = True
+        self.running.set()
+        self.process.start()
+
+    def run(self):
+        try:
+            while self.running.is_set():
+                self.server.handle_request()
+        finally:
+            self.server.server_close()
+
+    def want_task(self):
+        '''Keep enough queued to feed every idle remote thread'''
+        # Also requeue jobs from workers that went away even if nobody is asking for work
+        self.expire()
+        with self.lock:
+            idle = sum(self.clients.values()) - len(self.outstanding)
+        return self.qi.qsize() < max(1, idle)
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            for jid, job in self.outstanding.items():
+                if now - job.tstart > self.timeout:
+                    print 'TileServer WARNING: %s: job %d %s timed out, requeuing' % (job.client, jid, job.task[0])
+                    del self.outstanding[jid]
+                    self.qi.put(job.task)
+
+    '''
+    RPC
+    '''
+    def config_req(self, client, threads):
+        try:
+            print 'TileServer: %s connected with %d threads' % (client, threads)
+            with self.lock:
+                self.clients[client] = threads
+            return self.config
+        except:
+            traceback.print_exc()
+            raise
+
+    def job_req(self, client):
+        '''Return {'id', 'bounds'} or None if there is nothing to do right now'''
+        try:
+            self.expire()
+            try:
+                task = self.qi.get(False)
+            except Queue.Empty:
+                return None
+            jid = self.job_ids.next()
+            print 'TileServer: job %d %s => %s' % (jid, task[0], client)
+            with self.lock:
+                self.outstanding[jid] = Job(task, client)
+            return {'id': jid, 'bounds': list(task[0])}
+        except:
+            traceback.print_exc()
+            raise
+
+    '''
+    img is None if the supertile failed, estr then has the worker's stack trace
+    Otherwise img is the supertile image and ext its file extension
+    '''
+    def job_done(self, client, jid, img, ext, estr):
+        try:
+            with self.lock:
+                job = self.outstanding.pop(jid, None)
+            if job is None:
+                print 'TileServer WARNING: %s: ignoring result of expired job %d' % (client, jid)
+                return False
+            if img is not None and ext not in ST_EXTS:
+                # ext goes into a file name
+                print 'TileServer WARNING: %s: job %d bad image type %r, requeuing' % (client, jid, ext)
+                self.qi.put(job.task)
+                return False
+            print 'TileServer: job %d done by %s: %s in %0.1f sec' % (jid, client, img is not None, time.time() - job.tstart)
+            if img is None:
+                e = Exception('%s: %s' % (client, estr.strip().split('\n')[-1]))
+                self.qo.put(('exception', (job.task, e, estr)))
+                return True
+
+            st_bounds = job.task[0]
+            x0, _x1, y0, _y1 = st_bounds
+            temp_file = ManagedTempFile.get(None, ext, prefix_mangle='st_%06dx_%06dy_' % (x0, y0), scoped=False)
+            open(temp_file.file_name, 'wb').write(img.data)
+            if self.st_dir:
+                dst = os.path.join(self.st_dir, 'st_%06dx_%06dy.jpg' % (x0, y0))
+                save_st_jpg(temp_file.file_name, dst)
+                self.st_fns.put(dst)
+            # Same as a local Worker, the master loads and cuts it
+            self.qo.put(('done', (st_bounds, temp_file.detach())))
+            return True
+        except:
+            traceback.print_exc()
+            raise
+
+class TileClient(object):
+    '''
+    Remote worker: pulls supertiles from a TileServer and renders them with local Workers
+    Workers read their settings off this object as they would off a Tiler
+    '''
+    def __init__(self, url, threads=1, log_dir='pr0nts', image_dir=None, verbose=False):
+        self.url = url
+        self.proxy = ServerProxy(url, allow_none=True)
+        self.name = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.threads = threads
+        self.log_dir = log_dir
+        # Source images are found here by base name instead of at the master's paths
+        self.image_dir = image_dir
+        self.verbose = verbose
+        # Bytes of concurrent blends allowed on this machine, None for no limit
+        self.blend_memory = None
+
+        # Set by the master, see TileServer.setup()
+        self.pto = None
+        self.nona_args = []
+        self.enblend_args = []
+        self.remapper = 'nona'
+        self.blender = 'enblend'
+        self.ignore_errors = False
+        # Supertiles are only kept by the master
+        self.dry = False
+        self.st_dir = None
+        self.blend_sem = None
+        self.workers = None
+
+    def connect(self):
+        '''Wait for the master, which only serves after its dry run'''
+        waiting = False
+        while True:
+            try:
+                return self.proxy.config_req(self.name, self.threads)
+            except socket.error:
+                if not waiting:
+                    print 'TileClient: waiting for %s' % self.url
+                    waiting = True
+                time.sleep(POLL)
+
+    def configure(self, config):
+        self.pto = PTOProject.from_text(config['pto'])
+        if self.image_dir:
+            for il in self.pto.get_image_lines():
+                il.set_name(os.path.join(self.image_dir, os.path.basename(il.get_name())))
+        self.nona_args = config['nona_args']
+        self.enblend_args = config['enblend_args']
+        self.remapper = config['remapper']
+        self.blender = config['blender']
+        self.ignore_errors = config['ignore_errors']
+        if self.blend_memory is not None:
+            self.blend_sem = MemorySemaphore(self.blend_memory)
+
+    def job_done(self, jid, out):
+        what = out[0]
+        if what == 'done':
+            (_st_bounds, img_fn) = out[1]
+            data = open(img_fn, 'rb').read()
+            os.remove(img_fn)
+            self.proxy.job_done(self.name, jid, Binary(data), os.path.splitext(img_fn)[1], None)
+        else:
+            (_task, _e, estr) = out[1]
+            print 'TileClient: job %d failed' % jid
+            print estr
+            self.proxy.job_done(self.name, jid, None, None, estr)
+
+    def run(self):
+        print 'TileClient: %s connecting to %s' % (self.name, self.url)
+        self.configure(self.connect())
+
+        self.workers = []
+        for wi in xrange(self.threads):
+            w = Worker(wi, self, os.path.join(self.log_dir, 'w%02d.log' % wi))
+            self.workers.append(w)
+            w.start()
+
+        # Worker index => job id
+        jobs = {}
+        # Don't ask again for a bit after the master had nothing
+        next_req = 0
+        try:
+            while True:
+                progress = False
+                for wi, worker in enumerate(self.workers):
+                    try:
+                        out = worker.qo.get(False)
+                    except Queue.Empty:
+                        continue
+                    progress = True
+                    self.job_done(jobs.pop(wi), out)
+
+                for wi, worker in enumerate(self.workers):
+                    if wi in jobs or time.time() < next_req:
+                        continue
+                    job = self.proxy.job_req(self.name)
+                    if job is None:
+                        next_req = time.time() + POLL
+                        break
+                    progress = True
+                    jobs[wi] = job['id']
+                    worker.qi.put((job['bounds'], None))
+
+                if not progress:
+                    time.sleep(WORKER_POLL)
+        except (socket.error, ProtocolError) as e:
+            # The master stops serving once every tile is done
+            print 'TileClient: lost %s (%s), exiting with %d jobs in progress' % (self.url, e, len(jobs))
+        finally:
+            print 'TileClient: shutting down workers'
+            for worker in self.workers:
+                worker.running.clear()
+            for worker in self.workers:
+                worker.process.join(1)
@@ -0,0 +1,151 @@
+'''
+pr0ntools
+Copyright 2012 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+
+Region of interest extraction
+Crops a full resolution rectangle out of a supertile (st_*x_*y.jpg) or tile (y*_x*.jpg) dir
+without assembling the whole panorama
+'''
+
+from pr0ntools.stitch.image_coordinate_map import get_row_col, iter_dir
+from pr0ntools.stitch.single import coord
+from PIL import Image
+import hashlib
+import json
+import os
+
+# Entries are hashed into square buckets of about this many pixels
+BUCKET_MIN = 256
+
+def roi_cache_fn(dir):
+    '''Cache file kept next to (not in) dir so it doesn't show up as an image'''
+    # abspath so '.' doesn't become '..roi.json'
+    return os.path.abspath(dir) + '.roi.json'
+
+def dir_key(dir, names):
+    '''Cache key for the files in dir: names, sizes and mtimes, catches in place edits'''
+    h = hashlib.sha1()
+    for f in sorted(names):
+        st = os.stat(os.path.join(dir, f))
+        h.update('%s\t%d\t%r\n' % (f, st.st_size, st.st_mtime))
+    return h.hexdigest()
+
+class ROIIndex(object):
+    '''Position and size of every image in a dir, bucketed by area for quick overlap lookup'''
+    def __init__(self, dir, images):
+        self.dir = dir
+        # list of (file name relative to dir, x, y, w, h)
+        self.images = images
+        self.bucket = BUCKET_MIN
+        if images:
+            self.bucket = max(BUCKET_MIN, max([max(w, h) for (_f, _x, _y, w, h) in images]))
+        # (bucket x, bucket y) => list of indexes into images
+        self.buckets = {}
+        for i, (_f, x, y, w, h) in enumerate(images):
+            for by in xrange(y // self.bucket, (y + h - 1) // self.bucket + 1):
+                for bx in xrange(x // self.bucket, (x + w - 1) // self.bucket + 1):
+                    self.buckets.setdefault((bx, by), []).append(i)
+
+    @staticmethod
+    def scan(dir, names=None):
+        '''Index dir from file names, reading only image headers'''
+        if names is None:
+            names = iter_dir(dir)
+        images = []
+        tile_size = None
+        for f in sorted(names):
+            fn = os.path.join(dir, f)
+            if f.startswith('st_') and f.endswith('.jpg'):
+                # Supertiles are named by their panorama position and may differ in size
+                x, y = coord(f)
+                w, h = Image.open(fn).size
+            else:
+                try:
+                    row, col = get_row_col(f)
+                except Exception:
+                    continue
+                # Tiles are all the same size
+                if tile_size is None:
+                    tile_size = Image.open(fn).size
+                w, h = tile_size
+                x = col * w
+                y = row * h
+            images.append((f, x, y, w, h))
+        print 'ROI: indexed %d images in %s' % (len(images), dir)
+        return ROIIndex(dir, images)
+
+    @staticmethod
+    def from_dir(dir, cache=True):
+        '''Load dir index from cache if no file in it has changed, otherwise scan it'''
+        cache_fn = roi_cache_fn(dir)
+        names = list(iter_dir(dir))
+        key = None
+        if cache:
+            key = dir_key(dir, names)
+            try:
+                j = json.load(open(cache_fn))
+                if j.get('version') == 2 and j.get('key') == key:
+                    return ROIIndex(dir, [tuple(image) for image in j['images']])
+                print 'ROI cache %s stale' % cache_fn
+            except (IOError, ValueError):
+                pass
+
+        ret = ROIIndex.scan(dir, names)
+        if cache:
+            j = {
+                'version': 2,
+                'key': key,
+                'images': ret.images,
+                }
+            try:
+                tmp_fn = cache_fn + '.tmp'
+                json.dump(j, open(tmp_fn, 'w'))
+                os.rename(tmp_fn, cache_fn)
+            except (IOError, OSError) as e:
+                # Read only parent dir or similar, not important
+                print 'WARNING: failed to save ROI cache %s: %s' % (cache_fn, e)
+        return ret
+
+    def bounds(self):
+        '''Return (x0, y0, x1, y1) covered by all images'''
+        if not self.images:
+            return None
+        return (min([x for (_f, x, _y, _w, _h) in self.images]),
+                min([y for (_f, _x, y, _w, _h) in self.images]),
+                max([x + w for (_f, x, _y, w, _h) in self.images]),
+                max([y + h for (_f, _x, y, _w, h) in self.images]))
+
+    def overlapping(self, x0, y0, x1, y1):
+        '''Return images intersecting [x0, x1) x [y0, y1) in index (paste) order'''
+        hits = set()
+        for by in xrange(y0 // self.bucket, (y1 - 1) // self.bucket + 1):
+            for bx in xrange(x0 // self.bucket, (x1 - 1) // self.bucket + 1):
+                for i in self.buckets.get((bx, by), ()):
+                    _f, x, y, w, h = self.images[i]
+                    if x < x1 and x + w > x0 and y < y1 and y + h > y0:
+                        hits.add(i)
+        return [self.images[i] for i in sorted(hits)]
+
+    def extract(self, x0, y0, x1, y1, mode=None):
+        '''Return a PIL image of panorama area [x0, x1) x [y0, y1), uncovered area is black'''
+        if x1 <= x0 or y1 <= y0:
+            raise Exception('Bad ROI %d,%d to %d,%d' % (x0, y0, x1, y1))
+        hits = self.overlapping(x0, y0, x1, y1)
+        if not hits:
+            raise Exception('ROI %d,%d to %d,%d does not overlap any images' % (x0, y0, x1, y1))
+        ret = None
+        for (f, x, y, w, h) in hits:
+            print 'ROI: reading %s' % f
+            im = Image.open(os.path.join(self.dir, f))
+            if ret is None:
+                ret = Image.new(mode or im.mode, (x1 - x0, y1 - y0))
+            cx0 = max(x, x0)
+            cy0 = max(y, y0)
+            cx1 = min(x + w, x1)
+            cy1 = min(y + h, y1)
+            ret.paste(im.crop((cx0 - x, cy0 - y, cx1 - x, cy1 - y)), (cx0 - x0, cy0 - y0))
+        return ret
+
+def extract_roi(dir, x0, y0, x1, y1, cache=True):
+    return ROIIndex.from_dir(dir, cache=cache).extract(x0, y0, x1, y1)
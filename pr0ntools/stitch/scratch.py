@@ -0,0 +1,115 @@
+'''
+pr0ntools
+Copyright 2012 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+
+Scratch space for supertile intermediates (remapped TIFF_m layers)
+Each supertile's layers are estimated from the images overlapping its crop
+and placed on a RAM backed dir (tmpfs) if one is configured and they fit, otherwise under temp_base
+Supertiles wait for running ones to finish rather than overrunning either
+'''
+
+from pr0ntools.config import config
+from pr0ntools.stitch.remapper import image_position
+
+import os
+
+# Remapped layers are RGBA, LZW usually does better but plan for the worst case
+LAYER_BPP = 4
+# Fraction of free space used when there is no explicit budget
+FREE_FRACTION = 0.8
+# tmpfs also competes with the workers for RAM
+TMPFS_FREE_FRACTION = 0.5
+
+def free_bytes(d):
+    st = os.statvfs(d)
+    return st.f_bavail * st.f_frsize
+
+def image_rects(pto):
+    '''Return [(left, top, w, h)] of each image, left / top None if not positioned'''
+    pl = pto.get_panorama_line()
+    ret = []
+    for il in pto.get_image_lines():
+        if il.getv('d') is None or il.getv('e') is None:
+            ret.append((None, None, il.width(), il.height()))
+        else:
+            left, top = image_position(pl, il)
+            ret.append((left, top, il.width(), il.height()))
+    return ret
+
+def layer_pixels(rects, bounds):
+    '''
+    Estimate remapped layer pixels for a supertile crop
+    nona crops each layer (r:CROP) so only the image / crop intersection counts
+    '''
+    x0, x1, y0, y1 = bounds
+    ret = 0
+    for (left, top, w, h) in rects:
+        if left is None:
+            # Unknown position: assume it covers as much as it can
+            ret += min(w, x1 - x0) * min(h, y1 - y0)
+            continue
+        iw = min(x1, left + w) - max(x0, left)
+        ih = min(y1, top + h) - max(y0, top)
+        if iw > 0 and ih > 0:
+            ret += int(iw + 1) * int(ih + 1)
+    return ret
+
+def layer_bytes(rects, bounds):
+    return layer_pixels(rects, bounds) * LAYER_BPP
+
+class Reservation(object):
+    def __init__(self, where, dir, nbytes):
+        # 'tmpfs' or 'disk'
+        self.where = where
+        # Parent dir for the intermediates, None for the default temp dir
+        self.dir = dir
+        self.nbytes = nbytes
+
+    def __repr__(self):
+        return '%s %0.1f MB' % (self.where, self.nbytes / 1e6)
+
+class ScratchManager(object):
+    def __init__(self, tmpfs_dir=None, budget=None, tmpfs_budget=None):
+        '''
+        tmpfs_dir: RAM backed dir, None or '' to keep everything under temp_base
+        budget: disk bytes in flight, None to use most of the current free space
+        tmpfs_budget: as budget for tmpfs_dir
+        '''
+        if tmpfs_dir and not os.path.isdir(tmpfs_dir):
+            print 'Scratch: tmpfs dir %s not found, using disk only' % tmpfs_dir
+            tmpfs_dir = None
+        self.tmpfs_dir = tmpfs_dir
+        # Free space is taken once up front
+        # Later it would already include our own in flight intermediates
+        disk_dir = os.path.dirname(config.temp_base()) or '.'
+        if budget is None:
+            budget = int(free_bytes(disk_dir) * FREE_FRACTION)
+        self.budget = budget
+        if tmpfs_dir and tmpfs_budget is None:
+            tmpfs_budget = int(free_bytes(tmpfs_dir) * TMPFS_FREE_FRACTION)
+        self.tmpfs_budget = tmpfs_budget or 0
+        self.used = {'tmpfs': 0, 'disk': 0}
+        self.inflight = 0
+        print 'Scratch: disk %s budget %0.1f MB, tmpfs %s budget %0.1f MB' % (
+                disk_dir, self.budget / 1e6, self.tmpfs_dir, self.tmpfs_budget / 1e6)
+
+    def reserve(self, nbytes):
+        '''Return a Reservation for nbytes of intermediates or None if it has to wait'''
+        if self.tmpfs_dir and self.used['tmpfs'] + nbytes <= self.tmpfs_budget:
+            ret = Reservation('tmpfs', self.tmpfs_dir, nbytes)
+        elif self.used['disk'] + nbytes <= self.budget:
+            ret = Reservation('disk', None, nbytes)
+        elif self.inflight == 0:
+            # Waiting won't help, let it try
+            print 'Scratch WARNING: %0.1f MB estimate exceeds budget' % (nbytes / 1e6,)
+            ret = Reservation('disk', None, nbytes)
+        else:
+            return None
+        self.used[ret.where] += nbytes
+        self.inflight += 1
+        return ret
+
+    def release(self, res):
+        self.used[res.where] -= res.nbytes
+        self.inflight -= 1
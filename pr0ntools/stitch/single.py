@@ -1,5 +1,9 @@
 from PIL import Image
+import collections
+import multiprocessing
 import re
+import struct
+import zlib
 
 # /usr/local/lib/python2.7/dist-packages/PIL/Image.py:2210: DecompressionBombWarning: Image size (941782785 pixels) exceeds limit of 89478485 pixels, could be decompression bomb DOS attack.
 #   DecompressionBombWarning)
@@ -8,16 +12,198 @@ Image.MAX_IMAGE_PIXELS = None
 class HugeJPEG(Exception):
     pass
 
-def singlify(fns_in, fn_out, fn_out_alt=None):
-    def coord(fn):
-        '''Return (x, y) for filename'''
-        # st_021365x_005217y.jpg
-        m = re.match('.*st_([0-9]*)x_([0-9]*)y.jpg', fn)
-        return (int(m.group(1), 10), int(m.group(2), 10))
-    
+def coord(fn):
+    '''Return (x, y) for filename'''
+    # st_021365x_005217y.jpg
+    m = re.match('.*st_([0-9]*)x_([0-9]*)y.jpg', fn)
+    return (int(m.group(1), 10), int(m.group(2), 10))
+
+# TIFF field types
+TIFF_SHORT = 3
+TIFF_LONG = 4
+TIFF_LONG8 = 16
+
+# Leave room for the IFD and deflate expansion when picking classic TIFF
+CLASSIC_TIFF_MAX = 2**32 - 2**26
+
+'''
+Writes a strip TIFF one band of rows at a time
+Strip data goes out as it arrives and the IFD is written at the end
+Switches to BigTIFF (64 bit offsets) if the data may not fit in a classic TIFF
+'''
+class StripTIFFWriter(object):
+    def __init__(self, fn, w, h, mode, rows_per_strip, compress=False, bigtiff=None):
+        '''bigtiff: None to only use BigTIFF when needed'''
+        if mode == 'RGB':
+            self.spp = 3
+            self.photometric = 2
+        elif mode == 'L':
+            self.spp = 1
+            self.photometric = 1
+        else:
+            raise Exception('Unsupported TIFF mode %s' % mode)
+        self.fn = fn
+        self.w = w
+        self.h = h
+        self.mode = mode
+        self.rows_per_strip = rows_per_strip
+        self.compress = compress
+        self.big = bigtiff
+        if self.big is None:
+            self.big = w * h * self.spp >= CLASSIC_TIFF_MAX
+        self.offsets = []
+        self.counts = []
+
+        self.f = open(fn, 'wb')
+        if self.big:
+            # Byte order, version, offset size, reserved, first IFD
+            self.f.write(struct.pack('<2sHHHQ', 'II', 43, 8, 0, 0))
+        else:
+            self.f.write(struct.pack('<2sHI', 'II', 42, 0))
+        self.pos = self.f.tell()
+
+    def write_strip(self, data):
+        '''Write the next (already compressed if compress) strip'''
+        self.f.write(data)
+        self.offsets.append(self.pos)
+        self.counts.append(len(data))
+        self.pos += len(data)
+
+    def close(self):
+        # IFD must be word aligned
+        if self.pos % 2:
+            self.f.write('\0')
+            self.pos += 1
+        off_type = TIFF_LONG8 if self.big else TIFF_LONG
+        entries = [
+                (256, TIFF_LONG, [self.w]),
+                (257, TIFF_LONG, [self.h]),
+                (258, TIFF_SHORT, [8] * self.spp),
+                (259, TIFF_SHORT, [8 if self.compress else 1]),
+                (262, TIFF_SHORT, [self.photometric]),
+                (273, off_type, self.offsets),
+                (277, TIFF_SHORT, [self.spp]),
+                (278, TIFF_LONG, [self.rows_per_strip]),
+                (279, off_type, self.counts),
+                (284, TIFF_SHORT, [1]),
+                ]
+
+        if self.big:
+            head = struct.Struct('<Q')
+            entry = struct.Struct('<HHQ')
+            inline = 8
+        else:
+            head = struct.Struct('<H')
+            entry = struct.Struct('<HHI')
+            inline = 4
+        fmts = {TIFF_SHORT: 'H', TIFF_LONG: 'I', TIFF_LONG8: 'Q'}
+        ifd_pos = self.pos
+        # Values too big for the entry go after the IFD
+        extra_pos = ifd_pos + head.size + len(entries) * (entry.size + inline) + inline
+        ifd = head.pack(len(entries))
+        extra = ''
+        for tag, typ, vals in entries:
+            data = struct.pack('<%d%s' % (len(vals), fmts[typ]), *vals)
+            ifd += entry.pack(tag, typ, len(vals))
+            if len(data) <= inline:
+                ifd += data + '\0' * (inline - len(data))
+            else:
+                ifd += struct.pack('<Q' if self.big else '<I', extra_pos + len(extra))
+                extra += data
+                if len(extra) % 2:
+                    extra += '\0'
+        # No next IFD
+        ifd += '\0' * inline
+        self.f.write(ifd)
+        self.f.write(extra)
+        # Point the header at the IFD
+        if self.big:
+            self.f.seek(8)
+            self.f.write(struct.pack('<Q', ifd_pos))
+        else:
+            self.f.seek(4)
+            self.f.write(struct.pack('<I', ifd_pos))
+        self.f.close()
+
+def _compress(data):
+    return zlib.compress(data, 6)
+
+'''
+Assembles supertiles into a TIFF a band of rows at a time
+Each supertile is decoded once and dropped after the last band it overlaps
+so memory is about one row of supertiles instead of the whole canvas
+'''
+class StreamSingle(object):
+    def __init__(self, fns_in, fn_out, band_height=256, compress=False, threads=1):
+        self.fns_in = fns_in
+        self.fn_out = fn_out
+        self.band_height = band_height
+        self.compress = compress
+        self.threads = threads
+        # See StripTIFFWriter
+        self.bigtiff = None
+
+    def run(self, xmin, ymin, w, h, mode):
+        # (y, x, fn, index) sorted by where they start
+        # index keeps the original paste order where supertiles overlap
+        pending = collections.deque(sorted([(coord(fn)[1] - ymin, coord(fn)[0] - xmin, fn, i) for i, fn in enumerate(self.fns_in)]))
+        # index => (x, y, decoded image)
+        active = {}
+        writer = StripTIFFWriter(self.fn_out, w, h, mode, self.band_height, compress=self.compress, bigtiff=self.bigtiff)
+        pool = None
+        if self.compress and self.threads > 1:
+            pool = multiprocessing.Pool(self.threads)
+        # In flight compressions, bounded so bands don't pile up in memory
+        inflight = collections.deque()
+        try:
+            for y0 in xrange(0, h, self.band_height):
+                y1 = min(y0 + self.band_height, h)
+                print 'Band %d:%d / %d, %d supertiles open' % (y0, y1, h, len(active))
+                while pending and pending[0][0] < y1:
+                    y, x, fn, i = pending.popleft()
+                    im = Image.open(fn)
+                    im.load()
+                    active[i] = (x, y, im)
+                band = Image.new(mode, (w, y1 - y0))
+                for i in sorted(active):
+                    x, y, im = active[i]
+                    if y + im.size[1] <= y0:
+                        continue
+                    cy0 = max(y, y0)
+                    cy1 = min(y + im.size[1], y1)
+                    band.paste(im.crop((0, cy0 - y, im.size[0], cy1 - y)), (x, cy0 - y0))
+                for i in [i for i, (_x, y, im) in active.items() if y + im.size[1] <= y1]:
+                    del active[i]
+                data = band.tobytes()
+                del band
+
+                if pool:
+                    inflight.append(pool.apply_async(_compress, (data,)))
+                    while len(inflight) > 2 * self.threads:
+                        writer.write_strip(inflight.popleft().get())
+                elif self.compress:
+                    writer.write_strip(_compress(data))
+                else:
+                    writer.write_strip(data)
+            while inflight:
+                writer.write_strip(inflight.popleft().get())
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        writer.close()
+
+def is_tif(fn):
+    return fn.lower().endswith('.tif') or fn.lower().endswith('.tiff')
+
+def singlify(fns_in, fn_out, fn_out_alt=None, band_height=256, compress=False, threads=1):
+    '''
+    .tif output is streamed band by band, see StreamSingle
+    Other formats are assembled on a full size canvas
+    '''
     if not fns_in:
         raise Exception("No input")
-    
+
     print 'Calculating dimensions...'
     xmin = None
     xmax = None
@@ -33,7 +219,7 @@ def singlify(fns_in, fn_out, fn_out_alt=None):
             ymin = min(ymin, y)
             xmax = max(xmax, x)
             ymax = max(ymax, y)
-    
+
     print 'X: %d:%d' % (xmin, xmax)
     print 'Y: %d:%d' % (ymin, ymax)
     #with Image.open(fns_in[0]) as im0:
@@ -43,7 +229,6 @@ def singlify(fns_in, fn_out, fn_out_alt=None):
         w = im0.size[0] + xmax - xmin
         h = im0.size[1] + ymax - ymin
         print 'Net size: %dw x %dh' % (w, h)
-        dst = Image.new(im0.mode, (w, h))
 
     def verify_format():
         if fn_out.find('.jpg') >= 0:
@@ -67,7 +252,14 @@ def singlify(fns_in, fn_out, fn_out_alt=None):
         return fn_out
 
     fn_out = verify_format()
-    
+
+    if is_tif(fn_out):
+        print 'Streaming to %s...' % fn_out
+        StreamSingle(fns_in, fn_out, band_height=band_height, compress=compress, threads=threads).run(xmin, ymin, w, h, im0.mode)
+        print 'Done!'
+        return
+
+    dst = Image.new(im0.mode, (w, h))
     for fni, fn in enumerate(fns_in):
         print 'Merging %d/%d %s...' % (fni + 1, len(fns_in), fn)
         (x, y) = coord(fn)
@@ -76,4 +268,3 @@ def singlify(fns_in, fn_out, fn_out_alt=None):
     print 'Saving %s...' % fn_out
     dst.save(fn_out, quality=90)
     print 'Done!'
-
@@ -0,0 +1,136 @@
+'''
+pr0ntools
+Copyright 2011 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+
+Running model of the stage step between grid neighbors
+The CNC stage moves very consistently so once a few pairs are solved
+we can predict where the next pair overlaps and only match that window
+'''
+
+import collections
+import math
+import os
+
+def median(vals):
+    vals = sorted(vals)
+    n = len(vals)
+    if n % 2:
+        return vals[n / 2]
+    return (vals[n / 2 - 1] + vals[n / 2]) / 2.0
+
+def pair_offset(project, fn0, fn1):
+    '''
+    Return (dx, dy) position of fn1's upper left corner in fn0 pixel coordinates
+    Uses the median across all control points between the two images
+    Returns None if the project doesn't have any control points between them
+    '''
+    i0 = None
+    i1 = None
+    for i, il in enumerate(project.get_image_lines()):
+        name = il.get_name()
+        if name == fn0 or os.path.realpath(name) == os.path.realpath(fn0):
+            i0 = i
+        elif name == fn1 or os.path.realpath(name) == os.path.realpath(fn1):
+            i1 = i
+    if i0 is None or i1 is None:
+        return None
+
+    dxs = []
+    dys = []
+    for cpl in project.get_control_point_lines():
+        n = cpl.getv('n')
+        N = cpl.getv('N')
+        x = cpl.getv('x')
+        y = cpl.getv('y')
+        X = cpl.getv('X')
+        Y = cpl.getv('Y')
+        # A feature at x, y in image n is at X, Y in image N
+        if n == i0 and N == i1:
+            dxs.append(x - X)
+            dys.append(y - Y)
+        elif n == i1 and N == i0:
+            dxs.append(X - x)
+            dys.append(Y - y)
+    if not dxs:
+        return None
+    return (median(dxs), median(dys))
+
+class StepModel(object):
+    '''
+    Tracks the pixel offset of one col step and one row step
+    Diagonal and longer pairs are predicted as a sum of the two
+    '''
+    def __init__(self, history=64, min_samples=3, min_tol=32.0):
+        # Only keep recent results so we follow slow drift
+        self.history = history
+        # Don't predict until we have this many solves along an axis
+        self.min_samples = min_samples
+        # Smallest allowed deviation from prediction in pixels
+        self.min_tol = min_tol
+        # (dcol, drow) => deque of (dx, dy)
+        self.steps = {
+                (1, 0): collections.deque(maxlen=history),
+                (0, 1): collections.deque(maxlen=history),
+                }
+
+    @staticmethod
+    def pair_delta(pair):
+        return (pair.second.col - pair.first.col, pair.second.row - pair.first.row)
+
+    def add(self, pair, offset):
+        '''Record a solved (dx, dy) offset for an ImageCoordinatePair'''
+        if offset is None:
+            return
+        delta = self.pair_delta(pair)
+        if delta in self.steps:
+            self.steps[delta].append(offset)
+        elif (-delta[0], -delta[1]) in self.steps:
+            self.steps[(-delta[0], -delta[1])].append((-offset[0], -offset[1]))
+
+    def step(self, axis):
+        '''Return (dx, dy, spread) for axis (1, 0) or (0, 1) or None if not enough data'''
+        samples = self.steps[axis]
+        if len(samples) < self.min_samples:
+            return None
+        dx = median([s[0] for s in samples])
+        dy = median([s[1] for s in samples])
+        # Median absolute deviation scaled to be comparable to a standard deviation
+        mad = median([math.hypot(s[0] - dx, s[1] - dy) for s in samples]) * 1.4826
+        return (dx, dy, mad)
+
+    def predict(self, pair):
+        '''Return predicted (dx, dy, tolerance) for pair or None if we can't make a good guess'''
+        dcol, drow = self.pair_delta(pair)
+        dx = 0.0
+        dy = 0.0
+        spread = 0.0
+        for (axis, n) in (((1, 0), dcol), ((0, 1), drow)):
+            if n == 0:
+                continue
+            step = self.step(axis)
+            if step is None:
+                return None
+            dx += n * step[0]
+            dy += n * step[1]
+            spread += abs(n) * step[2]
+        return (dx, dy, max(self.min_tol, 4 * spread))
+
+    def check(self, predict, offset):
+        '''Return True if offset agrees with prediction'''
+        if predict is None:
+            return True
+        if offset is None:
+            return False
+        dx, dy, tol = predict
+        return math.hypot(offset[0] - dx, offset[1] - dy) <= tol
+
+    def __str__(self):
+        ret = []
+        for axis in sorted(self.steps):
+            step = self.step(axis)
+            if step is None:
+                ret.append('%s: %d samples' % (axis, len(self.steps[axis])))
+            else:
+                ret.append('%s: dx %0.1f, dy %0.1f, spread %0.1f (%d samples)' % (axis, step[0], step[1], step[2], len(self.steps[axis])))
+        return ', '.join(ret)
@@ -41,10 +41,13 @@ At the end check that all times have been generated and throw an error if we are
 Greedy algorithm to generate a tile if its legal (and safe)
 '''
 
-from pr0ntools.stitch.remapper import Nona
-from pr0ntools.stitch.blender import Enblend
+from pr0ntools.stitch.remapper import get_remapper, translate_unsupported, TranslateRemapper
+from pr0ntools.stitch.scratch import ScratchManager, image_rects, layer_bytes, layer_pixels
+from pr0ntools.stitch.blender import get_blender, blend_memory, Layer, MemorySemaphore
 from image_coordinate_map import ImageCoordinateMap
 from pr0ntools.config import config
+from pr0ntools import qlog
+from pr0ntools import telemetry
 from pr0ntools.temp_file import ManagedTempFile
 from pr0ntools.temp_file import ManagedTempDir
 from pr0ntools.pimage import PImage
@@ -52,7 +55,7 @@ from pr0ntools.benchmark import Benchmark
 from pr0ntools.geometry import ceil_mult
 from pr0ntools.execute import CommandFailed
 from pr0ntools.stitch.pto.util import dbg, rm_red_img
-from pr0ntools.util import IOTimestamp
+from PIL import Image
 
 import datetime
 import math
@@ -68,6 +71,30 @@ import traceback
 class InvalidClip(Exception):
     pass
 
+def save_st_jpg(src_fn, dst):
+    '''Save a reduced quality copy of supertile src_fn for --st-dir'''
+    #shutil.copyfile(src_fn, dst)
+    args = ['convert',
+            '-quality', '90', 
+            src_fn, dst]                    
+    print 'going to execute: %s' % (args,)
+    subp = subprocess.Popen(args, stdout=None, stderr=None, shell=False)
+    subp.communicate()
+    if subp.returncode != 0:
+        raise Exception('Failed to copy stitched file')
+
+    # having some problems that looks like file isn't getting written to disk
+    # monitoring for such errors
+    # remove if I can root cause the source of these glitches
+    for i in xrange(30):
+        if os.path.exists(dst):
+            break
+        if i == 0:
+            print 'WARNING: soften missing strong blur dest file name %s, waiting a bit...' % (dst,)
+        time.sleep(0.1)
+    else:
+        raise Exception('Missing soften strong blur output file name %s' % dst)
+
 class PartialStitcher(object):
     def __init__(self, pto, bounds, out, worki, work_run, pprefix):
         self.pto = pto
@@ -75,7 +102,14 @@ class PartialStitcher(object):
         self.out = out
         self.nona_args = []
         self.enblend_args = []
-        self.enblend_lock = False
+        # Shared MemorySemaphore, None to blend without waiting
+        self.blend_sem = None
+        # nona, translate or auto
+        self.remapper = 'nona'
+        # See blender.BLENDERS
+        self.blender = 'enblend'
+        # Parent dir for intermediates, None for the default temp dir
+        self.scratch_dir = None
         self.worki = worki
         self.work_run = work_run
         self.pprefix = pprefix
@@ -89,7 +123,7 @@ class PartialStitcher(object):
         Each one takes a noticible amount of time but its relatively small compared to the time spent actually mapping images
         '''
         print
-        print 'Supertile phase 1: remapping (nona)'
+        print 'Supertile phase 1: remapping'
         if self.out.find('.') < 0:
             raise Exception('Require image extension')
         # Hugin likes to use the base filename as the intermediates, lets do the sames
@@ -101,7 +135,12 @@ class PartialStitcher(object):
 
         # Scope of these files is only here
         # We only produce the single output file, not the intermediates
-        managed_temp_dir = ManagedTempDir.get2(prefix_mangle='st_%06dx_%06dy_' % (self.bounds[0], self.bounds[1]))
+        prefix_mangle = 'st_%06dx_%06dy_' % (self.bounds[0], self.bounds[1])
+        if self.scratch_dir:
+            managed_temp_dir = ManagedTempDir.get2(prefix=os.path.join(self.scratch_dir, 'pr0ntools_' + prefix_mangle))
+        else:
+            managed_temp_dir = ManagedTempDir.get2(prefix_mangle=prefix_mangle)
+        print 'Intermediates: %s' % managed_temp_dir.file_name
         # without the slash they go into the parent directory with that prefix
         out_name_prefix = managed_temp_dir.file_name + "/"
         
@@ -124,9 +163,27 @@ class PartialStitcher(object):
         #print 'debug break' ; sys.exit(1)
         
         print 'Preparing remapper...'
-        remapper = Nona(pto, out_name_prefix)
+        remapper = get_remapper(pto, out_name_prefix, self.remapper)
         remapper.pprefix = self.pprefix
         remapper.args = self.nona_args
+
+        if self.blender != 'enblend' and isinstance(remapper, TranslateRemapper):
+            '''
+            Translated layers go straight to the blender without intermediate files
+            '''
+            print 'Supertile phase 1 + 2: remapping and blending in memory (%s)' % self.blender
+            blender = get_blender(self.blender, None, self.out)
+            blender.pprefix = self.pprefix
+            # Layers are held from here on
+            nbytes = self.blend_acquire(layer_pixels(image_rects(pto), self.bounds))
+            try:
+                blender.set_layers([Layer(im, x, y) for (im, x, y) in remapper.layers()], remapper.canvas_size())
+                blender.run()
+            finally:
+                self.blend_release(nbytes)
+            print 'Supertile ready!'
+            return
+
         print 'Starting remapper...'
         remapper.remap()
         
@@ -134,11 +191,17 @@ class PartialStitcher(object):
         Phase 2: blend the remapped images into an output image
         '''
         print
-        print 'Supertile phase 2: blending (enblend)'
-        blender = Enblend(remapper.get_output_files(), self.out, lock=self.enblend_lock)
+        print 'Supertile phase 2: blending (%s)' % self.blender
+        blender = get_blender(self.blender, remapper.get_output_files(), self.out)
         blender.pprefix = self.pprefix
         blender.args = self.enblend_args
-        blender.run()
+        # Layer sizes from the TIFF headers
+        sizes = [Image.open(f).size for f in remapper.get_output_files()]
+        nbytes = self.blend_acquire(sum([w * h for (w, h) in sizes]))
+        try:
+            blender.run()
+        finally:
+            self.blend_release(nbytes)
         # We are done with these files, they should be nuked
         if not config.keep_temp_files():
             for f in remapper.get_output_files():
@@ -146,6 +209,19 @@ class PartialStitcher(object):
         
         print 'Supertile ready!'
 
+    def blend_acquire(self, pixels):
+        '''Wait until there is memory to blend pixels of layers, returning bytes to release'''
+        if self.blend_sem is None:
+            return 0
+        nbytes = blend_memory(self.blender, pixels)
+        print 'Blend estimate: %0.1f MP of layers => %0.1f MB' % (pixels / 1e6, nbytes / 1e6)
+        self.blend_sem.acquire(nbytes)
+        return nbytes
+
+    def blend_release(self, nbytes):
+        if self.blend_sem is not None:
+            self.blend_sem.release(nbytes)
+
 
 class Worker(object):
     def __init__(self, i, tiler, log_fn):
@@ -162,10 +238,15 @@ class Worker(object):
         self.ignore_errors = tiler.ignore_errors
         self.st_dir = tiler.st_dir
         self.pto = tiler.pto
-        self.enblend_lock = tiler.enblend_lock
+        self.blend_sem = tiler.blend_sem
         self.nona_args = tiler.nona_args
         self.enblend_args = tiler.enblend_args
+        self.remapper = tiler.remapper
+        self.blender = tiler.blender
+        self.verbose = tiler.verbose
         self.st_fns = multiprocessing.Queue()
+        # Renders on this machine (uses the master's scratch space)
+        self.remote = False
 
     def pprefix(self):
         # hack: ocassionally get io
@@ -173,6 +254,9 @@ class Worker(object):
         if not self.running:
             raise Exception('not running')
         # TODO: put this into queue so we don't drop
+        # qlog stamps each line itself
+        if qlog.active():
+            return 'w%d: ' % self.i
         return '%s w%d: ' % (datetime.datetime.utcnow().isoformat(), self.i)
         
     def start(self):
@@ -180,14 +264,19 @@ class Worker(object):
         # Prevents later join failure
         self.running.wait(1)
 
-    def run(self):
-        _outlog = open(self.log_fn, 'w')
-        sys.stdout = _outlog
-        sys.stderr = _outlog
+    def want_task(self):
+        return self.qi.empty()
 
-        _outdate = IOTimestamp(sys, 'stdout')
-        _errdate = IOTimestamp(sys, 'stderr')
+    def run(self):
+        # Formatting and writing happens in a background thread, see qlog
+        qlog.open_log(self.log_fn, level=qlog.DEBUG if self.verbose else qlog.INFO)
+        try:
+            telemetry.open_log(telemetry.log_fn(os.path.dirname(self.log_fn), 'w%02d' % self.i), proc='w%02d' % self.i)
+            self.loop()
+        finally:
+            qlog.close_log()
 
+    def loop(self):
         self.running.set()
         self.exit = False
         print 'Worker starting'
@@ -198,27 +287,24 @@ class Worker(object):
                 continue
             
             try:
-                (st_bounds,) = task
+                (st_bounds, scratch_dir) = task
 
-                print
-                print
-                print
-                print
-                print '*' * 80
-                print 'task rx'
+                qlog.debug('*' * 80)
+                qlog.info('task rx: %s', st_bounds)
 
                 try:
-                    img_fn = self.try_supertile(st_bounds)
+                    with telemetry.span('supertile', st='%06dx_%06dy' % (st_bounds[0], st_bounds[2])):
+                        img_fn = self.try_supertile(st_bounds, scratch_dir)
                     self.qo.put(('done', (st_bounds, img_fn)))
                 except CommandFailed as e:
                     if not self.ignore_errors:
                         raise
                     # We shouldn't be trying commands during dry but just in case should raise?
-                    print 'WARNING: got exception trying supertile %s' % str(st_bounds)
+                    qlog.warning('got exception trying supertile %s', st_bounds)
                     traceback.print_exc()
                     estr = traceback.format_exc()
                     self.qo.put(('exception', (task, e, estr)))
-                print 'task done'
+                qlog.info('task done')
                 
             except Exception as e:
                 traceback.print_exc()
@@ -227,7 +313,7 @@ class Worker(object):
         print 'exiting'
         self.exit = True
 
-    def try_supertile(self, st_bounds):
+    def try_supertile(self, st_bounds, scratch_dir=None):
         '''x0/1 and y0/1 are global absolute coordinates'''
         # First generate all of the valid tiles across this area to see if we can get any useful work done?
         # every supertile should have at least one solution or the bounds aren't good
@@ -248,9 +334,12 @@ class Worker(object):
             temp_file = ManagedTempFile.get(None, '.tif', prefix_mangle='st_%06dx_%06dy_' % (x0, y0))
 
             stitcher = PartialStitcher(self.pto, st_bounds, temp_file.file_name, self.i, self.running, pprefix=self.pprefix)
-            stitcher.enblend_lock = self.enblend_lock
+            stitcher.blend_sem = self.blend_sem
             stitcher.nona_args = self.nona_args
             stitcher.enblend_args = self.enblend_args
+            stitcher.remapper = self.remapper
+            stitcher.blender = self.blender
+            stitcher.scratch_dir = scratch_dir
 
             if self.dry:
                 print 'dry: skipping partial stitch'
@@ -266,36 +355,14 @@ class Worker(object):
             else:
                 if self.st_dir:
                     self.st_fns.put(dst)
-                    
-                    #shutil.copyfile(temp_file.file_name, dst)
-                    args = ['convert',
-                            '-quality', '90', 
-                            temp_file.file_name, dst]                    
-                    print 'going to execute: %s' % (args,)
-                    subp = subprocess.Popen(args, stdout=None, stderr=None, shell=False)
-                    subp.communicate()
-                    if subp.returncode != 0:
-                        raise Exception('Failed to copy stitched file')
-
-                    # having some problems that looks like file isn't getting written to disk
-                    # monitoring for such errors
-                    # remove if I can root cause the source of these glitches
-                    for i in xrange(30):
-                        if os.path.exists(dst):
-                            break
-                        if i == 0:
-                            print 'WARNING: soften missing strong blur dest file name %s, waiting a bit...' % (dst,)
-                        time.sleep(0.1)
-                    else:
-                        raise Exception('Missing soften strong blur output file name %s' % dst)
+                    save_st_jpg(temp_file.file_name, dst)
 
                 # FIXME: was passing loaded image object
                 # Directory should delete on exit
                 # otherwise parent can delete it
                 #img = PImage.from_file(temp_file.file_name)
-                img_fn = temp_file.file_name
                 # prevent deletion
-                temp_file.file_name = ''
+                img_fn = temp_file.detach()
                 
                 #print 'supertile width: %d, height: %d' % (img.width(), img.height())
                 print 'Supertile done w/ fn %s' % (img_fn,)
@@ -334,8 +401,24 @@ class Tiler:
         self.st_dir = None
         self.nona_args = []
         self.enblend_args = []
+        # Supertile remapper: nona, translate (in process shift for flat projects) or auto
+        self.remapper = 'nona'
+        # Supertile blender, see blender.BLENDERS
+        self.blender = 'enblend'
+        # Bytes of concurrent blends allowed, None for no limit
+        self.blend_memory = None
+        # Only one blend at a time, same as blend_memory 0
+        self.enblend_lock = False
+        self.blend_sem = None
+        # Supertile intermediates, see scratch.ScratchManager
+        self.scratch_tmpfs = config.scratch_tmpfs()
+        self.scratch_budget = config.scratch_budget()
+        self.scratch_tmpfs_budget = config.scratch_tmpfs_budget()
+        self.scratch = None
         self.threads = 1
         self.workers = None
+        # remote.TileServer handing supertiles to other machines, None to only render locally
+        self.server = None
         self.st_fns = []
         self.st_limit = float('inf')
         self.log_dir = log_dir
@@ -654,31 +737,27 @@ class Tiler:
         skip_yl_check = False
         skip_yh_check = False
         if y0 == self.top():
-            print 'Y check skip (%d): top border' % y0
+            qlog.debug('Y check skip (%d): top border', y0)
             skip_yl_check = True
         if y1 == self.bottom():
-            print 'Y check skip (%d): bottom border' % y1
+            qlog.debug('Y check skip (%d): bottom border', y1)
             skip_yh_check = True
             
         for y in xrange(yt0, yt1, self.th):
             # Are we trying to construct a tile in the buffer zone?
             if (not skip_yl_check) and y < y0 + self.clip_height:
-                if self.verbose:
-                    print 'Rejecting tile @ y%d, x*: yl clip' % (y)
+                qlog.debug('Rejecting tile @ y%d, x*: yl clip', y)
                 continue
             if (not skip_yh_check) and y + self.th >= y1 - self.clip_height:
-                if self.verbose:
-                    print 'Rejecting tile @ y%d, x*: yh clip' % (y)
+                qlog.debug('Rejecting tile @ y%d, x*: yh clip', y)
                 continue
             for x in xrange(xt0, xt1, self.tw):                 
                 # Are we trying to construct a tile in the buffer zone?
                 if (not skip_xl_check) and x < x0 + self.clip_width:
-                    if self.verbose:
-                        print 'Rejecting tiles @ y%d, x%d: xl clip' % (y, x)
+                    qlog.debug('Rejecting tiles @ y%d, x%d: xl clip', y, x)
                     continue
                 if (not skip_xh_check) and x + self.tw >= x1 - self.clip_width:
-                    if self.verbose:
-                        print 'Rejecting tiles @ y%d, x%d: xh clip' % (y, x)
+                    qlog.debug('Rejecting tiles @ y%d, x%d: xh clip', y, x)
                     continue
                 yield (y, x)
                 
@@ -692,10 +771,9 @@ class Tiler:
         bench = Benchmark()
         [x0, x1, y0, y1] = st_bounds
         gen_tiles = 0
-        print
         # TODO: get the old info back if I miss it after yield refactor
-        print 'Phase 4: chopping up supertile'
-        self.msg('step(x: %d, y: %d)' % (self.tw, self.th), 3)
+        qlog.info('Phase 4: chopping up supertile')
+        qlog.debug('step(x: %d, y: %d)', self.tw, self.th)
         #self.msg('x in xrange(%d, %d, %d)' % (xt0, xt1, self.tw), 3)
         #self.msg('y in xrange(%d, %d, %d)' % (yt0, yt1, self.th), 3)
     
@@ -707,8 +785,7 @@ class Tiler:
             # Did we already do this tile?
             if self.is_done(row, col):
                 # No use repeating it although it would be good to diff some of these
-                if self.verbose:
-                    print 'Rejecting tile x%d, y%d / r%d, c%d: already done' % (x, y, row, col)
+                qlog.debug('Rejecting tile x%d, y%d / r%d, c%d: already done', x, y, row, col)
                 continue
         
             # note that x and y are in whole pano coords
@@ -717,7 +794,7 @@ class Tiler:
             self.make_tile(pim, x - x0, y - y0, row, col)
             gen_tiles += 1
         bench.stop()
-        print 'Generated %d new tiles for a total of %d / %d in %s' % (gen_tiles, len(self.closed_list), self.net_expected_tiles, str(bench))
+        qlog.info('Generated %d new tiles for a total of %d / %d in %s', gen_tiles, len(self.closed_list), self.net_expected_tiles, bench)
         if gen_tiles == 0:
             raise Exception("Didn't generate any tiles")
         # temp_file should be automatically deleted upon exit
@@ -732,8 +809,7 @@ class Tiler:
     def make_tile(self, pim, x, y, row, col):
         '''Make a tile given an image, the upper left x and y coordinates in that image, and the global row/col indices'''    
         if self.dry:
-            if self.verbose:
-                print 'Dry: not making tile w/ x%d y%d r%d c%d' % (x, y, row, col)
+            qlog.debug('Dry: not making tile w/ x%d y%d r%d c%d', x, y, row, col)
         else:
             xmin = x
             ymin = y
@@ -741,8 +817,7 @@ class Tiler:
             ymax = min(ymin + self.th, pim.height())
             nfn = self.get_name(row, col)
 
-            if self.verbose:
-                print 'Subtile %s: (x %d:%d, y %d:%d)' % (nfn, xmin, xmax, ymin, ymax)
+            qlog.debug('Subtile %s: (x %d:%d, y %d:%d)', nfn, xmin, xmax, ymin, ymax)
             ip = pim.subimage(xmin, xmax, ymin, ymax)
             '''
             Images must be padded
@@ -907,6 +982,24 @@ class Tiler:
             already_done += 1
         print 'Map seeded with %d already done tiles' % already_done
     
+    def scratch_release(self, reservations, st_bounds):
+        res = reservations.pop(tuple(st_bounds), None)
+        if res:
+            self.scratch.release(res)
+
+    def init_scratch(self):
+        self.scratch = ScratchManager(self.scratch_tmpfs, budget=self.scratch_budget, tmpfs_budget=self.scratch_tmpfs_budget)
+        # Translated layers blended in memory never hit scratch
+        if self.blender != 'enblend' and self.remapper != 'nona' and translate_unsupported(self.pto) is None:
+            self.scratch_rects = None
+        else:
+            self.scratch_rects = image_rects(self.pto)
+
+    def scratch_estimate(self, st_bounds):
+        if self.scratch_rects is None:
+            return 0
+        return layer_bytes(self.scratch_rects, st_bounds)
+
     def wkill(self):
         print 'Shutting down workers'
         for worker in self.workers:
@@ -921,6 +1014,7 @@ class Tiler:
                 print '  W%d: stopped' % i
 
     def run(self):
+        qlog.set_level(qlog.DEBUG if self.verbose else qlog.INFO)
         print 'Input images width %d, height %d' % (self.img_width, self.img_height)
         print 'Output to %s' % self.out_dir
         print 'Super tile width %d, height %d from scalar %d' % (self.stw, self.sth, self.st_scalar_heuristic)
@@ -987,14 +1081,36 @@ class Tiler:
                 x_tiles, y_tiles, self.net_expected_tiles)
         if self.merge:
             self.seed_merge()
+        if not self.dry:
+            self.init_scratch()
+            telemetry.open_log(telemetry.log_fn(self.log_dir, 'm'), proc='m')
+
+        # Workers inherit the semaphore when they fork
+        self.blend_sem = None
+        if self.enblend_lock:
+            self.blend_sem = MemorySemaphore(0)
+        elif self.blend_memory is not None:
+            self.blend_sem = MemorySemaphore(self.blend_memory)
+        if self.blend_sem:
+            print 'M: blend memory %0.1f MB' % (self.blend_sem.total / 1e6,)
 
-        print 'M: Initializing %d workers' % self.threads
+        threads = self.threads
+        if self.dry and threads == 0:
+            # Rendering only remotely, but the dry run doesn't use the server
+            threads = 1
+        print 'M: Initializing %d workers' % threads
         self.workers = []
-        for ti in xrange(self.threads):
+        for ti in xrange(threads):
             print 'Bringing up W%02d' % ti
             w = Worker(ti, self, os.path.join(self.log_dir, 'w%02d.log' % ti))
             self.workers.append(w)
             w.start()
+        # Remote workers are fed through the server like one more local worker
+        if self.server and not self.dry:
+            print 'M: serving remote workers'
+            self.server.setup(self)
+            self.server.start()
+            self.workers.append(self.server)
 
         print
         print
@@ -1013,6 +1129,10 @@ class Tiler:
             pair_submit = 0
             pair_complete = 0
             idle = False
+            # Supertile checked but waiting on scratch space
+            pending_st = None
+            # tuple(st_bounds) => scratch Reservation
+            reservations = {}
             while not (all_allocated and pair_complete == pair_submit):
                 progress = False
                 # Check for completed jobs
@@ -1027,16 +1147,18 @@ class Tiler:
     
                     if what == 'done':
                         (st_bounds, img_fn) = out[1]
-                        print 'MW%d: done w/ submit %d, complete %d' % (wi, pair_submit, pair_complete)
-                        # Dry run
-                        if img_fn is None:
-                            pim = None
-                        else:
-                            pim = PImage.from_file(img_fn)
-                        # hack
-                        # ugh remove may be an already existing supertile (not a temp file)
-                        #os.remove(img_fn)
-                        self.process_image(pim, st_bounds)
+                        self.scratch_release(reservations, st_bounds)
+                        qlog.info('MW%d: done w/ submit %d, complete %d', wi, pair_submit, pair_complete)
+                        with telemetry.span('tiles', st='%06dx_%06dy' % (st_bounds[0], st_bounds[2])):
+                            # Dry run
+                            if img_fn is None:
+                                pim = None
+                            else:
+                                pim = PImage.from_file(img_fn)
+                            # hack
+                            # ugh remove may be an already existing supertile (not a temp file)
+                            #os.remove(img_fn)
+                            self.process_image(pim, st_bounds)
                     elif what == 'exception':
                         if not self.ignore_errors:
                             for worker in self.workers:
@@ -1048,7 +1170,8 @@ class Tiler:
                         #(_task, e) = out[1]
                         print '!' * 80
                         print 'M: ERROR: MW%d failed w/ exception' % wi
-                        (_task, _e, estr) = out[1]
+                        (task, _e, estr) = out[1]
+                        self.scratch_release(reservations, task[0])
                         print 'M: Stack trace:'
                         for l in estr.split('\n'):
                             print l
@@ -1069,30 +1192,47 @@ class Tiler:
                 for wi, worker in enumerate(self.workers):
                     if all_allocated:
                         break
-                    if worker.qi.empty():
+                    if worker.want_task():
                         while True:
-                            try:
-                                st_bounds = st_gen.next()
-                            except StopIteration:
-                                print 'M: all tasks allocated'
-                                all_allocated = True
-                                break
-            
-                            progress = True
+                            if pending_st is None:
+                                try:
+                                    st_bounds = st_gen.next()
+                                except StopIteration:
+                                    print 'M: all tasks allocated'
+                                    all_allocated = True
+                                    break
+                
+                                progress = True
 
+                                [x0, x1, y0, y1] = st_bounds
+                                self.n_supertiles += 1
+                                qlog.debug('M: checking supertile x(%d:%d) y(%d:%d)', x0, x1, y0, y1)
+                                if not self.should_try_supertile(st_bounds):
+                                    qlog.warning('M: skipping supertile %d as it would not generate any new tiles', self.n_supertiles)
+                                    continue
+                                pending_st = st_bounds
+                            st_bounds = pending_st
                             [x0, x1, y0, y1] = st_bounds
-                            self.n_supertiles += 1
-                            print 'M: checking supertile x(%d:%d) y(%d:%d)' % (x0, x1, y0, y1)
-                            if not self.should_try_supertile(st_bounds):
-                                print 'M WARNING: skipping supertile %d as it would not generate any new tiles' % self.n_supertiles
-                                continue
+
+                            scratch_dir = None
+                            if self.scratch and not worker.remote:
+                                nbytes = self.scratch_estimate(st_bounds)
+                                res = self.scratch.reserve(nbytes)
+                                if res is None:
+                                    if not idle:
+                                        print 'M: waiting for scratch space (%0.1f MB estimate)' % (nbytes / 1e6,)
+                                    break
+                                print 'M: scratch %s' % (res,)
+                                reservations[tuple(st_bounds)] = res
+                                scratch_dir = res.dir
+                            pending_st = None
+                            progress = True
                 
-                            print '*' * 80
+                            qlog.debug('*' * 80)
                             #print 'W%d: submit %s (%d / %d)' % (wi, repr(pair), pair_submit, n_pairs)
-                            print "Creating supertile %d / %d with x%d:%d, y%d:%d" % (self.n_supertiles, self.n_expected_sts, x0, x1, y0, y1)
-                            print 'W%d: submit' % (wi,)
+                            qlog.info("W%d: creating supertile %d / %d with x%d:%d, y%d:%d", wi, self.n_supertiles, self.n_expected_sts, x0, x1, y0, y1)
                 
-                            worker.qi.put((st_bounds,))
+                            worker.qi.put((st_bounds, scratch_dir))
                             pair_submit += 1
                             break
     
@@ -0,0 +1,205 @@
+'''
+pr0ntools
+Copyright 2012 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+
+Per stage timing and resource telemetry
+Each process writes JSON lines to its own file, one per finished span:
+    {"stage": "blend", "proc": "w01", "st": "021365x_005217y", "t": start unix time,
+     "wall": sec, "cpu": sec, "maxrss": bytes, "read": bytes, "write": bytes, "ok": true}
+CPU and I/O include waited for children (nona, enblend, etc)
+They are per process: a span also counts whatever other threads of the process did meanwhile
+maxrss is the largest of this process and its children so far, not just during the span
+Nested spans inherit their parent's ids (ex: supertile) and are counted in the parent as well
+Nesting is tracked per thread
+Callers can add fields to a span's record, ex: execute.Result.fields() of the program it ran
+Those exe_* numbers come from wait4() and cover only that program, maxrss included
+
+    telemetry.open_log('pr0nts/w01.telemetry.jsonl', proc='w01')
+    with telemetry.span('supertile', st='%06dx_%06dy' % (x0, y0)):
+        ...
+    with telemetry.span('remap', remapper='nona') as rec:
+        rec.update(execute.run(args).fields())
+'''
+
+import contextlib
+import glob
+import json
+import os
+import resource
+import threading
+import time
+
+# Telemetry file name within a log dir, see log_fn()
+SUFFIX = '.telemetry.jsonl'
+
+_f = None
+# Process that opened _f, forked children (ex: Pool) don't write to it
+_pid = None
+# Ids added to every record (ex: proc)
+_context = {}
+# Ids of enclosing spans, see _stack()
+_local = threading.local()
+# Threads share _f
+_lock = threading.Lock()
+
+def _stack():
+    '''Ids of the calling thread's enclosing spans'''
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+def log_fn(log_dir, name):
+    return os.path.join(log_dir, name + SUFFIX)
+
+def open_log(fn, **context):
+    '''Start writing this process's spans to fn'''
+    global _f
+    global _pid
+    global _context
+    close_log()
+    # Line buffered so a killed run still has what finished
+    _f = open(fn, 'a', 1)
+    _pid = os.getpid()
+    _context = dict(context)
+    _context.setdefault('proc', 'p%d' % os.getpid())
+    _local.stack = []
+
+def close_log():
+    global _f
+    if _f:
+        _f.close()
+    _f = None
+
+def enabled():
+    return _f is not None and _pid == os.getpid()
+
+def _usage():
+    '''Return (cpu sec, maxrss bytes, read bytes, write bytes) for this process and its children'''
+    s = resource.getrusage(resource.RUSAGE_SELF)
+    c = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (s.ru_utime + s.ru_stime + c.ru_utime + c.ru_stime,
+            # Linux reports KB
+            max(s.ru_maxrss, c.ru_maxrss) * 1024,
+            # 512 byte blocks
+            (s.ru_inblock + c.ru_inblock) * 512,
+            (s.ru_oublock + c.ru_oublock) * 512)
+
+def emit(rec):
+    if not enabled():
+        return
+    r = dict(_context)
+    r.update(rec)
+    l = json.dumps(r, sort_keys=True) + '\n'
+    with _lock:
+        _f.write(l)
+
+@contextlib.contextmanager
+def span(stage, **ids):
+    '''
+    Time the enclosed block as stage, ids (supertile, pair, etc) are recorded with it
+    Yields a dict of extra fields for the record, not inherited by nested spans
+    '''
+    extra = {}
+    if not enabled():
+        yield extra
+        return
+    stack = _stack()
+    ids = dict(stack[-1] if stack else {}, **ids)
+    stack.append(ids)
+    start = time.time()
+    cpu0, _rss0, read0, write0 = _usage()
+    ok = False
+    try:
+        yield extra
+        ok = True
+    finally:
+        stack.pop()
+        cpu1, rss1, read1, write1 = _usage()
+        rec = dict(ids)
+        rec.update(extra)
+        rec.update({
+            'stage': stage,
+            't': start,
+            'wall': time.time() - start,
+            'cpu': cpu1 - cpu0,
+            'maxrss': rss1,
+            'read': read1 - read0,
+            'write': write1 - write0,
+            'ok': ok,
+            })
+        emit(rec)
+
+def load(fns):
+    '''Return records from telemetry files and / or log dirs'''
+    ret = []
+    for fn in fns:
+        if os.path.isdir(fn):
+            load_fns = sorted(glob.glob(os.path.join(fn, '*' + SUFFIX)))
+        else:
+            load_fns = [fn]
+        for load_fn in load_fns:
+            for l in open(load_fn):
+                l = l.strip()
+                if not l:
+                    continue
+                try:
+                    ret.append(json.loads(l))
+                except ValueError:
+                    # Truncated last line from a killed process
+                    print 'WARNING: %s: bad line' % load_fn
+    return ret
+
+class Summary:
+    def __init__(self):
+        self.n = 0
+        self.failed = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.maxrss = 0
+        self.read = 0
+        self.write = 0
+
+    def add(self, r):
+        self.n += 1
+        if not r.get('ok', True):
+            self.failed += 1
+        self.wall += r['wall']
+        self.cpu += r['cpu']
+        self.maxrss = max(self.maxrss, r['maxrss'])
+        self.read += r['read']
+        self.write += r['write']
+
+def summarize(recs, key=lambda r: r['stage']):
+    '''Return {key: Summary}'''
+    ret = {}
+    for r in recs:
+        ret.setdefault(key(r), Summary()).add(r)
+    return ret
+
+def format_summary(summaries, title):
+    ret = ['%-24s %6s %5s %12s %10s %12s %6s %9s %9s %9s' % (
+            title, 'n', 'fail', 'wall sec', 'avg sec', 'cpu sec', 'cpu %', 'RSS MB', 'read MB', 'write MB')]
+    for k in sorted(summaries, key=lambda k: -summaries[k].wall):
+        s = summaries[k]
+        ret.append('%-24s %6d %5d %12.3f %10.3f %12.3f %6.0f %9.1f %9.1f %9.1f' % (
+                k, s.n, s.failed, s.wall, s.wall / s.n, s.cpu, 100.0 * s.cpu / max(s.wall, 1e-6),
+                s.maxrss / 1e6, s.read / 1e6, s.write / 1e6))
+    return '\n'.join(ret)
+
+def report(recs):
+    '''Where time goes per stage and per process'''
+    ret = []
+    if not recs:
+        return 'No telemetry'
+    t0 = min([r['t'] for r in recs])
+    t1 = max([r['t'] + r['wall'] for r in recs])
+    ret.append('%d spans over %0.1f sec' % (len(recs), t1 - t0))
+    ret.append('')
+    ret.append(format_summary(summarize(recs), 'stage'))
+    for proc in sorted(set([r.get('proc') for r in recs])):
+        ret.append('')
+        ret.append(format_summary(summarize([r for r in recs if r.get('proc') == proc]), 'proc %s' % proc))
+    return '\n'.join(ret)
@@ -2,15 +2,35 @@
 pr0ntools
 Copyright 2011 John McMaster <JohnDMcMaster@gmail.com>
 Licensed under a 2 clause BSD license, see COPYING for details
+
+Temp files are deleted when their ManagedTempFile is garbage collected
+Inside a TempScope they are instead deleted together when the scope closes:
+
+    with TempScope(tmpfs=True):
+        sub = ManagedTempFile.get(None, '.jpg')
+        ...
 '''
 
-import random
+import atexit
+import binascii
+import errno
+import itertools
 import os
 import shutil
 from pr0ntools.config import config
 
 g_default_prefix_dir = None
 g_default_prefix = None
+# Process that made g_default_prefix_dir, see cleanup()
+g_default_prefix_pid = None
+
+# Unique names: random per process base + counter, see TempFile.unique_str()
+g_name_pid = None
+g_name_base = None
+g_name_count = None
+
+# Open TempScope's, innermost last
+g_scopes = []
 
 
 PREFIX_BASE = config.temp_base()
@@ -23,74 +43,130 @@ class TempFile:
     def default_prefix():
         global g_default_prefix_dir
         global g_default_prefix
+        global g_default_prefix_pid
         
         if g_default_prefix is None:
             g_default_prefix_dir = ManagedTempDir.get(TempFile.get(PREFIX_BASE))
+            g_default_prefix_pid = os.getpid()
             g_default_prefix = os.path.join(g_default_prefix_dir.file_name, '')
             print 'TEMP DIR: %s' % g_default_prefix
         return g_default_prefix
 
+    @staticmethod
+    def current_prefix():
+        '''Prefix new temp files go under: the innermost TempScope's or the default'''
+        if g_scopes and g_scopes[-1].prefix:
+            return g_scopes[-1].prefix
+        return TempFile.default_prefix()
+
     @staticmethod
     def rand_str(length):
-        ret = ''
-        for i in range(0, length):
-            ret += "%X" % random.randint(0, 15)
-        return ret
+        return binascii.hexlify(os.urandom((length + 1) / 2)).upper()[0:length]
+
+    @staticmethod
+    def unique_str():
+        '''
+        16 hex chars not repeated by this process
+        Random per process base so forked workers and earlier runs don't collide
+        '''
+        global g_name_pid
+        global g_name_base
+        global g_name_count
+
+        pid = os.getpid()
+        if g_name_pid != pid:
+            g_name_pid = pid
+            g_name_base = TempFile.rand_str(8)
+            g_name_count = itertools.count()
+        return '%s%08X' % (g_name_base, g_name_count.next())
 
     @staticmethod
     def get(prefix = None, suffix = None):
         if not prefix:
-            prefix = TempFile.default_prefix()
+            prefix = TempFile.current_prefix()
         if not suffix:
             suffix = ""
-        # Good enough for now
-        return prefix + TempFile.rand_str(16) + suffix
+        return prefix + TempFile.unique_str() + suffix
+
+def remove(fn):
+    '''Delete fn (file or dir tree), returning False if it didn't exist'''
+    try:
+        if os.path.isdir(fn):
+            shutil.rmtree(fn)
+        else:
+            os.remove(fn)
+        return True
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
 
 class ManagedTempFile:
-    def __init__(self, file_name):
+    def __init__(self, file_name, scoped=True):
         if file_name:
             self.file_name = file_name
         else:
             self.file_name = TempFile.get()
+        # False once detached or deleted by a TempScope
+        self.managed = True
+        if scoped and g_scopes:
+            g_scopes[-1].add(self)
     
     def __repr__(self):
         return self.file_name
     
     @staticmethod
-    def get(prefix=None, suffix=None, prefix_mangle=None):
+    def get(prefix=None, suffix=None, prefix_mangle=None, scoped=True):
+        '''
+        scoped: belongs to the innermost TempScope (if any)
+        Otherwise it is placed in the default dir and lives until garbage collected
+        '''
         if prefix_mangle:
             if prefix is not None:
                 raise Exception("Can't specify prefix and prefix_mangle")
-            # seed default prefix if not created
-            TempFile.default_prefix()
-            prefix = g_default_prefix + prefix_mangle
-        return ManagedTempFile(TempFile.get(prefix, suffix))
+            if scoped:
+                prefix = TempFile.current_prefix() + prefix_mangle
+            else:
+                prefix = TempFile.default_prefix() + prefix_mangle
+        elif prefix is None and not scoped:
+            prefix = TempFile.default_prefix()
+        return ManagedTempFile(TempFile.get(prefix, suffix), scoped=scoped)
 
     @staticmethod
     def from_existing(file_name):
-        return ManagedTempFile(file_name)
+        return ManagedTempFile(file_name, scoped=False)
 
     @staticmethod
-    def from_same_extension(reference_file_name, prefix = None):
-        return ManagedTempFile.get(prefix, '.' + reference_file_name.split(".")[-1])
+    def from_same_extension(reference_file_name, prefix = None, scoped=True):
+        return ManagedTempFile.get(prefix, '.' + reference_file_name.split(".")[-1], scoped=scoped)
+
+    def detach(self):
+        '''Stop managing the file (caller now owns it), returning its name'''
+        self.managed = False
+        return self.file_name
+
+    # Bound now so late garbage collection still works after module teardown
+    def delete(self, remove=remove, config=config):
+        if not self.managed:
+            return
+        self.managed = False
+        if config.keep_temp_files():
+            verbose('KEEP: Deleted temp file %s' % self.file_name)
+            return
+        # Ignore if it was never created
+        if remove(self.file_name):
+            verbose('Deleted temp file %s' % self.file_name)
 
     def __del__(self):
         try:
-            if os.path.exists(self.file_name):
-                if config.keep_temp_files():
-                    verbose('KEEP: Deleted temp file %s' % self.file_name)
-                else:
-                    os.remove(self.file_name)
-                    verbose('Deleted temp file %s' % self.file_name)
-            else:
-                verbose("Didn't delete inexistant temp file %s" % self.file_name)
-        # Ignore if it was never created
+            self.delete()
         except:
             print 'WARNING: failed to delete temp file: %s' % self.file_name
 
 class ManagedTempDir(ManagedTempFile):
     def __init__(self, temp_dir):
-        ManagedTempFile.__init__(self, temp_dir)
+        # Dirs outlive scopes, they are usually already tied to a stage
+        ManagedTempFile.__init__(self, temp_dir, scoped=False)
 
     @staticmethod
     def get(temp_dir = None):
@@ -114,16 +190,84 @@ class ManagedTempDir(ManagedTempFile):
         # Make it in this dir
         return TempFile.get(os.path.join(self.file_name, prefix), suffix)
 
-    def __del__(self):
+    def __del__(self, remove=remove, config=config):
+        if not self.managed:
+            return
+        self.managed = False
         try:
-            if os.path.exists(self.file_name):
-                if config.keep_temp_files():            
-                    print 'KEEP: Deleted temp dir %s' % self.file_name
-                else:
-                    shutil.rmtree(self.file_name)
-                    print 'Deleted temp dir %s' % self.file_name
+            if config.keep_temp_files():
+                print 'KEEP: Deleted temp dir %s' % self.file_name
+            elif remove(self.file_name):
+                print 'Deleted temp dir %s' % self.file_name
             else:
                 print "Didn't delete inexistant temp dir %s" % self.file_name
-        # Ignore if it was never created
         except:
             print 'WARNING: failed to delete temp dir: %s' % self.file_name
+
+class TempScope(object):
+    '''
+    Temp files made while the scope is open are deleted together when it closes
+    instead of one by one whenever they get garbage collected
+    Files that have to outlive it: ManagedTempFile.get(..., scoped=False) or detach()
+    Scopes are per process and shared by its threads
+    '''
+    def __init__(self, tmpfs=False, prefix=None):
+        '''
+        tmpfs: place files in the RAM backed dir (config scratch.tmpfs) if it exists
+        prefix: place files here (ex: '/mnt/fast/pr0ntools_'), default: enclosing scope / temp_base
+        '''
+        if prefix is None and tmpfs:
+            prefix = TempScope.tmpfs_prefix()
+        if prefix is None and g_scopes:
+            prefix = g_scopes[-1].prefix
+        self.prefix = prefix
+        self.files = []
+
+    @staticmethod
+    def tmpfs_prefix():
+        d = config.scratch_tmpfs()
+        if not d or not os.path.isdir(d):
+            return None
+        return os.path.join(d, 'pr0ntools_')
+
+    def add(self, tmp):
+        self.files.append(tmp)
+
+    def close(self):
+        '''Delete all files still managed by the scope'''
+        files = self.files
+        self.files = []
+        for tmp in files:
+            try:
+                tmp.delete()
+            except OSError as e:
+                print 'WARNING: failed to delete temp file %s: %s' % (tmp.file_name, e)
+
+    def __enter__(self):
+        g_scopes.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        g_scopes.remove(self)
+        self.close()
+        return False
+
+def cleanup():
+    '''
+    Delete the default temp dir while the module is still intact
+    Left to garbage collection it would go at interpreter exit after module teardown
+    Forked children leave it to the process that made it
+    '''
+    global g_default_prefix_dir
+    global g_default_prefix
+    d = g_default_prefix_dir
+    g_default_prefix_dir = None
+    g_default_prefix = None
+    if d is None:
+        return
+    if g_default_prefix_pid != os.getpid():
+        d.detach()
+        return
+    d.__del__()
+
+atexit.register(cleanup)
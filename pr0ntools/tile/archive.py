@@ -0,0 +1,241 @@
+'''
+pr0ntools
+Copyright 2012 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+
+Packed tile archive
+Holds a whole map pyramid in one file so generation and deployment
+don't pay per file filesystem overhead for hundreds of thousands of tiles
+
+Layout:
+    magic (8 bytes)
+    tile data, back to back
+    JSON index
+    footer: index offset (u64), index length (u64), magic (8 bytes)
+
+Index:
+    {"version": 1, "tiles": {"<level>/yNNN_xNNN.jpg": [offset, length], ...}, ...}
+Names are the same relative paths the tiles would have under tiles_out
+Identical tiles (ex: blank background) share one copy of their data
+'''
+
+import BaseHTTPServer
+import hashlib
+import json
+import mimetypes
+import os
+import struct
+import urllib
+
+MAGIC = 'PR0NTAR1'
+FOOTER = struct.Struct('<QQ8s')
+
+def tile_name(level, row, col, im_ext='.jpg'):
+    return '%d/y%03d_x%03d%s' % (level, row, col, im_ext)
+
+class ArchiveWriter(object):
+    '''Writes tiles sequentially, the index is written by close()'''
+    def __init__(self, fn, meta=None):
+        self.fn = fn
+        self.f = open(fn, 'wb')
+        self.f.write(MAGIC)
+        self.pos = len(MAGIC)
+        # name => (offset, length)
+        self.tiles = {}
+        # sha1 => (offset, length)
+        self.hashes = {}
+        # Extra index entries (tile size, etc)
+        self.meta = meta or {}
+
+    def add(self, name, data, digest=None):
+        '''Add tile data under name, returning (offset, length)'''
+        if digest is None:
+            digest = hashlib.sha1(data).hexdigest()
+        ent = self.hashes.get(digest)
+        if ent is None:
+            self.f.write(data)
+            ent = (self.pos, len(data))
+            self.pos += len(data)
+            self.hashes[digest] = ent
+        self.tiles[name] = ent
+        return ent
+
+    def add_file(self, name, fn):
+        return self.add(name, open(fn, 'rb').read())
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        if self.f is None:
+            return
+        index = dict(self.meta)
+        index['version'] = 1
+        index['tiles'] = self.tiles
+        j = json.dumps(index)
+        self.f.write(j)
+        self.f.write(FOOTER.pack(self.pos, len(j), MAGIC))
+        self.f.close()
+        self.f = None
+
+class ArchiveReader(object):
+    def __init__(self, fn):
+        self.fn = fn
+        self.f = open(fn, 'rb')
+        if self.f.read(len(MAGIC)) != MAGIC:
+            raise Exception('%s: not a tile archive' % fn)
+        self.f.seek(-FOOTER.size, os.SEEK_END)
+        offset, length, magic = FOOTER.unpack(self.f.read(FOOTER.size))
+        if magic != MAGIC:
+            raise Exception('%s: truncated tile archive' % fn)
+        self.f.seek(offset)
+        self.index = json.loads(self.f.read(length))
+        if self.index.get('version') != 1:
+            raise Exception('%s: unsupported archive version %s' % (fn, self.index.get('version')))
+        self.tiles = self.index['tiles']
+
+    def names(self):
+        return sorted(self.tiles.keys())
+
+    def __contains__(self, name):
+        return name in self.tiles
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def get(self, name):
+        '''Return tile data or None if not present'''
+        ent = self.tiles.get(name)
+        if ent is None:
+            return None
+        offset, length = ent
+        self.f.seek(offset)
+        return self.f.read(length)
+
+    def get_tile(self, level, row, col, im_ext='.jpg'):
+        return self.get(tile_name(level, row, col, im_ext))
+
+    def extract(self, dst_dir):
+        '''Unpack to the usual tiles_out/<level>/ layout'''
+        for name in self.names():
+            fn = os.path.join(dst_dir, name)
+            d = os.path.dirname(fn)
+            if not os.path.exists(d):
+                os.makedirs(d)
+            open(fn, 'wb').write(self.get(name))
+
+    def close(self):
+        self.f.close()
+
+def merge_shards(shards, fn, meta=None):
+    '''
+    Merge shard archive data into one archive
+    shards: list of (shard file name, {name: (offset, length, sha1)})
+    Shard files are raw tile data without header or index
+    '''
+    w = ArchiveWriter(fn, meta)
+    for shard_fn, entries in shards:
+        f = open(shard_fn, 'rb')
+        # Sequential read order
+        for name, (offset, length, digest) in sorted(entries.items(), key=lambda x: x[1][0]):
+            if digest in w.hashes:
+                w.tiles[name] = w.hashes[digest]
+                continue
+            f.seek(offset)
+            w.add(name, f.read(length), digest)
+        f.close()
+    w.close()
+    return w
+
+def pack_dir(src_dir, fn, meta=None):
+    '''Pack an existing tiles_out/<level>/ dir'''
+    w = ArchiveWriter(fn, meta)
+    for level in sorted(os.listdir(src_dir)):
+        level_dir = os.path.join(src_dir, level)
+        if not level.isdigit() or not os.path.isdir(level_dir):
+            continue
+        for f in sorted(os.listdir(level_dir)):
+            w.add_file('%s/%s' % (level, f), os.path.join(level_dir, f))
+    w.close()
+    return w
+
+def serve(map_dir, archive_fn=None, port=8000):
+    '''
+    Serve a map dir over HTTP with tiles_out/ coming from the archive
+    archive_fn defaults to map_dir/tiles.pta
+    '''
+    if archive_fn is None:
+        archive_fn = os.path.join(map_dir, 'tiles.pta')
+    archive = ArchiveReader(archive_fn)
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = urllib.unquote(self.path.split('?')[0]).lstrip('/')
+            if path == '':
+                path = 'index.html'
+            data = None
+            if path.startswith('tiles_out/'):
+                data = archive.get(path[len('tiles_out/'):])
+            elif not '..' in path.split('/'):
+                fn = os.path.join(map_dir, path)
+                if os.path.isfile(fn):
+                    data = open(fn, 'rb').read()
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', mimetypes.guess_type(path)[0] or 'application/octet-stream')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    print 'Serving %s (%d tiles from %s) on port %d' % (map_dir, len(archive), archive_fn, port)
+    BaseHTTPServer.HTTPServer(('', port), Handler).serve_forever()
+
+class ShardWriter(object):
+    '''
+    Raw tile data written by one process, combined later by merge_shards()
+    Forked workers each open their own shard on first write
+    '''
+    def __init__(self, archive_fn):
+        self.archive_fn = archive_fn
+        self.pid = None
+        self.f = None
+        self.pos = 0
+        # sha1 => (offset, length)
+        self.hashes = {}
+        # name => (offset, length, sha1) since the last take()
+        self.entries = {}
+
+    def shard_fn(self):
+        return '%s.shard.%d' % (self.archive_fn, os.getpid())
+
+    def add(self, name, data):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.f = open(self.shard_fn(), 'wb')
+            self.pos = 0
+            self.hashes = {}
+            self.entries = {}
+        digest = hashlib.sha1(data).hexdigest()
+        ent = self.hashes.get(digest)
+        if ent is None:
+            self.f.write(data)
+            ent = (self.pos, len(data))
+            self.pos += len(data)
+            self.hashes[digest] = ent
+        self.entries[name] = (ent[0], ent[1], digest)
+
+    def take(self):
+        '''Flush and return (shard file name, entries) added since the last take() or None'''
+        if not self.entries or self.pid != os.getpid():
+            return None
+        self.f.flush()
+        ret = (self.shard_fn(), self.entries)
+        self.entries = {}
+        return ret
+
+    def close(self):
+        if self.f and self.pid == os.getpid():
+            self.f.close()
+        self.f = None
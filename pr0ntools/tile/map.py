@@ -27,7 +27,7 @@ class MapSource:
 	def calc_max_level(self):
 		return calc_max_level(self.height(), self.width())
 				
-	def generate_tiles(self, max_level, min_level, dst_basedir):
+	def generate_tiles(self, max_level, min_level, dst_basedir, incremental=False, blank_tol=0, archive_fn=None):
 		pass
 		
 # Input to map generator algorithm is a large input image
@@ -49,7 +49,7 @@ class ImageMapSource(MapSource):
 	def height(self):
 		return self.pim.height()
 	
-	def generate_tiles(self, max_level, min_level, dst_basedir):
+	def generate_tiles(self, max_level, min_level, dst_basedir, incremental=False, blank_tol=0, archive_fn=None):
 		# Generate tiles
 		print 'From single image in %s to dir %s' % (self.image_in, dst_basedir)
 		rows = int(math.ceil(1.0 * self.pim.height() / self.th))
@@ -61,6 +61,9 @@ class ImageMapSource(MapSource):
 			max_level, min_level,
 			dst_basedir=dst_basedir, threads=self.threads,
 			pim=self.pim, im_ext=self.im_ext)
+		gen.incremental = incremental
+		gen.blank_tol = blank_tol
+		gen.archive_fn = archive_fn
 		
 		gen.run()
 	
@@ -71,12 +74,10 @@ class TileMapSource(MapSource):
 		self.th = 250
 		self.threads = threads
 		
-		self.file_names = set()
-		for f in os.listdir(dir_in):
-			self.file_names.add(dir_in + "/" + f)
 		self.src_dir = dir_in
 		
-		self.map = ImageCoordinateMap.from_tagged_file_names(self.file_names)
+		self.map = ImageCoordinateMap.from_dir_tagged_file_names(dir_in)
+		self.file_names = set([fn for (fn, _row, _col) in self.map.images()])
 		
 		self.x_tiles = self.map.width()
 		self.y_tiles = self.map.height()
@@ -98,7 +99,7 @@ class TileMapSource(MapSource):
 	def height(self):
 		return self.th * self.y_tiles
 	
-	def generate_tiles(self, max_level, min_level, dst_basedir):
+	def generate_tiles(self, max_level, min_level, dst_basedir, incremental=False, blank_tol=0, archive_fn=None):
 		print 'From multi tiles'
 		gen = Tiler(
 			self.map.height(), self.map.width(),
@@ -106,6 +107,9 @@ class TileMapSource(MapSource):
 			max_level, min_level,
 			dst_basedir=dst_basedir, threads=self.threads,
 			pim=None, im_ext=self.im_ext)
+		gen.incremental = incremental
+		gen.blank_tol = blank_tol
+		gen.archive_fn = archive_fn
 		gen.run()
 	
 class Map:
@@ -122,6 +126,12 @@ class Map:
 		self.image = None
 		# don't error on missing tiles in grid
 		self.skip_missing = False
+		# Keep old output and only regenerate tiles whose source changed
+		self.incremental = False
+		# Store uniform tiles once, None to disable
+		self.blank_tol = 0
+		# Pack tiles into out_dir/tiles.pta instead of out_dir/tiles_out/
+		self.archive = False
 		self.set_im_ext('.jpg')
 		self.tw = 250
 		self.th = 250
@@ -355,7 +365,7 @@ siMap.setOptions({
 			self.page_title = 'SiMap: %s' % self.source.get_name()
 	
 		# If it looks like there is old output and we are trying to re-generate js don't nuke it
-		if os.path.exists(self.out_dir) and not self.js_only:
+		if os.path.exists(self.out_dir) and not self.js_only and not self.incremental:
 			os.system('rm -rf %s' % self.out_dir)
 		if not os.path.exists(self.out_dir):
 			os.mkdir(self.out_dir)
@@ -369,6 +379,11 @@ siMap.setOptions({
 		
 		self.image = None
 
+	def archive_fn(self):
+		if not self.archive:
+			return None
+		return '%s/tiles.pta' % self.out_dir
+
 	def generate(self):
 		'''
 		It would be a good idea to check the tiles gnerated against what we are expecting
@@ -379,5 +394,5 @@ siMap.setOptions({
 			print
 			print
 			print
-			self.source.generate_tiles(self.max_level, self.min_level, dst_basedir='%s/tiles_out' % self.out_dir)
+			self.source.generate_tiles(self.max_level, self.min_level, dst_basedir='%s/tiles_out' % self.out_dir, incremental=self.incremental, blank_tol=self.blank_tol, archive_fn=self.archive_fn())
 
@@ -1,12 +1,44 @@
 from pr0ntools.stitch.image_coordinate_map import ImageCoordinateMap
-from pr0ntools.pimage import PImage
+from PIL import Image
+import distutils.spawn
+import itertools
+import multiprocessing
 import os
 import shutil
+import subprocess
 
 class Object():
 	pass
 
-def rotate_tiles(src_dir, dst_dir, degrees, force = False, rc = False):
+# Clockwise degrees => PIL transpose (PIL angles are CCW)
+TRANSPOSES = {
+	90: Image.ROTATE_270,
+	180: Image.ROTATE_180,
+	270: Image.ROTATE_90,
+}
+
+def rotate_tile(args):
+	'''
+	Rotate one tile clockwise, returning True if done losslessly
+	jpegtran -perfect refuses tiles that aren't a whole number of MCUs
+	so those (and non-JPEG tiles) are decoded and rotated by PIL
+	'''
+	src, dst, degrees, jpegtran, quality = args
+	if jpegtran and os.path.splitext(src)[1].lower() in ('.jpg', '.jpeg'):
+		devnull = open(os.devnull, 'w')
+		try:
+			if subprocess.call([jpegtran, '-copy', 'all', '-perfect', '-rotate', str(degrees), '-outfile', dst, src], stdout=devnull, stderr=devnull) == 0:
+				return True
+		finally:
+			devnull.close()
+	im = Image.open(src)
+	if im.format == 'JPEG':
+		im.transpose(TRANSPOSES[degrees]).save(dst, quality=quality)
+	else:
+		im.transpose(TRANSPOSES[degrees]).save(dst)
+	return False
+
+def rotate_tiles(src_dir, dst_dir, degrees, force = False, rc = False, threads = None, quality = 95):
 	self = Object()
 
 	if src_dir[-1] == '/':
@@ -36,6 +68,7 @@ def rotate_tiles(src_dir, dst_dir, degrees, force = False, rc = False):
 	icm = ImageCoordinateMap.from_dir_tagged_file_names(src_dir)
 	
 	# Verify uniform size
+	# Image.open() only reads the header
 	print "Verifying tile size...."
 	self.tw = None
 	self.th = None
@@ -43,20 +76,22 @@ def rotate_tiles(src_dir, dst_dir, degrees, force = False, rc = False):
 	n = 0
 	for (src, row, col) in icm.images():
 		n += 1
-		pi = PImage.from_file(src)
+		w, h = Image.open(src).size
 		# I could actually set with / height here but right now this is
 		# coming up fomr me accidentially using 256 x 256 tiles when the 
 		# standard is 250 x 250
 		if self.tw is None:
-			self.tw = pi.width()
+			self.tw = w
 		if self.th is None:
-			self.th = pi.height()
-		if pi.width() != self.tw or pi.height() != self.th:
+			self.th = h
+		if w != self.tw or h != self.th:
 			raise Exception('Source image incorrect size')
 		
-	this_n = 0
+	jpegtran = distutils.spawn.find_executable('jpegtran')
+	if not jpegtran:
+		print 'WARNING: jpegtran not found, JPEG tiles will be recompressed'
+	tasks = []
 	for (src, src_row, src_col) in icm.images():
-		this_n += 1
 		extension = '.jpg'
 		extension = '.' + src.split('.')[-1]
 		
@@ -79,12 +114,27 @@ def rotate_tiles(src_dir, dst_dir, degrees, force = False, rc = False):
 			dst = os.path.join(dst_dir, 'c%04d_r%04d%s' % (dst_col, dst_row, extension))
 		else:
 			dst = os.path.join(dst_dir, 'y%03d_x%03d%s' % (dst_row, dst_col, extension))
-		pi = PImage.from_file(src)
-		# rotates CCW...w/e
-		pip = pi.rotate(-degrees)
-		print '%d / %d: %s => %s' % (this_n, n, src, dst)
-		pip.save(dst)
-	
+		tasks.append((src, dst, degrees, jpegtran, quality))
+
+	if threads is None:
+		threads = multiprocessing.cpu_count()
+	pool = None
+	if threads > 1:
+		pool = multiprocessing.Pool(threads)
+		results = pool.imap(rotate_tile, tasks, chunksize=16)
+	else:
+		results = itertools.imap(rotate_tile, tasks)
+	lossless = 0
+	try:
+		for this_n, ((src, dst, _degrees, _jpegtran, _quality), res) in enumerate(itertools.izip(tasks, results), 1):
+			if res:
+				lossless += 1
+			print '%d / %d: %s => %s' % (this_n, n, src, dst)
+	finally:
+		if pool:
+			pool.close()
+			pool.join()
+	print 'Rotated %d tiles, %d lossless' % (n, lossless)
 
 #def rotate_map(dir):
 
@@ -6,7 +6,9 @@ Licensed under a 2 clause BSD license, see COPYING for details
 '''
 
 from pr0ntools import pimage
+from pr0ntools.tile import archive
 from pr0ntools.pimage import PImage
+from pr0ntools.stitch.image_coordinate_map import get_row_col
 
 import sys 
 import os.path
@@ -17,6 +19,10 @@ import Queue
 import multiprocessing
 import traceback
 import time
+import itertools
+import json
+import io
+import tempfile
 
 # needed for PNG support
 # rarely used and PIL seems to have bugs
@@ -48,19 +54,105 @@ def calc_max_level(height, width, zoom_factor=None):
     print 'Calc max zoom level for %d X %d screen: %d (wmax: %d lev / %d pix, hmax: %d lev / %d pix)' % (fit_width, fit_height, max_level, width_levels, width, height_levels, height)
     return max_level
 
+'''
+Uniform (blank) tiles are encoded once and hard linked everywhere else
+Die images have large background areas so this saves encoding time and disk
+'''
+class BlankStore(object):
+    def __init__(self, basedir, im_ext='.jpg', tol=0, quality=None):
+        # Hidden so it isn't mistaken for a level by anything listing tiles_out
+        self.dir = os.path.join(basedir, '.blank')
+        self.im_ext = im_ext
+        # Max per band variation still considered blank
+        self.tol = tol
+        self.quality = quality
+        # Shared files known to exist
+        self.made = set()
+        self.stored = 0
+
+    def color(self, im):
+        return pimage.uniform_color(im, self.tol)
+
+    def get_fn(self, color, size):
+        if isinstance(color, tuple):
+            color_str = '_'.join(['%d' % c for c in color])
+        else:
+            color_str = '%d' % color
+        return '%s/%s_%dx%d%s' % (self.dir, color_str, size[0], size[1], self.im_ext)
+
+    def link(self, color, mode, size, dst_fn):
+        '''Make dst_fn a tile of a single color'''
+        src_fn = self.get_fn(color, size)
+        if src_fn not in self.made:
+            if not os.path.exists(src_fn):
+                try:
+                    os.mkdir(self.dir)
+                except OSError:
+                    # Another worker got there first
+                    pass
+                # Workers may race on the same color
+                tmp_fn = '%s.%d.tmp%s' % (src_fn, os.getpid(), self.im_ext)
+                im = Image.new(mode, size, color)
+                if self.quality and self.im_ext == '.jpg':
+                    im.save(tmp_fn, quality=self.quality)
+                else:
+                    im.save(tmp_fn)
+                os.rename(tmp_fn, src_fn)
+            self.made.add(src_fn)
+        # Never write through an existing link
+        if os.path.exists(dst_fn):
+            os.unlink(dst_fn)
+        try:
+            os.link(src_fn, dst_fn)
+        except OSError:
+            shutil.copyfile(src_fn, dst_fn)
+        self.stored += 1
+
+    def store(self, im, dst_fn):
+        '''Link dst_fn to a shared tile if im is blank, returning True if it was'''
+        color = self.color(im)
+        if color is None:
+            return False
+        self.link(color, im.mode, im.size, dst_fn)
+        return True
+
+# Set in the parent before forking band workers
+_image_tiler = None
+
+def _image_tiler_band(row):
+    _image_tiler.make_band(row)
+    return row
+
 '''
 Take a single large image and break it into tiles
 '''
 class ImageTiler(object):
-    def __init__(self, pim, dst_dir, tw=250, th=250, im_ext='.jpg'):
+    def __init__(self, pim, dst_dir, tw=250, th=250, im_ext='.jpg', threads=1, src_fn=None, blanks=None, quality=None):
+        '''
+        pim: source PImage, or None to read bands from src_fn as needed
+        threads: tile this many horizontal bands at once
+        blanks: BlankStore to dedupe uniform tiles or None
+        quality: JPEG quality or None for PIL default
+        '''
         self.verbose = False
         self.pim = pim
+        self.blanks = blanks
+        self.quality = quality
+        self.src_fn = src_fn
+        if self.src_fn is None and pim is not None:
+            self.src_fn = getattr(pim.image, 'filename', None)
+        self.threads = threads
         self.progress_inc = 0.10
         
+        if pim is not None:
+            width, height = pim.width(), pim.height()
+        else:
+            # Only reads the header
+            width, height = Image.open(src_fn).size
         self.x0 = 0
-        self.x1 = pim.width()
+        self.x1 = width
         self.y0 = 0
-        self.y1 = pim.height()
+        self.y1 = height
         
         self.tw = tw
         self.th = th
@@ -73,7 +165,10 @@ class ImageTiler(object):
     def get_name(self, row, col):
         return '%s/y%03d_x%03d%s' % (self.dst_dir, row, col, self.im_ext)
         
-    def make_tile(self, x, y, row, col):
+    def make_tile(self, x, y, row, col, src=None, src_y=0):
+        '''src: image to crop from (default: whole source image) whose first row is at src_y'''
+        if src is None:
+            src = self.pim.image
         xmin = x
         ymin = y
         xmax = min(xmin + self.tw, self.x1)
@@ -83,10 +178,10 @@ class ImageTiler(object):
         #if self.verbose:
         #print '%s: (x %d:%d, y %d:%d)' % (nfn, xmin, xmax, ymin, ymax)
         
-        im = self.pim.image.crop((xmin, ymin, xmax, ymax))
+        im = src.crop((xmin, ymin - src_y, xmax, ymax - src_y))
 
-        if PALETTES and self.pim.image.palette:
-            im.putpalette(self.pim.image.palette)
+        if PALETTES and src.palette:
+            im.putpalette(src.palette)
             # XXX: workaround for PIL bug
             im = pimage.im_reload(im)
         
@@ -95,8 +190,59 @@ class ImageTiler(object):
             #print 'resizing', x, y
             #print im.size, self.tw, self.th
             im = pimage.resize(im, self.tw, self.th)
-        im.save(nfn)
-        
+        if self.blanks and self.blanks.store(im, nfn):
+            return
+        if self.quality and self.im_ext == '.jpg':
+            im.save(nfn, quality=self.quality)
+        else:
+            im.save(nfn)
+
+    def make_band(self, row):
+        '''Make all tiles in a tile row'''
+        y = self.y0 + row * self.th
+        if self.pim is None:
+            src = pimage.open_band(self.src_fn, y, y + self.th)
+            src_y = y
+        else:
+            src = self.pim.image
+            src_y = 0
+        for col, x in enumerate(xrange(self.x0, self.x1, self.tw)):
+            self.make_tile(x, y, row, col, src=src, src_y=src_y)
+
+    def run_bands(self):
+        '''Tile in parallel horizontal bands'''
+        global _image_tiler
+
+        if self.pim is None and not (self.src_fn and pimage.band_readable(self.src_fn)):
+            self.pim = PImage.from_file(self.src_fn)
+        if self.pim is not None:
+            # Decode once here so the workers share it instead of each decoding it
+            self.pim.image.load()
+        else:
+            print 'Reading source in bands from %s' % self.src_fn
+
+        rows = len(range(self.y0, self.y1, self.th))
+        next_progress = self.progress_inc
+        _image_tiler = self
+        pool = None
+        try:
+            if self.threads > 1:
+                pool = multiprocessing.Pool(self.threads)
+                results = pool.imap_unordered(_image_tiler_band, xrange(rows))
+            else:
+                results = itertools.imap(_image_tiler_band, xrange(rows))
+            for processed, _row in enumerate(results, 1):
+                if self.progress_inc:
+                    cur_progress = 1.0 * processed / rows
+                    if cur_progress >= next_progress:
+                        print 'Progress: %02.2f%% %d / %d rows' % (cur_progress * 100, processed, rows)
+                        next_progress += self.progress_inc
+        finally:
+            _image_tiler = None
+            if pool:
+                pool.close()
+                pool.join()
+
     def run(self):
         '''
         Namer is a function that accepts the following arguments and returns a string:
@@ -110,6 +256,10 @@ class ImageTiler(object):
             namer = google_namer
         '''
 
+        if self.threads > 1 or self.pim is None:
+            self.run_bands()
+            return
+
         col = 0
         next_progress = self.progress_inc
         processed = 0
@@ -132,13 +282,14 @@ Only support tiled workers since unclear if full image can/should be parallelize
 '''
 class TWorker(object):
     def __init__(self,
-            ti, qo, im_ext,
+            ti, qi, qo, im_ext,
             # tile width/height
             tw, th):
         self.process = multiprocessing.Process(target=self.run)
         self.ti = ti
         
-        self.qi = multiprocessing.Queue()
+        # Task queue shared by all workers
+        self.qi = qi
         self.qo = qo
         self.running = multiprocessing.Event()
         
@@ -147,40 +298,37 @@ class TWorker(object):
         self.th = th
         self.zoom = 2.0
     
-    def submit(self, event, args):
-        self.qi.put((event, args))
-
     def complete(self, event, args):
         self.qo.put((self.ti, event, args))
 
     def task_subtile(self, val):
-        dst_dir, dst_row, dst_cols, src_dir = val
-        src_rowb = 2 * dst_row
+        '''
+        Shrink a block of destination tiles
+        src_have: source tile file names that exist in the block, listed once by the master
+        '''
+        dst_dir, (dst_row0, dst_row1, dst_col0, dst_col1), src_dir, src_have = val
         
-        # Workers are given 1 output row (2 input rows) at a time
-        for dst_col in xrange(dst_cols):
-            src_colb = 2 * dst_col
-
-            # Collapse 2x2
-            # XXX: how much faster would it be to actually know?
-            # Would we save anything given that occasionally I process broken sets?
-            # Just guess based on fn existing since its most foolproof anyway
-            # adjust to be more accurate if we have a reason to care
-            src_img_fns = [
-                [None, None],
-                [None, None],
-                ]
-            for src_col in xrange(src_colb, src_colb + 2):
-                for src_row in xrange(src_rowb, src_rowb + 2):
-                    fn = get_fn(src_dir, src_row, src_col, im_ext=self.im_ext)
-                    src_img_fns[src_row - src_rowb][src_col - src_colb] = fn if os.path.exists(fn) else None
-            
-            img_full = pimage.from_fns(src_img_fns,
-                    tw=self.tw, th=self.th)
-            #img_full = pimage.im_reload(img_full)
-            img_scaled = pimage.rescale(img_full, 0.5, filt=Image.ANTIALIAS)
-            dst_fn = get_fn(dst_dir, dst_row, dst_col, im_ext=self.im_ext)
-            img_scaled.save(dst_fn)
+        for dst_row in xrange(dst_row0, dst_row1):
+            src_rowb = 2 * dst_row
+            for dst_col in xrange(dst_col0, dst_col1):
+                src_colb = 2 * dst_col
+
+                # Collapse 2x2
+                src_img_fns = [
+                    [None, None],
+                    [None, None],
+                    ]
+                for src_col in xrange(src_colb, src_colb + 2):
+                    for src_row in xrange(src_rowb, src_rowb + 2):
+                        fn = get_fn(src_dir, src_row, src_col, im_ext=self.im_ext)
+                        src_img_fns[src_row - src_rowb][src_col - src_colb] = fn if os.path.basename(fn) in src_have else None
+                
+                img_full = pimage.from_fns(src_img_fns,
+                        tw=self.tw, th=self.th)
+                #img_full = pimage.im_reload(img_full)
+                img_scaled = pimage.rescale(img_full, 0.5, filt=Image.ANTIALIAS)
+                dst_fn = get_fn(dst_dir, dst_row, dst_col, im_ext=self.im_ext)
+                img_scaled.save(dst_fn)
     
     def start(self):
         self.process.start()
@@ -198,7 +346,8 @@ class TWorker(object):
             
             def task_subtile(args):
                 self.task_subtile(args)
-                self.complete('done', args)
+                # Master doesn't need the listing back
+                self.complete('done', args[0:3])
             
             taskers = {
                 'subtile': task_subtile,
@@ -212,6 +361,368 @@ class TWorker(object):
                 estr = traceback.format_exc()
                 self.complete('exception', (task, e, estr))
 
+'''
+Split dst_rows x dst_cols tiles into about n_blocks rectangles
+Rows are kept whole when there are enough of them
+since a row of tiles reads two full source rows sequentially
+Block edges fall on even rows / cols so the 2x2 tiles under each next level tile
+are all in one block
+Returns a list of (row0, row1, col0, col1)
+'''
+def subtile_blocks(dst_rows, dst_cols, n_blocks):
+    n_blocks = max(1, n_blocks)
+    if dst_rows >= 2 * n_blocks:
+        row_step = dst_rows / n_blocks / 2 * 2
+        col_step = dst_cols
+    else:
+        # Wide and short: also split cols
+        row_step = 2
+        col_splits = int(math.ceil(1.0 * n_blocks / ((dst_rows + 1) / 2)))
+        col_step = int(math.ceil(1.0 * dst_cols / col_splits))
+        col_step = max(2, col_step + col_step % 2)
+    ret = []
+    for row0 in xrange(0, dst_rows, row_step):
+        for col0 in xrange(0, dst_cols, col_step):
+            ret.append((row0, min(row0 + row_step, dst_rows), col0, min(col0 + col_step, dst_cols)))
+    return ret
+
+'''
+Source tile names in src_dir needed by a dst block
+'''
+def subtile_have(have, src_dir, block, im_ext):
+    row0, row1, col0, col1 = block
+    ret = set()
+    for src_row in xrange(2 * row0, 2 * row1):
+        for src_col in xrange(2 * col0, 2 * col1):
+            fn = os.path.basename(get_fn(src_dir, src_row, src_col, im_ext=im_ext))
+            if fn in have:
+                ret.add(fn)
+    return ret
+
+# Set in the parent before forking pyramid workers
+_pyramid = None
+
+def _pyramid_subtree(args):
+    level, row, col = args
+    im = _pyramid.node(level, row, col)
+    if im is None:
+        return (None, _pyramid.shards and _pyramid.shards.take())
+    # Parent finishes the upper levels from the lossless result
+    # and collects where the worker archived its tiles
+    return ((im.mode, im.size, im.tobytes()), _pyramid.shards and _pyramid.shards.take())
+
+'''
+Builds every zoom level in one pass over the base tiles
+Each base tile is decoded once and parents are downsampled from lossless children
+Tiles are visited in Z order (depth first over the quad tree)
+so only a few tiles per level are held in memory at once
+'''
+class Pyramid(object):
+    def __init__(self, tiler):
+        self.src_dir = tiler.src_dir
+        self.pim = tiler.pim
+        self.rcs = tiler.rcs
+        self.max_level = tiler.max_level
+        self.min_level = tiler.min_level
+        self.dst_basedir = tiler.dst_basedir
+        self.tw = tiler.tw
+        self.th = tiler.th
+        self.quality = tiler.quality
+        self.im_ext = tiler.im_ext
+        self.threads = tiler.threads
+        self.progress_inc = tiler.progress_inc
+        # Base level already written to its final location
+        self.base_in_place = False
+        # level => set of (row, col) to regenerate, None for everything
+        self.dirty = None
+        self.blanks = None
+        if tiler.blank_tol is not None and tiler.blank_tol >= 0:
+            self.blanks = BlankStore(self.dst_basedir, self.im_ext, tiler.blank_tol, self.quality)
+        # Packed archive output instead of tile files
+        # The archive dedups identical tiles itself, blanks is only used to skip work
+        self.archive_fn = tiler.archive_fn
+        self.shards = None
+        if self.archive_fn:
+            self.shards = archive.ShardWriter(self.archive_fn)
+        # (shard file name, entries) from each task
+        self.shard_entries = []
+
+    def level_dir(self, level):
+        return '%s/%d' % (self.dst_basedir, level)
+
+    def encode(self, im):
+        buf = io.BytesIO()
+        Image.init()
+        fmt = Image.EXTENSION[self.im_ext.lower()]
+        if self.im_ext == '.jpg':
+            im.save(buf, fmt, quality=self.quality)
+        else:
+            im.save(buf, fmt)
+        return buf.getvalue()
+
+    def save(self, im, level, row, col):
+        if self.shards:
+            self.shards.add(archive.tile_name(level, row, col, self.im_ext), self.encode(im))
+            return
+        dst_fn = get_fn(self.level_dir(level), row, col, im_ext=self.im_ext)
+        if self.blanks and self.blanks.store(im, dst_fn):
+            return
+        # May be a link to a shared blank tile from a previous run
+        if os.path.exists(dst_fn):
+            os.unlink(dst_fn)
+        if self.im_ext == '.jpg':
+            im.save(dst_fn, quality=self.quality)
+        else:
+            im.save(dst_fn)
+
+    def base_tile(self, row, col):
+        '''Return decoded base tile and write it to the max level dir'''
+        if self.src_dir:
+            src_fn = get_fn(self.src_dir, row, col, im_ext=self.im_ext)
+            if not os.path.exists(src_fn):
+                # Removed since the last run?
+                dst_fn = get_fn(self.level_dir(self.max_level), row, col, im_ext=self.im_ext)
+                if self.dirty is not None and os.path.exists(dst_fn):
+                    os.unlink(dst_fn)
+                return None
+            im = Image.open(src_fn)
+            im.load()
+            # Don't recompress the base level
+            if self.shards:
+                self.shards.add(archive.tile_name(self.max_level, row, col, self.im_ext), open(src_fn, 'rb').read())
+            elif not self.base_in_place:
+                dst_fn = get_fn(self.level_dir(self.max_level), row, col, im_ext=self.im_ext)
+                if not (self.blanks and self.blanks.store(im, dst_fn)):
+                    if os.path.exists(dst_fn):
+                        os.unlink(dst_fn)
+                    shutil.copyfile(src_fn, dst_fn)
+            return im
+
+        x = col * self.tw
+        y = row * self.th
+        im = self.pim.image.crop((x, y, min(x + self.tw, self.pim.width()), min(y + self.th, self.pim.height())))
+        # w/o pad map stretches image
+        if im.size != (self.tw, self.th):
+            im = pimage.resize(im, self.tw, self.th)
+        self.save(im, self.max_level, row, col)
+        return im
+
+    def merge(self, children):
+        '''
+        Paste 2x2 children (row major, None if missing) and shrink by 2
+        Missing tiles are filled like pimage.from_fns()
+        '''
+        last = None
+        mode = None
+        for im in children:
+            if im is not None:
+                mode = im.mode
+                break
+        if mode is None:
+            return None
+        if self.blanks:
+            color = self.merge_color(children)
+            if color is not None:
+                # Shrinking a blank quad gives the same blank
+                return Image.new(mode, (self.tw, self.th), color)
+        full = Image.new(mode, (2 * self.tw, 2 * self.th))
+        for i, im in enumerate(children):
+            if im is None:
+                # Can we make a best guess on what to fill in?
+                if last is None:
+                    continue
+                im = Image.new(mode, (self.tw, self.th), last.getpixel((self.tw - 1, self.th - 1)))
+            else:
+                last = im
+            full.paste(im, ((i % 2) * self.tw, (i / 2) * self.th))
+        return pimage.rescale(full, 0.5, filt=Image.ANTIALIAS)
+
+    def set_dirty(self, base_tiles):
+        '''Only regenerate base_tiles, a set of (row, col), and their ancestors'''
+        self.dirty = {self.max_level: set(base_tiles)}
+        for level in xrange(self.max_level - 1, self.min_level - 1, -1):
+            self.dirty[level] = set([(row / 2, col / 2) for (row, col) in self.dirty[level + 1]])
+
+    def existing(self, level, row, col):
+        '''Load an unchanged tile from a previous run'''
+        fn = get_fn(self.level_dir(level), row, col, im_ext=self.im_ext)
+        if not os.path.exists(fn):
+            return None
+        im = Image.open(fn)
+        im.load()
+        return im
+
+    def merge_color(self, children):
+        '''Return the color merge() would produce if the 2x2 quad is blank, else None'''
+        ret = None
+        last = None
+        for im in children:
+            if im is None:
+                # Same fill as merge()
+                if last is None:
+                    return None
+                color = last.getpixel((self.tw - 1, self.th - 1))
+            else:
+                color = self.blanks.color(im)
+                if color is None:
+                    return None
+                last = im
+            if ret is None:
+                ret = color
+            elif color != ret:
+                return None
+        return ret
+
+    def node(self, level, row, col):
+        '''Return tile image at level / row / col after writing it and everything under it'''
+        if self.dirty is not None and (row, col) not in self.dirty[level]:
+            return self.existing(level, row, col)
+        if level == self.max_level:
+            return self.base_tile(row, col)
+        src_rows, src_cols = self.rcs[level + 1]
+        children = []
+        for src_row in (2 * row, 2 * row + 1):
+            for src_col in (2 * col, 2 * col + 1):
+                if src_row < src_rows and src_col < src_cols:
+                    children.append(self.node(level + 1, src_row, src_col))
+                else:
+                    children.append(None)
+        im = self.merge(children)
+        if im is not None:
+            self.save(im, level, row, col)
+        elif self.dirty is not None and not self.shards:
+            # Everything under it was removed since the last run
+            dst_fn = get_fn(self.level_dir(level), row, col, im_ext=self.im_ext)
+            if os.path.exists(dst_fn):
+                os.unlink(dst_fn)
+        return im
+
+    def split_level(self):
+        '''Coarsest level with enough subtrees to keep the workers busy'''
+        for level in xrange(self.min_level, self.max_level + 1):
+            rows, cols = self.rcs[level]
+            if rows * cols >= 4 * self.threads:
+                return level
+        return self.max_level
+
+    def run(self):
+        global _pyramid
+
+        if not self.shards:
+            for level in xrange(self.max_level, self.min_level - 1, -1):
+                if not os.path.exists(self.level_dir(level)):
+                    os.mkdir(self.level_dir(level))
+
+        band_dir = None
+        src_fn = self.pim and getattr(self.pim.image, 'filename', None)
+        if src_fn and pimage.band_readable(src_fn):
+            # Too big to hold: tile the base in bands then build up from those tiles
+            print 'Pyramid: tiling base level in bands from %s' % src_fn
+            if self.shards:
+                # Staged next to the archive, packed as the pyramid is built
+                band_dir = tempfile.mkdtemp(prefix='pr0ntile_', dir=os.path.dirname(os.path.abspath(self.archive_fn)))
+                self.src_dir = band_dir
+            else:
+                self.src_dir = self.level_dir(self.max_level)
+                self.base_in_place = True
+            ImageTiler(None, self.src_dir, tw=self.tw, th=self.th, im_ext=self.im_ext,
+                    threads=self.threads, src_fn=src_fn, blanks=None if self.shards else self.blanks, quality=self.quality).run()
+            self.pim = None
+        elif self.pim:
+            # Decode once here so forked workers share it
+            self.pim.image.load()
+
+        if self.threads <= 1:
+            split = self.min_level
+        else:
+            split = self.split_level()
+        rows, cols = self.rcs[split]
+        print 'Pyramid: levels %d to %d, %d subtrees at level %d' % (self.max_level, self.min_level, rows * cols, split)
+
+        tasks = [(split, row, col) for row in xrange(rows) for col in xrange(cols)]
+        ims = {}
+        next_progress = self.progress_inc
+        _pyramid = self
+        pool = None
+        try:
+            if self.threads <= 1 or split == self.min_level:
+                results = itertools.imap(_pyramid_subtree, tasks)
+            else:
+                pool = multiprocessing.Pool(self.threads)
+                results = pool.imap(_pyramid_subtree, tasks)
+            for done, ((_level, row, col), (res, shard)) in enumerate(itertools.izip(tasks, results), 1):
+                if res is not None:
+                    mode, size, data = res
+                    ims[(row, col)] = Image.frombytes(mode, size, data)
+                if shard:
+                    self.shard_entries.append(shard)
+                progress = 1.0 * done / len(tasks)
+                if self.progress_inc and progress >= next_progress:
+                    print 'Progress: %02.2f%% %d / %d' % (progress * 100, done, len(tasks))
+                    next_progress += self.progress_inc
+        finally:
+            _pyramid = None
+            if pool:
+                pool.close()
+                pool.join()
+            if band_dir:
+                shutil.rmtree(band_dir)
+
+        self.finish(split, ims)
+        if self.shards:
+            self.write_archive()
+
+    def write_archive(self):
+        '''Combine the per process shards into the final archive'''
+        shard = self.shards.take()
+        if shard:
+            self.shard_entries.append(shard)
+        self.shards.close()
+        # shard file name => entries
+        shards = {}
+        for shard_fn, entries in self.shard_entries:
+            shards.setdefault(shard_fn, {}).update(entries)
+        meta = {
+            'tw': self.tw,
+            'th': self.th,
+            'im_ext': self.im_ext,
+            'min_level': self.min_level,
+            'max_level': self.max_level,
+            }
+        tmp_fn = self.archive_fn + '.tmp'
+        try:
+            w = archive.merge_shards(sorted(shards.items()), tmp_fn, meta)
+        finally:
+            for shard_fn in shards:
+                os.unlink(shard_fn)
+        os.rename(tmp_fn, self.archive_fn)
+        print 'Pyramid: archived %d tiles, %d unique, to %s' % (len(w.tiles), len(w.hashes), self.archive_fn)
+
+    def run_incremental(self):
+        '''Regenerate only the dirty paths, see set_dirty()'''
+        roots = sorted(self.dirty[self.min_level])
+        print 'Pyramid: updating %d base tiles, %d tiles total' % (len(self.dirty[self.max_level]), sum([len(d) for d in self.dirty.values()]))
+        for (row, col) in roots:
+            self.node(self.min_level, row, col)
+
+    def finish(self, split, ims):
+        '''Finish the levels above the split from the in memory results'''
+        for level in xrange(split - 1, self.min_level - 1, -1):
+            src_rows, src_cols = self.rcs[level + 1]
+            rows, cols = self.rcs[level]
+            level_ims = {}
+            for row in xrange(rows):
+                for col in xrange(cols):
+                    children = []
+                    for src_row in (2 * row, 2 * row + 1):
+                        for src_col in (2 * col, 2 * col + 1):
+                            children.append(ims.get((src_row, src_col)))
+                    im = self.merge(children)
+                    if im is not None:
+                        self.save(im, level, row, col)
+                        level_ims[(row, col)] = im
+            ims = level_ims
+
 '''
 Creates smaller tiles from source tiles
 '''
@@ -236,6 +747,18 @@ class Tiler(object):
         self.progress_inc = 0.10
         self.threads = threads
         self.im_ext = im_ext
+        # Build all levels from one decode of the base tiles
+        # Otherwise each level is decoded from the previous level's files
+        self.single_pass = True
+        # Multi level path: about this many blocks of tiles per worker per level
+        self.blocks_per_thread = 4
+        # Only regenerate tiles whose source changed since the manifest was written
+        self.incremental = False
+        # Tiles with all bands within this range are stored once and linked
+        # None to disable
+        self.blank_tol = 0
+        # Write all levels into one packed file (see archive.py) instead of tile files
+        self.archive_fn = None
 
         self.workers = None
         
@@ -257,17 +780,17 @@ class Tiler(object):
 
     def wstart(self):
         self.workers = []
-        self.wopen = set()
         # Our input queue / worker output queue
         self.qi = multiprocessing.Queue()
+        # Shared task queue, workers pull the next block as soon as they are free
+        self.qtask = multiprocessing.Queue()
         for wi in xrange(self.threads):
             if self.verbose:
                 print 'Bringing up W%02d' % wi
-            w = TWorker(wi, self.qi, im_ext=self.im_ext,
+            w = TWorker(wi, self.qtask, self.qi, im_ext=self.im_ext,
                 tw=self.tw, th=self.th)
             self.workers.append(w)
             w.start()
-            self.wopen.add(wi)
 
     def wkill(self):
         if self.workers is None:
@@ -291,7 +814,6 @@ class Tiler(object):
                 if self.verbose:
                     print '  W%d: stopped' % wi
                 self.workers[wi] = None
-                self.wopen.remove(wi)
         if allw:
             self.workers = None
 
@@ -306,58 +828,38 @@ class Tiler(object):
                 src_cols, dst_cols,
                 src_rows, dst_rows)
         
+        # One listing instead of an exists() per tile per worker
+        have = set(os.listdir(src_dir))
+        # Several blocks per worker so a slow block doesn't leave the others idle at the end
+        blocks = subtile_blocks(dst_rows, dst_cols, self.threads * self.blocks_per_thread)
+        if self.verbose:
+            print '%d blocks' % len(blocks)
+        # All tasks are queued up front so a worker never waits on us for the next one
+        for block in blocks:
+            self.qtask.put(('subtile', (dst_dir, block, src_dir, subtile_have(have, src_dir, block, self.im_ext))))
+        
         next_progress = self.progress_inc
         done = 0
-        # AttributeError: 'xrange' object has no attribute 'next'
-        def dst_row_genf():
-            for x in xrange(dst_rows):
-                yield x
-        dst_row_gen = dst_row_genf()
-        
-        while True:
-            idle = True
-            
-            # No more jobs to give and all workers are idle?
-            if dst_row_gen is None and len(self.wopen) == len(self.workers):
-                break
-            
-            # Scrub completed tasks
+        n_tiles = dst_rows * dst_cols
+        for _i in xrange(len(blocks)):
             while True:
                 try:
-                    wi, event, val = self.qi.get(False)
-                except Queue.Empty:
+                    wi, event, val = self.qi.get(True, 1.0)
                     break
-                if event != 'done':
-                    print event, val
-                    raise Exception()
-                idle = False
-                self.wopen.add(wi)
-                
-                done += 1
-                progress = 1.0 * done / dst_rows
-                if self.progress_inc and progress >= next_progress:
-                    print 'Progress: %02.2f%% %d / %d' % (progress * 100, done, dst_rows)
-                    next_progress += self.progress_inc
-            
-            # More tasks to give?
-            if dst_row_gen and len(self.wopen):
-                # Assign next task
-                try:
-                    dst_row = dst_row_gen.next()
-                # Out of tasks?
-                except StopIteration:
-                    dst_row_gen = None
-                    continue
-                
-                idle = False
-                worker = self.workers[self.wopen.pop()]
-                worker.submit('subtile',
-                    (dst_dir, dst_row, dst_cols,
-                    src_dir))
+                except Queue.Empty:
+                    for worker in self.workers:
+                        if not worker.process.is_alive():
+                            raise Exception('Worker died')
+            if event != 'done':
+                print event, val
+                raise Exception()
             
-            if idle:
-                # Couldn't find something to do
-                time.sleep(0.05)
+            _dst_dir, (row0, row1, col0, col1), _src_dir = val
+            done += (row1 - row0) * (col1 - col0)
+            progress = 1.0 * done / n_tiles
+            if self.progress_inc and progress >= next_progress:
+                print 'Progress: %02.2f%% %d / %d' % (progress * 100, done, n_tiles)
+                next_progress += self.progress_inc
             
         # Next shrink will be on the previous tile set, not the original
         if self.verbose:
@@ -403,7 +905,7 @@ class Tiler(object):
             if level == self.max_level:
                 print 'Source: single image'
                 pim = self.pim
-                tiler = ImageTiler(pim, dst_dir, tw=self.tw, th=self.th, im_ext=self.im_ext)
+                tiler = ImageTiler(pim, dst_dir, tw=self.tw, th=self.th, im_ext=self.im_ext, threads=self.threads)
                 tiler.run()
             # Additional levels we take the image coordinate map and shrink
             else:
@@ -411,13 +913,111 @@ class Tiler(object):
                 src_dir = '%s/%d' % (self.dst_basedir, level + 1)
                 self.subtile(level, dst_dir, src_dir)
 
+    def manifest_fn(self):
+        return os.path.join(self.dst_basedir, 'manifest.json')
+
+    def source_manifest(self):
+        '''Snapshot of the input used to decide what an incremental run needs to redo'''
+        rows, cols = self.rcs[self.max_level]
+        ret = {
+            'params': {
+                'rows': rows,
+                'cols': cols,
+                'max_level': self.max_level,
+                'min_level': self.min_level,
+                'tw': self.tw,
+                'th': self.th,
+                'im_ext': self.im_ext,
+                'quality': self.quality,
+                'blank_tol': self.blank_tol,
+                },
+            }
+        if self.src_dir:
+            tiles = {}
+            for f in os.listdir(self.src_dir):
+                if not f.endswith(self.im_ext):
+                    continue
+                st = os.stat(os.path.join(self.src_dir, f))
+                tiles[f] = [st.st_mtime, st.st_size]
+            ret['tiles'] = tiles
+        else:
+            fn = getattr(self.pim.image, 'filename', None)
+            if fn:
+                st = os.stat(fn)
+                ret['image'] = [os.path.realpath(fn), st.st_mtime, st.st_size]
+        return ret
+
+    def run_incremental(self):
+        '''Returns True if the tiles were brought up to date, False if a full rebuild is needed'''
+        try:
+            old = json.load(open(self.manifest_fn()))
+        except (IOError, ValueError):
+            print 'Incremental: no manifest, full rebuild'
+            return False
+        new = self.source_manifest()
+        if old.get('params') != new['params']:
+            print 'Incremental: parameters changed, full rebuild'
+            return False
+
+        if 'tiles' not in new:
+            # Can't tell which part of a single image changed
+            if 'image' in new and old.get('image') == new['image']:
+                print 'Incremental: source image unchanged'
+                return True
+            print 'Incremental: source image changed, full rebuild'
+            return False
+
+        old_tiles = old.get('tiles', {})
+        changed = set()
+        for f in set(old_tiles.keys()) | set(new['tiles'].keys()):
+            if old_tiles.get(f) != new['tiles'].get(f):
+                changed.add(f)
+        print 'Incremental: %d / %d base tiles changed' % (len(changed), len(new['tiles']))
+        if changed:
+            p = Pyramid(self)
+            p.set_dirty([get_row_col(f) for f in changed])
+            p.run_incremental()
+        self.write_manifest(new)
+        return True
+
+    def write_manifest(self, manifest=None):
+        if manifest is None:
+            manifest = self.source_manifest()
+        tmp_fn = self.manifest_fn() + '.tmp'
+        json.dump(manifest, open(tmp_fn, 'w'))
+        os.rename(tmp_fn, self.manifest_fn())
+
     def run(self):
+        # Palette workarounds are only in the old path
+        palettes = pimage.PALETTES or (self.pim and self.pim.image.palette)
+
+        if self.archive_fn:
+            if palettes or not self.single_pass:
+                raise Exception('Tile archive requires single pass tiling without palettes')
+            if self.incremental:
+                print 'Tile archive: incremental not supported, full rebuild'
+            Pyramid(self).run()
+            return
+
+        if self.incremental and not palettes and os.path.exists(self.dst_basedir):
+            if self.run_incremental():
+                return
+            shutil.rmtree(self.dst_basedir)
+
+        if not os.path.exists(self.dst_basedir):
+            os.mkdir(self.dst_basedir)
+
+        if self.single_pass and not palettes and (self.src_dir or self.pim):
+            Pyramid(self).run()
+        else:
+            self.run_levels()
+        self.write_manifest()
+
+    def run_levels(self):
+        '''Generate each level from the files of the level below'''
         try:
             self.wstart()
             
-            if not os.path.exists(self.dst_basedir):
-                os.mkdir(self.dst_basedir)
-            
             if self.src_dir:
                 self.run_src_dir()
             elif self.pim:
@@ -0,0 +1,35 @@
+#!/usr/bin/python
+'''
+pr0ncpbench: compare control point engine speed and accuracy
+Copyright 2011 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+'''
+
+import argparse
+import json
+from pr0ntools.stitch.cp_bench import CPBench, ENGINES, print_results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark control point engines on a synthetic grid cut from one image')
+    parser.add_argument('--engines', default=','.join(ENGINES), help='Comma separated engines (default: %s)' % ','.join(ENGINES))
+    parser.add_argument('--cols', type=int, default=3, help='Grid cols')
+    parser.add_argument('--rows', type=int, default=3, help='Grid rows')
+    parser.add_argument('--overlap', type=float, default=0.3, help='Fraction shared between neighbors')
+    parser.add_argument('--jitter', type=int, default=8, help='Random position error in pixels')
+    parser.add_argument('--tile-width', type=int, default=None, help='Image width (default: fill source)')
+    parser.add_argument('--tile-height', type=int, default=None, help='Image height (default: fill source)')
+    parser.add_argument('--seed', type=int, default=None, help='Jitter random seed')
+    parser.add_argument('--json', default=None, help='Also write results to this file')
+    parser.add_argument('src', help='Large source image')
+    args = parser.parse_args()
+
+    bench = CPBench(args.src, cols=args.cols, rows=args.rows, overlap=args.overlap,
+            jitter=args.jitter, tile_width=args.tile_width, tile_height=args.tile_height,
+            seed=args.seed)
+    results = bench.run(args.engines.split(','))
+    print_results(results)
+
+    if args.json:
+        for r in results:
+            r['stages'] = r['stages'].totals
+        json.dump(results, open(args.json, 'w'), sort_keys=True, indent=4, separators=(',', ': '))
@@ -31,6 +31,9 @@ if __name__ == "__main__":
     parser.add_argument('--c-mc', '-M', action='store_true', help='Set copyright "%s"' % std_c_mc)
     parser.add_argument('--c-dig', '-D', action='store_true', help='Set copyright "%s"' % std_c_dig)
     parser.add_argument('--threads', type=int, default= multiprocessing.cpu_count())
+    parser.add_argument('--blank-tol', type=int, default=0, help='Store tiles whose bands vary by at most this much once and hard link them, negative to disable (default: 0, exactly uniform)')
+    parser.add_argument('--incremental', action='store_true', help='Keep existing output and only regenerate tiles whose source changed')
+    parser.add_argument('--archive', action='store_true', help='Write tiles into one packed tiles.pta file instead of tiles_out/ (see pr0nmaputil --serve, --unpack)')
     args = parser.parse_args()
     
     if args.c_mc:
@@ -77,6 +80,9 @@ if __name__ == "__main__":
     m.max_level = args.level_max
     m.js_only = args.js_only
     m.skip_missing = args.skip_missing
+    m.incremental = args.incremental
+    m.archive = args.archive
+    m.blank_tol = args.blank_tol if args.blank_tol >= 0 else None
     
     if not out_dir:
         out_dir = "map"
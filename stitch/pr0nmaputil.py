@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 
 from pr0ntools.tile.map_util import *
+from pr0ntools.tile import archive
 import argparse
+import multiprocessing
+import os
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Generate Google Maps code from image file(s)')
@@ -9,9 +12,22 @@ if __name__ == "__main__":
 	parser.add_argument('--rotate', action="store", dest="rotate_degrees", type=int, default=None, help='Degrees to rotate CW')
 	parser.add_argument('--force', action="store_true", dest="force", default=False, help='Force conversion')
 	parser.add_argument('--rc', action="store_true", dest="rc", default=False, help='Row/col form like cnc_microscope gives')
+	parser.add_argument('--threads', type=int, default= multiprocessing.cpu_count(), help='Rotation worker processes')
+	parser.add_argument('--pack', action="store_true", default=False, help='Pack map dir tiles_out/ into tiles.pta')
+	parser.add_argument('--unpack', action="store_true", default=False, help='Unpack map dir tiles.pta into tiles_out/')
+	parser.add_argument('--serve', action="store", type=int, default=None, metavar='PORT', help='Serve map dir over HTTP with tiles from tiles.pta')
 	args = parser.parse_args()
 
 	for f in args.files_in:
 		if not args.rotate_degrees is None:
-			rotate_tiles(f, None, args.rotate_degrees, args.force, args.rc)
-
+			rotate_tiles(f, None, args.rotate_degrees, args.force, args.rc, threads=args.threads)
+		if args.pack:
+			w = archive.pack_dir(os.path.join(f, 'tiles_out'), os.path.join(f, 'tiles.pta'))
+			print '%s: packed %d tiles, %d unique' % (f, len(w.tiles), len(w.hashes))
+		if args.unpack:
+			r = archive.ArchiveReader(os.path.join(f, 'tiles.pta'))
+			r.extract(os.path.join(f, 'tiles_out'))
+			print '%s: unpacked %d tiles' % (f, len(r))
+			r.close()
+	if args.serve is not None:
+		archive.serve(args.files_in[0], port=args.serve)
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+'''
+Quick low resolution preview of an optimized .pto
+'''
+import argparse
+import multiprocessing
+from pr0ntools.stitch.pto.project import PTOProject
+from pr0ntools.stitch.preview import Preview
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render a low resolution preview from .pto image positions')
+    parser.add_argument('pto', help='optimized .pto')
+    parser.add_argument('fn_out', nargs='?', default='preview.jpg', help='output image (default: preview.jpg)')
+    parser.add_argument('--max-size', type=int, default=2000, help='longest output side in pixels')
+    parser.add_argument('--scale', type=float, default=None, help='output / panorama pixels, overrides --max-size')
+    parser.add_argument('--feather', type=int, default=8, help='seam blend width in output pixels, 0 to disable')
+    parser.add_argument('--threads', type=int, default= multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    pto = PTOProject.from_file_name(args.pto)
+    im = Preview(pto, max_size=args.max_size, scale=args.scale, feather=args.feather, threads=args.threads).run()
+    print 'Saving %s...' % args.fn_out
+    im.save(args.fn_out, quality=90)
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+'''
+Crop a full resolution region out of a supertile or tile dir
+'''
+import argparse
+from pr0ntools.stitch.roi import ROIIndex
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Extract a region of interest from a supertile (st_*x_*y.jpg) or tile (y*_x*.jpg) dir')
+    parser.add_argument('dir', help='supertile or tile dir')
+    parser.add_argument('rect', nargs='?', default=None, help='x,y,w,h in panorama pixels')
+    parser.add_argument('fn_out', nargs='?', default=None, help='output image')
+    parser.add_argument('--no-cache', action='store_true', help='rescan dir instead of using dir.roi.json')
+    args = parser.parse_args()
+
+    index = ROIIndex.from_dir(args.dir, cache=not args.no_cache)
+    print 'Bounds: %s' % (index.bounds(),)
+    if args.rect:
+        if not args.fn_out:
+            raise Exception('Need output file name')
+        x, y, w, h = [int(v) for v in args.rect.split(',')]
+        im = index.extract(x, y, x + w, y + h)
+        print 'Saving %s...' % args.fn_out
+        im.save(args.fn_out, quality=90)
@@ -1,12 +1,17 @@
 #!/usr/bin/env python
 import argparse
+import multiprocessing
 from pr0ntools.stitch.single import singlify
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Generate Google Maps code from image file(s)')
     parser.add_argument('fn_out', help='')
     parser.add_argument('fns_in', nargs='+', help='')
+    parser.add_argument('--band-height', type=int, default=256, help='.tif output: rows assembled at a time')
+    parser.add_argument('--compress', action='store_true', help='.tif output: deflate compress (output can no longer be tiled in bands)')
+    parser.add_argument('--threads', type=int, default= multiprocessing.cpu_count(), help='.tif output: compression processes')
     args = parser.parse_args()
 
     # Warning: will throw HugeJPEG if too big
-    singlify(args.fns_in, args.fn_out)
+    # .tif is streamed and has no such limit
+    singlify(args.fns_in, args.fn_out, band_height=args.band_height, compress=args.compress, threads=args.threads)
@@ -19,6 +19,8 @@ import sys
 import traceback
 import multiprocessing
 from pr0ntools.stitch.grid_stitch import GridStitch
+from pr0ntools.stitch.image_coordinate_map import PAIRINGS
+from pr0ntools.temp_file import TempScope
 from pr0ntools.util import logwt
 
 allow_overwrite = True
@@ -52,6 +54,11 @@ if __name__ == "__main__":
     parser.add_argument('--y-overlap', help='')
     parser_add_bool_arg('--dry', default=False, help='')
     parser_add_bool_arg('--skip-missing', default=False, help='')
+    parser_add_bool_arg('--soften-parallel', default=False, help='On match failure try all soften levels at once and keep the best')
+    parser_add_bool_arg('--tmpfs', default=False, help='Keep per pair temp files (sub images, projects) in RAM, needs config scratch.tmpfs (ex: /dev/shm)')
+    parser_add_bool_arg('--predict', default=True, help='Only match the overlap predicted from already solved pairs')
+    parser.add_argument('--pairing', default='grid4', choices=PAIRINGS, help='Which neighbors to feature match (default: grid4)')
+    parser.add_argument('--loop-spacing', type=int, default=4, help='tree pairing: link rows every this many cols')
     parser.add_argument('fns', nargs='+', help='File names')
     args = parser.parse_args()
     
@@ -90,6 +97,13 @@ if __name__ == "__main__":
         print 'Using %d threads' % args.threads
         engine.threads = args.threads
         engine.skip_missing = args.skip_missing
+        engine.soften_parallel = args.soften_parallel
+        engine.temp_tmpfs = args.tmpfs
+        if args.tmpfs and TempScope.tmpfs_prefix() is None:
+            print 'WARNING: --tmpfs without a scratch.tmpfs dir configured, temp files stay under temp_base'
+        engine.predict_windows = args.predict
+        engine.pairing = args.pairing
+        engine.loop_spacing = args.loop_spacing
     else:
         raise Exception('need an algorithm / engine')
 
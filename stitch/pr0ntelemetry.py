@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+'''
+Summarize where time goes from pr0nts / pr0nstitch telemetry
+'''
+import argparse
+from pr0ntools import telemetry
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Report time and resources per stage and per worker from *.telemetry.jsonl')
+    parser.add_argument('fns', nargs='*', default=['pr0nts'], help='log dirs (ex: pr0nts, pr0nstitch) or telemetry files')
+    parser.add_argument('--stage', action='append', help='only show the slowest spans of this stage')
+    parser.add_argument('--top', type=int, default=10, help='number of slowest spans to show with --stage')
+    args = parser.parse_args()
+
+    recs = telemetry.load(args.fns)
+    print telemetry.report(recs)
+    for stage in args.stage or []:
+        print
+        print 'Slowest %s' % stage
+        for r in sorted([r for r in recs if r['stage'] == stage], key=lambda r: -r['wall'])[0:args.top]:
+            ids = ' '.join(['%s=%s' % (k, r[k]) for k in sorted(r) if k not in ('stage', 't', 'wall', 'cpu', 'maxrss', 'read', 'write', 'ok')])
+            print '  %10.3f sec %10.3f cpu  %s' % (r['wall'], r['cpu'], ids)
@@ -13,6 +13,8 @@ http://uvicrec.blogspot.com/2012/02/tile-stitch.html
 '''
 
 from pr0ntools.stitch.tiler import Tiler
+from pr0ntools.stitch.remote import TileServer, TileClient, parse_addr
+from pr0ntools.stitch.blender import BLENDERS, default_blend_memory
 from pr0ntools.stitch.pto.project import PTOProject
 from pr0ntools.config import config
 from pr0ntools.stitch.single import singlify, HugeJPEG
@@ -81,6 +83,12 @@ def mem2pix(mem):
     # since the files got deleted after the run it wasn't obvious
     #return mem * 35 / 1000
 
+def get_blend_memory(args):
+    '''Bytes shared by concurrent blends, None for no limit'''
+    if args.blend_memory:
+        return mksize(str(args.blend_memory))
+    return default_blend_memory()
+
 def parser_add_bool_arg(yes_arg, default=False, **kwargs):
     dashed = yes_arg.replace('--', '')
     dest = dashed.replace('-', '_')
@@ -94,6 +102,7 @@ if __name__ == "__main__":
     parser.add_argument('--sth', help='Supertile height')
     parser.add_argument('--stp', help='Supertile pixels')
     parser.add_argument('--stm', help='Supertile memory')
+    parser.add_argument('--blend-memory', default=config.blend_memory(), help='Memory shared by concurrent blends (default: half of physical RAM)')
     parser.add_argument('--force', action="store_true", help='Force by replacing old files')
     parser.add_argument('--merge', action="store_true", help="Don't delete anything and only generate things missing")
     parser.add_argument('--out-ext', default='.jpg', help='Select output image extension (and type), .jpg, .png, .tif, etc')
@@ -105,18 +114,26 @@ if __name__ == "__main__":
     parser.add_argument('--ignore-crop', action="store_true", help='Continue even if not cropped')
     parser.add_argument('--nona-args')
     parser.add_argument('--enblend-args')
+    parser.add_argument('--blender', default='enblend', choices=BLENDERS, help='enblend; built in (no temp files with the translate remapper): multiband, or feather / nearest for quick looks')
+    parser.add_argument('--remapper', default='nona', choices=('auto', 'nona', 'translate'), help='nona (default), translate: remap in process (translation only projects), auto: translate when the project allows it, otherwise nona')
     parser.add_argument('--ignore-errors', action="store_true", dest="ignore_errors", help='skip broken tile stitches (advanced)')
     parser.add_argument('--verbose', '-v', action="store_true", help='spew lots of info')
     parser.add_argument('--st-dir', default='st', help='store intermediate supertiles to given dir')
     parser.add_argument('--st-limit', default='inf', help='debug (exit after # supertiles, typically --st-limit 1 --threads 1)')
     parser.add_argument('--single-dir', default='single', help='folder to put final output composite image')
     parser.add_argument('--single-fn', default=None, help='file name to write in single dir')
-    parser_add_bool_arg('--enblend-lock', default=False, help='use lock file to only enblend (memory intensive part) one at a time')
-    parser.add_argument('--threads', type=int, default= multiprocessing.cpu_count())
+    parser.add_argument('--scratch-budget', help='Disk space for in flight supertile intermediates (default: most of the free space under temp_base)')
+    parser.add_argument('--scratch-tmpfs', default=config.scratch_tmpfs(), help='RAM backed dir (ex: /dev/shm) to put intermediates on when they fit (default: disabled). Uses RAM on top of the blend memory budget')
+    parser.add_argument('--scratch-tmpfs-budget', help='Space to use on --scratch-tmpfs (default: half of its free space)')
+    parser_add_bool_arg('--enblend-lock', default=False, help='only blend (memory intensive part) one supertile at a time regardless of --blend-memory')
+    parser.add_argument('--threads', type=int, default= multiprocessing.cpu_count(), help='Local workers, 0 with --serve to only render remotely')
+    parser.add_argument('--serve', help='[host:]port to also hand supertiles to remote workers (pr0nts --worker) on')
+    parser.add_argument('--worker', help='Render supertiles for a pr0nts --serve master at this URL (ex: http://master:28786) instead')
+    parser.add_argument('--image-dir', help='--worker: source images are in this dir rather than at the paths in the master project')
     parser.add_argument('--log', default='pr0nts', help='Output log file name')
     args = parser.parse_args()
 
-    if args.threads < 1:
+    if args.threads < 0 or (args.threads == 0 and not args.serve):
         raise Exception('Bad threads')
     print 'Using %d threads' % args.threads
     
@@ -124,6 +141,12 @@ if __name__ == "__main__":
     out_dir = 'out'
     _dt = logwt(log_dir, 'main.log', shift_d=True)
 
+    if args.worker:
+        c = TileClient(args.worker, threads=args.threads, log_dir=log_dir, image_dir=args.image_dir, verbose=args.verbose)
+        c.blend_memory = get_blend_memory(args)
+        c.run()
+        sys.exit(0)
+
     fn = args.pto[0]
     
     auto_size = not (args.stp or args.stm or args.stw or args.sth)
@@ -158,6 +181,9 @@ if __name__ == "__main__":
     t.ignore_errors = args.ignore_errors
     t.ignore_crop = args.ignore_crop
     t.st_limit = float(args.st_limit)
+    if args.serve:
+        bind, port = parse_addr(args.serve)
+        t.server = TileServer(bind, port, verbose=args.verbose)
 
     # TODO: make this more proper?
     if args.nona_args:
@@ -180,6 +206,15 @@ if __name__ == "__main__":
     if args.full:
         t.make_full()
     t.enblend_lock = args.enblend_lock
+    # Blends run concurrently while their estimates fit
+    t.blend_memory = get_blend_memory(args)
+    t.remapper = args.remapper
+    t.blender = args.blender
+    t.scratch_tmpfs = args.scratch_tmpfs
+    if args.scratch_budget:
+        t.scratch_budget = mksize(args.scratch_budget)
+    if args.scratch_tmpfs_budget:
+        t.scratch_tmpfs_budget = mksize(args.scratch_tmpfs_budget)
 
     if args.single_dir and not os.path.exists(args.single_dir):
         os.mkdir(args.single_dir)
@@ -214,7 +249,7 @@ if __name__ == "__main__":
         single_fn_alt = single_fn.replace('.jpg', '.tif')
 
     try:
-        singlify(s_fns, single_fn, single_fn_alt)
+        singlify(s_fns, single_fn, single_fn_alt, threads=args.threads)
     except HugeJPEG:
         print 'WARNING: single: exceeds max image size'
 
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+from pr0ntools.stitch.blender import MultiBandBlender, Layer, MemorySemaphore, blend_memory, default_blend_memory
+from PIL import Image
+import numpy
+import random
+import threading
+import unittest
+
+def make_layers(rows, cols, w, h, step_x, step_y):
+	r = random.Random(1)
+	layers = []
+	for row in xrange(rows):
+		for col in xrange(cols):
+			a = numpy.random.RandomState(row * cols + col).randint(0, 256, (h, w, 3)).astype(numpy.uint8)
+			# Distinct base color so the seams matter
+			a[:, :, 0] = (row * cols + col) * 25
+			layers.append(Layer(Image.fromarray(a), col * step_x + r.randint(0, 9), row * step_y + r.randint(0, 9)))
+	canvas = (max([l.x + l.width() for l in layers]), max([l.y + l.height() for l in layers]))
+	return layers, canvas
+
+class MultiBandTest(unittest.TestCase):
+	def blend(self, layers, canvas, tile):
+		b = MultiBandBlender([], None)
+		b.set_layers(layers, canvas)
+		b.tile = tile
+		return numpy.asarray(b.blend())
+
+	def test_tiled(self):
+		layers, canvas = make_layers(2, 3, 200, 150, 170, 120)
+		full = self.blend(layers, canvas, max(canvas))
+		# Tile edges on and off the pyramid grid
+		for tile in (100, 133):
+			self.assertTrue((self.blend(layers, canvas, tile) == full).all(), tile)
+
+	def edge_pair(self, edge_value):
+		# Left layer ends in a 4 pixel stripe that the right layer's label region owns
+		a = numpy.full((128, 128, 3), 100, numpy.uint8)
+		a[:, 124:] = edge_value
+		b = numpy.full((128, 128, 3), 50, numpy.uint8)
+		layers = [Layer(Image.fromarray(a), 0, 0), Layer(Image.fromarray(b), 96, 0)]
+		return self.blend(layers, (224, 128), 1024).astype(int)
+
+	def test_coverage(self):
+		# Past the left layer's edge its pixels are only edge replicated
+		# and shouldn't pull the coarse levels of the right layer
+		d = abs(self.edge_pair(255) - self.edge_pair(100))[:, 128:]
+		self.assertTrue(d.max() <= 4, d.max())
+
+	def test_coverage_fallback(self):
+		# Too small for any coarse level to be fully covered: falls back to the replicated pixels
+		a = numpy.full((20, 20, 3), 200, numpy.uint8)
+		b = self.blend([Layer(Image.fromarray(a), 100, 100)], (256, 256), 1024)
+		self.assertTrue((b[100:120, 100:120] >= 190).all())
+		self.assertTrue((b[0:100] == 0).all())
+
+class MemorySemaphoreTest(unittest.TestCase):
+	def acquire(self, sem, nbytes):
+		t = threading.Thread(target=sem.acquire, args=(nbytes,))
+		t.daemon = True
+		t.start()
+		t.join(2.0)
+		return t
+
+	def test_concurrent(self):
+		# Two 10 MP multiband blends fit in the default budget together
+		nbytes = blend_memory('multiband', 10 * 1000 * 1000)
+		total = default_blend_memory()
+		self.assertTrue(total >= 2 * nbytes)
+		sem = MemorySemaphore(total)
+		self.assertFalse(self.acquire(sem, nbytes).is_alive())
+		self.assertFalse(self.acquire(sem, nbytes).is_alive())
+		self.assertEqual(sem.holders.value, 2)
+		sem.release(nbytes)
+		sem.release(nbytes)
+
+	def test_wait(self):
+		sem = MemorySemaphore(100)
+		sem.acquire(60)
+		t = self.acquire(sem, 60)
+		self.assertTrue(t.is_alive())
+		sem.release(60)
+		t.join(5.0)
+		self.assertFalse(t.is_alive())
+		self.assertEqual((sem.holders.value, sem.used.value), (1, 60))
+		sem.release(60)
+		# Larger than the total, but nothing else holds memory
+		self.assertFalse(self.acquire(sem, 500).is_alive())
+		sem.release(500)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+from pr0ntools.stitch import cp_bench
+from pr0ntools.stitch.cp_bench import CPBench
+from PIL import Image
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+class StubEngine:
+	'''Matches nothing, no cpfind / autopano needed'''
+	def __init__(self):
+		self.print_output = True
+		self.stages = None
+		self.calls = 0
+
+	def generate_core(self, fns):
+		self.calls += 1
+		return None
+
+class CPBenchTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp(prefix='pr0ncpbench_test_')
+		self.src_fn = os.path.join(self.dir, 'src.png')
+		# Smooth but position dependent so JPEG round trips stay close
+		im = Image.new('RGB', (400, 300))
+		im.putdata([(x % 256, y % 256, (x + y) % 256) for y in xrange(300) for x in xrange(400)])
+		im.save(self.src_fn)
+		self.src = im
+		self.get_cp_engine = cp_bench.get_cp_engine
+
+	def tearDown(self):
+		cp_bench.get_cp_engine = self.get_cp_engine
+		shutil.rmtree(self.dir)
+
+	def test_synthesize(self):
+		bench = CPBench(self.src_fn, cols=3, rows=2, overlap=0.3, jitter=8, seed=1)
+		bench.synthesize()
+		self.assertEqual(len(bench.truth), 6)
+		self.assertEqual((bench.icm.width(), bench.icm.height()), (3, 2))
+		sizes = set()
+		for fn, (x, y) in bench.truth.iteritems():
+			self.assert_(os.path.exists(fn))
+			im = Image.open(fn)
+			sizes.add(im.size)
+			(w, h) = im.size
+			self.assert_(x >= 0 and y >= 0 and x + w <= 400 and y + h <= 300)
+			# Tile is the source at its recorded position
+			for (px, py) in [(0, 0), (w / 2, h / 2), (w - 1, h - 1)]:
+				got = im.getpixel((px, py))
+				want = self.src.getpixel((x + px, y + py))
+				for (g, e) in zip(got, want):
+					self.assert_(abs(g - e) < 24, '%s: %s vs %s' % (fn, got, want))
+		self.assertEqual(len(sizes), 1)
+		(w, h) = sizes.pop()
+		# Neighbors share about overlap of the image
+		for col in xrange(2):
+			(x0, _y0) = bench.truth[os.path.join(bench.tmp_dir.file_name, 'c%03d_r%03d.jpg' % (col, 0))]
+			(x1, _y1) = bench.truth[os.path.join(bench.tmp_dir.file_name, 'c%03d_r%03d.jpg' % (col + 1, 0))]
+			self.assert_(abs((x1 - x0) - int(w * 0.7)) <= 16)
+
+	def test_seed(self):
+		truths = []
+		for _i in xrange(2):
+			bench = CPBench(self.src_fn, seed=3)
+			bench.synthesize()
+			truths.append(sorted(bench.truth.values()))
+		self.assertEqual(truths[0], truths[1])
+
+	def test_too_small(self):
+		bench = CPBench(self.src_fn, cols=3, rows=3, tile_width=300, tile_height=200)
+		self.assertRaises(Exception, bench.synthesize)
+
+	def test_run_stages(self):
+		engine = StubEngine()
+		cp_bench.get_cp_engine = lambda name: engine
+		bench = CPBench(self.src_fn, cols=2, rows=2, seed=1)
+		(r,) = bench.run(['stub'])
+		# 2x2 grid: 2 horizontal + 2 vertical pairs
+		self.assertEqual(r['pairs'], 4)
+		self.assertEqual(r['failed'], 4)
+		self.assertEqual(engine.calls, 4)
+		self.assertEqual(r['error_median'], None)
+		# One crop per pair
+		self.assertEqual(r['stages'].counts['crop'], 4)
+		self.assertEqual(r['stages'].counts['encode'], 4)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+from pr0ntools import execute
+from pr0ntools.execute import Prefixer, RingBuffer
+import StringIO
+import sys
+import unittest
+
+def sh(cmd, **kwargs):
+	return execute.run(['sh', '-c', cmd], **kwargs)
+
+class RunTest(unittest.TestCase):
+	def setUp(self):
+		self.stdout = StringIO.StringIO()
+		self.stderr = StringIO.StringIO()
+
+	def test_rc(self):
+		self.assertEqual(sh('exit 0', out=execute.OUT_DISCARD).rc, 0)
+		self.assertEqual(sh('exit 3', out=execute.OUT_DISCARD).rc, 3)
+		self.assertEqual(sh('kill -TERM $$', out=execute.OUT_DISCARD).rc, -15)
+
+	def test_print(self):
+		ret = sh('echo out; echo err >&2', stdout=self.stdout, stderr=self.stderr)
+		self.assertEqual(ret.output, None)
+		self.assertEqual(self.stdout.getvalue(), 'out\n')
+		self.assertEqual(self.stderr.getvalue(), 'err\n')
+
+	def test_capture(self):
+		ret = sh('echo out; echo err >&2', out=execute.OUT_CAPTURE, stdout=self.stdout, stderr=self.stderr)
+		self.assertEqual(sorted(ret.output.split('\n')), ['', 'err', 'out'])
+		self.assertEqual(self.stdout.getvalue(), '')
+		self.assertEqual(self.stderr.getvalue(), '')
+
+	def test_tee(self):
+		ret = sh('echo out', out=execute.OUT_TEE, stdout=self.stdout, stderr=self.stderr)
+		self.assertEqual(ret.output, 'out\n')
+		self.assertEqual(self.stdout.getvalue(), 'out\n')
+
+	def test_ring(self):
+		ret = sh('seq 1 10000', out=execute.OUT_CAPTURE, ring=10)
+		self.assertEqual(ret.output, '\n9999\n10000\n'[-10:])
+
+	def test_prefix(self):
+		sh('printf "a\\nb"; sleep 0.1; printf "c\\n"; sleep 0.1; printf "d\\n\\ne"',
+				stdout=self.stdout, stderr=self.stderr, prefix=lambda: 'P:')
+		self.assertEqual(self.stdout.getvalue(), 'P:a\nP:bc\nP:d\nP:\nP:e')
+
+	def test_fields(self):
+		f = sh('exit 2', out=execute.OUT_DISCARD).fields()
+		self.assertEqual((f['exe'], f['exe_rc']), ('sh', 2))
+		self.assertTrue(f['exe_wall'] >= 0 and f['exe_cpu'] >= 0 and f['exe_maxrss'] > 0)
+
+	def test_exc_ret_istr(self):
+		stdout = sys.stdout
+		sys.stdout = self.stdout
+		try:
+			rc, output = execute.exc_ret_istr('sh', ['-c', 'echo err >&2; exit 1'])
+		finally:
+			sys.stdout = stdout
+		self.assertEqual((rc, output), (1, 'err\n'))
+		# stderr echoed to stdout
+		self.assertEqual(self.stdout.getvalue(), 'err\n')
+
+	def test_missing(self):
+		self.assertRaises(OSError, execute.run, ['/nonexistent/pr0ntools_test'])
+
+	def test_bad_out(self):
+		self.assertRaises(ValueError, execute.run, ['true'], out='bogus')
+
+class RingBufferTest(unittest.TestCase):
+	def test_all(self):
+		r = RingBuffer()
+		for i in xrange(1000):
+			r.write('%d,' % i)
+		self.assertEqual(r.getvalue(), ''.join(['%d,' % i for i in xrange(1000)]))
+
+	def test_last(self):
+		r = RingBuffer(5)
+		for s in ('abc', 'defgh', 'ij', 'klmnopqrstuvwxyz'):
+			r.write(s)
+			self.assertTrue(len(r.buf) <= 2 * 5 + len(s))
+		self.assertEqual(r.getvalue(), 'vwxyz')
+		r.write('0')
+		self.assertEqual(r.getvalue(), 'wxyz0')
+
+class PrefixerTest(unittest.TestCase):
+	def test_newlines(self):
+		f = StringIO.StringIO()
+		p = Prefixer(f, lambda: '> ')
+		# Line ending exactly at the end of a write
+		p.write('a\n')
+		p.write('b')
+		p.write('c\nd\n\n')
+		p.write('')
+		p.write('e')
+		self.assertEqual(f.getvalue(), '> a\n> bc\n> d\n> \n> e')
+
+if __name__ == '__main__':
+	unittest.main()
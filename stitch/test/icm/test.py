@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+from pr0ntools.stitch.image_coordinate_map import ImageCoordinateMap, get_row_col
+from pr0ntools.stitch import image_coordinate_map
+import os
+import shutil
+import tempfile
+import unittest
+
+def make_map(cols, rows):
+	icm = ImageCoordinateMap(cols, rows)
+	for col in xrange(cols):
+		for row in xrange(rows):
+			icm.set_image(col, row, 'c%04d_r%04d.jpg' % (col, row))
+	return icm
+
+def connected(icm, pairs):
+	# Union find over (col, row)
+	parent = {}
+	def find(k):
+		while parent.get(k, k) != k:
+			k = parent[k]
+		return k
+	for pair in pairs:
+		(a, b) = pair.key()
+		parent[find(a)] = find(b)
+	roots = set([find(k) for k in icm.gen_set()])
+	return len(roots) == 1
+
+class PairingTest(unittest.TestCase):
+	def test_grid4(self):
+		icm = make_map(5, 4)
+		pairs = list(icm.gen_pairs_pairing('grid4'))
+		# (cols - 1) * rows + cols * (rows - 1)
+		self.assertEqual(len(pairs), 4 * 4 + 5 * 3)
+		self.assertTrue(connected(icm, pairs))
+
+	def test_grid8(self):
+		icm = make_map(5, 4)
+		pairs = list(icm.gen_pairs_pairing('grid8'))
+		self.assertEqual(len(pairs), 4 * 4 + 5 * 3 + 2 * 4 * 3)
+		self.assertEqual(len(set([p.key() for p in pairs])), len(pairs))
+
+	def test_tree(self):
+		icm = make_map(10, 6)
+		grid4 = list(icm.gen_pairs_pairing('grid4'))
+		tree = list(icm.gen_pairs_pairing('tree', loop_spacing=4))
+		self.assertTrue(connected(icm, tree))
+		# Rows chained, links at cols 0, 4, 8, 9
+		self.assertEqual(len(tree), 9 * 6 + 4 * 5)
+		self.assertTrue(len(tree) < len(grid4))
+		# Same orientation as the full grid so nothing is matched backwards
+		grid4_keys = set([p.key() for p in grid4])
+		for pair in tree:
+			self.assertTrue(pair.key() in grid4_keys)
+
+	def test_fallback(self):
+		icm = make_map(3, 3)
+		pair = list(icm.gen_pairs_pairing('grid4'))[0]
+		diag = icm.fallback_pairs(pair, 'grid4-fallback')
+		grid8_keys = set([p.key() for p in icm.gen_pairs_pairing('grid8')])
+		self.assertTrue(len(diag) > 0)
+		for extra in diag:
+			self.assertTrue(extra.key() in grid8_keys)
+		self.assertEqual(icm.fallback_pairs(pair, 'grid4'), [])
+
+class MapTest(unittest.TestCase):
+	def test_row_col(self):
+		self.assertEqual(get_row_col('c0012_r0034.jpg'), (34, 12))
+		self.assertEqual(get_row_col('/some/dir/r3_c4.png'), (3, 4))
+		self.assertEqual(get_row_col('x1_y2.tif'), (2, 1))
+		self.assertRaises(Exception, get_row_col, 'c1_c2.jpg')
+		self.assertRaises(Exception, get_row_col, 'c1_r2_extra.jpg')
+
+	def test_dir_cache(self):
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			src_dir = os.path.join(tmp_dir, 'tiles')
+			os.mkdir(src_dir)
+			for col in xrange(3):
+				for row in xrange(2):
+					open(os.path.join(src_dir, 'c%d_r%d.jpg' % (col, row)), 'w').close()
+			orig_min = image_coordinate_map.ICM_CACHE_MIN
+			image_coordinate_map.ICM_CACHE_MIN = 1
+			try:
+				icm = ImageCoordinateMap.from_dir_tagged_file_names(src_dir)
+				self.assertTrue(os.path.exists(src_dir + '.icm.json'))
+				cached = ImageCoordinateMap.from_dir_tagged_file_names(src_dir)
+			finally:
+				image_coordinate_map.ICM_CACHE_MIN = orig_min
+			self.assertEqual((cached.width(), cached.height()), (3, 2))
+			self.assertEqual(cached.layout, icm.layout)
+		finally:
+			shutil.rmtree(tmp_dir)
+
+	def test_dir_cache_key(self):
+		tmp_dir = tempfile.mkdtemp()
+		orig_min = image_coordinate_map.ICM_CACHE_MIN
+		orig_cwd = os.getcwd()
+		image_coordinate_map.ICM_CACHE_MIN = 1
+		try:
+			src_dir = os.path.join(tmp_dir, 'tiles')
+			os.mkdir(src_dir)
+			for col in xrange(3):
+				for row in xrange(2):
+					open(os.path.join(src_dir, 'c%d_r%d.jpg' % (col, row)), 'w').close()
+			cache_fn = src_dir + '.icm.json'
+
+			# Hinted maps don't populate the cache
+			hinted = ImageCoordinateMap.from_dir_tagged_file_names(src_dir, rows=4, cols=5)
+			self.assertEqual((hinted.width(), hinted.height()), (5, 4))
+			self.assertFalse(os.path.exists(cache_fn))
+			self.assertEqual(ImageCoordinateMap.from_dir_tagged_file_names(src_dir).width(), 3)
+			self.assertTrue(os.path.exists(cache_fn))
+			# ...and don't use it
+			self.assertEqual(ImageCoordinateMap.from_dir_tagged_file_names(src_dir, rows=4, cols=5).width(), 5)
+
+			# Keyed on names, not the dir mtime
+			st = os.stat(src_dir)
+			open(os.path.join(src_dir, 'c3_r0.jpg'), 'w').close()
+			os.utime(src_dir, (st.st_atime, st.st_mtime))
+			self.assertEqual(ImageCoordinateMap.from_dir_tagged_file_names(src_dir).width(), 4)
+
+			# '.' caches next to the dir, not in its parent as '..icm.json'
+			os.chdir(src_dir)
+			ImageCoordinateMap.from_dir_tagged_file_names('.')
+			self.assertFalse(os.path.exists(os.path.join(tmp_dir, '..icm.json')))
+			self.assertTrue(os.path.exists(cache_fn))
+		finally:
+			os.chdir(orig_cwd)
+			image_coordinate_map.ICM_CACHE_MIN = orig_min
+			shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+from pr0ntools.tile.tile import Tiler, get_fn, subtile_blocks
+from pr0ntools.tile import archive
+from PIL import Image
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+def make_src(src_dir, rows, cols):
+	r = random.Random(1)
+	os.mkdir(src_dir)
+	for row in xrange(rows):
+		for col in xrange(cols):
+			im = Image.new('RGB', (250, 250), (r.randint(0, 255), 0, 0))
+			im.save(get_fn(src_dir, row, col))
+
+class PyramidTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp(prefix='pr0nmap_test_')
+		self.src_dir = os.path.join(self.dir, 'src')
+		self.dst_dir = os.path.join(self.dir, 'out')
+		make_src(self.src_dir, 5, 6)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def tiler(self):
+		t = Tiler(5, 6, self.src_dir, 3, 0, dst_basedir=self.dst_dir)
+		t.incremental = True
+		t.progress_inc = None
+		return t
+
+	def test_layout(self):
+		self.tiler().run()
+		# Blank tiles are linked from a hidden dir, only levels are visible
+		names = [f for f in os.listdir(self.dst_dir) if not f.startswith('.')]
+		self.assertEqual(sorted(names), ['0', '1', '2', '3', 'manifest.json'])
+
+	def test_incremental_removed(self):
+		self.tiler().run()
+		# Level 3: 5 x 6, level 2: 3 x 3, level 1: 2 x 2, level 0: 1 x 1
+		# Last base row is the only child of level 2 row 2 which is the only child of level 1 row 1
+		for col in xrange(6):
+			os.unlink(get_fn(self.src_dir, 4, col))
+		self.tiler().run()
+
+		def exists(level, row, col):
+			return os.path.exists(get_fn(os.path.join(self.dst_dir, '%d' % level), row, col))
+		for col in xrange(6):
+			self.assertFalse(exists(3, 4, col))
+			self.assertTrue(exists(3, 3, col))
+		for col in xrange(3):
+			self.assertFalse(exists(2, 2, col))
+			self.assertTrue(exists(2, 1, col))
+		for col in xrange(2):
+			self.assertFalse(exists(1, 1, col))
+			self.assertTrue(exists(1, 0, col))
+		self.assertTrue(exists(0, 0, 0))
+
+class SubtileBlocksTest(unittest.TestCase):
+	def test_aligned(self):
+		for rows, cols, n in [(10, 4, 4), (13, 100, 4), (3, 1000, 8), (1, 5, 8), (7, 7, 1), (100, 3, 16), (5, 5, 32)]:
+			owner = {}
+			for bi, (row0, row1, col0, col1) in enumerate(subtile_blocks(rows, cols, n)):
+				self.assertEqual((row0 % 2, col0 % 2), (0, 0))
+				for row in xrange(row0, row1):
+					for col in xrange(col0, col1):
+						self.assertFalse((row, col) in owner)
+						owner[(row, col)] = bi
+			self.assertEqual(len(owner), rows * cols)
+			# A next level tile's children are all in one block
+			for (row, col), bi in owner.iteritems():
+				self.assertEqual(owner[(row / 2 * 2, col / 2 * 2)], bi, (rows, cols, n, row, col))
+
+class ArchiveTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp(prefix='pr0nmap_test_')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_pack_dir(self):
+		src_dir = os.path.join(self.dir, 'src')
+		dst_dir = os.path.join(self.dir, 'out')
+		make_src(src_dir, 5, 6)
+		Tiler(5, 6, src_dir, 3, 0, dst_basedir=dst_dir).run()
+		fn = os.path.join(self.dir, 'tiles.pta')
+		archive.pack_dir(dst_dir, fn)
+
+		expect = {}
+		for level in xrange(4):
+			level_dir = os.path.join(dst_dir, '%d' % level)
+			for f in os.listdir(level_dir):
+				expect['%d/%s' % (level, f)] = open(os.path.join(level_dir, f), 'rb').read()
+		r = archive.ArchiveReader(fn)
+		self.assertEqual(r.names(), sorted(expect.keys()))
+		for name, data in expect.iteritems():
+			self.assertEqual(r.get(name), data)
+		self.assertEqual(r.get_tile(3, 4, 5), expect['3/y004_x005.jpg'])
+		self.assertEqual(r.get('4/y000_x000.jpg'), None)
+		r.close()
+
+	def test_merge_shards(self):
+		fn = os.path.join(self.dir, 'tiles.pta')
+		# Each shard has its own blob and both have the shared one
+		tiles = [
+				{'0/a.jpg': 'shared', '0/b.jpg': 'only a', '1/c.jpg': 'shared'},
+				{'1/d.jpg': 'only b', '1/e.jpg': 'shared'},
+				]
+		shards = []
+		for i, t in enumerate(tiles):
+			w = archive.ShardWriter(os.path.join(self.dir, 's%d' % i))
+			for name, data in sorted(t.items()):
+				w.add(name, data)
+			shards.append(w.take())
+			w.close()
+		w = archive.merge_shards(shards, fn)
+		# Data stored once per distinct blob
+		self.assertEqual(w.pos - len(archive.MAGIC), len('shared') + len('only a') + len('only b'))
+
+		r = archive.ArchiveReader(fn)
+		expect = {}
+		for t in tiles:
+			expect.update(t)
+		self.assertEqual(r.names(), sorted(expect.keys()))
+		for name, data in expect.iteritems():
+			self.assertEqual(r.get(name), data)
+		r.close()
+
+if __name__ == '__main__':
+	unittest.main()
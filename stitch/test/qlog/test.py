@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+from pr0ntools import qlog
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+class Counted(object):
+	'''Counts how many times it was formatted'''
+	def __init__(self):
+		self.n = 0
+
+	def __str__(self):
+		self.n += 1
+		return 'counted'
+
+class QLogTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp(prefix='pr0nqlog_test_')
+		self.fn = os.path.join(self.dir, 'w00.log')
+
+	def tearDown(self):
+		qlog.close_log()
+		qlog.set_level(qlog.INFO)
+		shutil.rmtree(self.dir)
+
+	def lines(self):
+		# Strip the time stamp
+		return [l.split(' ', 1)[1] for l in open(self.fn).read().split('\n') if l]
+
+	def test_levels(self):
+		qlog.open_log(self.fn, level=qlog.INFO, redirect=False)
+		self.assertFalse(qlog.enabled(qlog.DEBUG))
+		self.assertTrue(qlog.enabled(qlog.WARNING))
+		c = Counted()
+		qlog.debug('dropped %s', c)
+		qlog.info('info %d', 1)
+		qlog.warning('warning %s', c)
+		qlog.error('two\nlines')
+		qlog.info('bad %d', 'x')
+		qlog.close_log()
+		# Only formatted once, by the writer thread
+		self.assertEqual(c.n, 1)
+		lines = self.lines()
+		self.assertEqual(lines[0:4], ['I: info 1', 'W: warning counted', 'E: two', 'E: lines'])
+		self.assertTrue(lines[4].startswith("I: 'bad %d' % ('x',)"))
+
+	def test_flush(self):
+		qlog.open_log(self.fn, redirect=False)
+		qlog.info('a')
+		qlog.flush()
+		self.assertEqual(self.lines(), ['I: a'])
+		qlog.set_level(qlog.DEBUG)
+		qlog.debug('b')
+		qlog.close_log()
+		self.assertEqual(self.lines(), ['I: a', 'D: b'])
+		self.assertFalse(qlog.active())
+
+	def test_redirect(self):
+		stdout = sys.stdout
+		qlog.open_log(self.fn)
+		try:
+			self.assertEqual(qlog.timestamp(), '')
+			print 'printed'
+			sys.stderr.write('err\n')
+			sys.stdout.write('par')
+			sys.stdout.write('tial')
+		finally:
+			qlog.close_log()
+		self.assertTrue(sys.stdout is stdout)
+		self.assertEqual(self.lines(), ['I: printed', 'W: err', 'I: partial'])
+		self.assertNotEqual(qlog.timestamp(), '')
+
+	def test_fork(self):
+		qlog.open_log(self.fn, redirect=False)
+		out_fn = os.path.join(self.dir, 'child.txt')
+		pid = os.fork()
+		if pid == 0:
+			# Forked child: printed directly instead of queued to a dead thread
+			sys.stdout = open(out_fn, 'w')
+			qlog.info('child %d', 1)
+			qlog.debug('child debug')
+			sys.stdout.close()
+			os._exit(0 if not qlog.active() else 1)
+		_pid, status = os.waitpid(pid, 0)
+		self.assertEqual(status, 0)
+		qlog.info('parent')
+		qlog.close_log()
+		self.assertEqual(open(out_fn).read(), 'child 1\n')
+		self.assertEqual(self.lines(), ['I: parent'])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+from pr0ntools.stitch import remote
+from pr0ntools.stitch.pto.project import PTOProject
+from pr0ntools.stitch.remote import TileServer, TileClient
+from PIL import Image
+from xmlrpclib import Binary
+import os
+import Queue
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+PTO = '''p f0 w256 h256 v90
+m i0
+i f0 w256 h256 v90 n"c0000_r0000.jpg"
+'''
+
+class StubWorker(object):
+	'''Renders a supertile as a flat image sized to its bounds instead of stitching'''
+	def __init__(self, i, tiler, log_fn):
+		self.i = i
+		self.qi = Queue.Queue()
+		self.qo = Queue.Queue()
+		self.running = threading.Event()
+		self.process = threading.Thread(target=self.run)
+		self.process.daemon = True
+
+	def start(self):
+		self.running.set()
+		self.process.start()
+
+	def run(self):
+		while self.running.is_set():
+			try:
+				(st_bounds, _scratch_dir) = self.qi.get(True, 0.1)
+			except Queue.Empty:
+				continue
+			x0, x1, y0, y1 = st_bounds
+			fd, fn = tempfile.mkstemp(suffix='.png')
+			os.close(fd)
+			Image.new('RGB', (x1 - x0, y1 - y0), (self.i, 1, 2)).save(fn)
+			self.qo.put(('done', (st_bounds, fn)))
+
+class StubTiler(object):
+	def __init__(self):
+		self.st_dir = None
+		self.pto = PTOProject.from_text(PTO)
+		self.nona_args = []
+		self.enblend_args = []
+		self.remapper = 'nona'
+		self.blender = 'enblend'
+		self.ignore_errors = False
+
+class TileServerTest(unittest.TestCase):
+	def setUp(self):
+		# Not started, RPC methods are called directly
+		self.s = TileServer()
+		self.s.qi.put(([0, 1, 2, 3], None))
+
+	def test_bad_ext(self):
+		j = self.s.job_req('a')
+		self.assertFalse(self.s.job_done('a', j['id'], Binary('x'), '/../../x', None))
+		# Back in the queue, nothing for the master
+		self.assertEqual(self.s.qi.qsize(), 1)
+		self.assertEqual(self.s.outstanding, {})
+		self.assertTrue(self.s.qo.empty())
+
+	def test_expire(self):
+		self.s.config_req('a', 1)
+		j = self.s.job_req('a')
+		# Empty queue, always keep one ready
+		self.assertTrue(self.s.want_task())
+		self.s.timeout = 0.1
+		time.sleep(0.2)
+		# Requeued by the master loop alone
+		self.assertFalse(self.s.want_task())
+		self.assertEqual(self.s.outstanding, {})
+		self.assertEqual(self.s.qi.qsize(), 1)
+		# Too late
+		self.assertFalse(self.s.job_done('a', j['id'], None, None, 'x'))
+
+class RoundTripTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp(prefix='pr0nremote_test_')
+		self.worker = remote.Worker
+		remote.Worker = StubWorker
+
+	def tearDown(self):
+		remote.Worker = self.worker
+		shutil.rmtree(self.dir)
+
+	def test_localhost(self):
+		# Any free port
+		s = TileServer('localhost', 0)
+		s.setup(StubTiler())
+		s.start()
+		c = TileClient('http://localhost:%d' % s.port, threads=1, log_dir=self.dir)
+		t = threading.Thread(target=c.run)
+		t.daemon = True
+		t.start()
+		try:
+			s.qi.put(([64, 128, 0, 32], None))
+			what, (st_bounds, img_fn) = s.qo.get(True, 10)
+			self.assertEqual(what, 'done')
+			self.assertEqual(st_bounds, [64, 128, 0, 32])
+			im = Image.open(img_fn)
+			self.assertEqual(im.size, (64, 32))
+			self.assertEqual(im.getpixel((0, 0)), (0, 1, 2))
+			os.remove(img_fn)
+			self.assertEqual(s.outstanding, {})
+			self.assertEqual(s.clients.keys(), [c.name])
+			# Master settings made it over
+			self.assertEqual(len(c.pto.get_image_lines()), 1)
+		finally:
+			s.running.clear()
+			s.process.join(5)
+		# Client gives up once the master stops serving
+		t.join(10)
+		self.assertFalse(t.is_alive())
+
+if __name__ == '__main__':
+	unittest.main()
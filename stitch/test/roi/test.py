@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+from pr0ntools.stitch.roi import ROIIndex, roi_cache_fn
+from PIL import Image
+import os
+import shutil
+import tempfile
+import unittest
+
+def make_tile(fn, row, col, size=(100, 100)):
+	Image.new('RGB', size, (row * 50, col * 50, 0)).save(fn)
+
+class ROITest(unittest.TestCase):
+	def setUp(self):
+		self.parent = tempfile.mkdtemp(prefix='pr0nroi_test_')
+		self.dir = os.path.join(self.parent, 'tiles')
+		os.mkdir(self.dir)
+		for row in xrange(2):
+			for col in xrange(3):
+				make_tile(os.path.join(self.dir, 'y%03d_x%03d.png' % (row, col)), row, col)
+		self.scans = 0
+		self.scan = ROIIndex.scan
+		def scan(*args):
+			self.scans += 1
+			return self.scan(*args)
+		ROIIndex.scan = staticmethod(scan)
+		self.cwd = os.getcwd()
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		ROIIndex.scan = staticmethod(self.scan)
+		shutil.rmtree(self.parent)
+
+	def test_extract(self):
+		index = ROIIndex.from_dir(self.dir, cache=False)
+		self.assertEqual(index.bounds(), (0, 0, 300, 200))
+		self.assertEqual([f for (f, _x, _y, _w, _h) in index.overlapping(150, 50, 250, 150)],
+				['y000_x001.png', 'y000_x002.png', 'y001_x001.png', 'y001_x002.png'])
+		im = index.extract(90, 90, 210, 110)
+		self.assertEqual(im.size, (120, 20))
+		self.assertEqual(im.getpixel((0, 0)), (0, 0, 0))
+		self.assertEqual(im.getpixel((119, 19)), (50, 100, 0))
+
+	def test_cache(self):
+		ROIIndex.from_dir(self.dir)
+		ROIIndex.from_dir(self.dir)
+		self.assertEqual(self.scans, 1)
+		# Next to the dir, not in it
+		self.assertTrue(os.path.exists(os.path.join(self.parent, 'tiles.roi.json')))
+		self.assertEqual(sorted(os.listdir(self.dir))[0], 'y000_x000.png')
+
+		# Same name, different contents
+		make_tile(os.path.join(self.dir, 'y001_x002.png'), 1, 2, (100, 100))
+		os.utime(os.path.join(self.dir, 'y001_x002.png'), (1, 1))
+		index = ROIIndex.from_dir(self.dir)
+		self.assertEqual(self.scans, 2)
+		ROIIndex.from_dir(self.dir)
+		self.assertEqual(self.scans, 2)
+		self.assertEqual(len(index.images), 6)
+
+	def test_cwd(self):
+		os.chdir(self.dir)
+		self.assertEqual(roi_cache_fn('.'), self.dir + '.roi.json')
+		ROIIndex.from_dir('.')
+		ROIIndex.from_dir('.')
+		self.assertEqual(self.scans, 1)
+		self.assertFalse(os.path.exists(os.path.join(self.parent, '.roi.json')))
+
+if __name__ == '__main__':
+	unittest.main()
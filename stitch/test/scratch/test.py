@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+from pr0ntools.stitch.scratch import ScratchManager
+import shutil
+import tempfile
+import unittest
+
+class ScratchTest(unittest.TestCase):
+	def setUp(self):
+		self.tmpfs = tempfile.mkdtemp(prefix='pr0nscratch_test_')
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpfs)
+
+	def test_default(self):
+		# No tmpfs unless asked for
+		s = ScratchManager(None, budget=100)
+		self.assertEqual(s.reserve(10).where, 'disk')
+
+	def test_tmpfs_then_disk(self):
+		s = ScratchManager(self.tmpfs, budget=100, tmpfs_budget=50)
+		a = s.reserve(40)
+		self.assertEqual((a.where, a.dir), ('tmpfs', self.tmpfs))
+		# Doesn't fit in what's left of tmpfs
+		b = s.reserve(40)
+		self.assertEqual((b.where, b.dir), ('disk', None))
+		c = s.reserve(10)
+		self.assertEqual(c.where, 'tmpfs')
+		self.assertEqual(s.used, {'tmpfs': 50, 'disk': 40})
+
+		s.release(a)
+		s.release(b)
+		s.release(c)
+		self.assertEqual(s.used, {'tmpfs': 0, 'disk': 0})
+		self.assertEqual(s.inflight, 0)
+
+	def test_wait(self):
+		s = ScratchManager(self.tmpfs, budget=100, tmpfs_budget=50)
+		a = s.reserve(50)
+		b = s.reserve(80)
+		self.assertEqual(s.reserve(30), None)
+		s.release(b)
+		self.assertEqual(s.reserve(30).where, 'disk')
+		s.release(a)
+
+	def test_oversize(self):
+		s = ScratchManager(self.tmpfs, budget=100, tmpfs_budget=50)
+		a = s.reserve(10)
+		# Would never fit, but something else is still running
+		self.assertEqual(s.reserve(500), None)
+		s.release(a)
+		# Nothing in flight, let it try
+		b = s.reserve(500)
+		self.assertEqual(b.where, 'disk')
+		self.assertEqual(s.reserve(60), None)
+		s.release(b)
+		self.assertEqual(s.used, {'tmpfs': 0, 'disk': 0})
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+from pr0ntools import pimage
+from pr0ntools.stitch.single import singlify, StreamSingle
+from PIL import Image
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+def read_tiff(fn):
+	'''Minimal strip TIFF / BigTIFF reader: return (big, (w, h), pixel bytes)'''
+	f = open(fn, 'rb')
+	order, version = struct.unpack('<2sH', f.read(4))
+	assert order == 'II'
+	big = version == 43
+	if big:
+		_off_size, _res, ifd_pos = struct.unpack('<HHQ', f.read(12))
+		head, entry, inline = '<Q', '<HHQ', 8
+	else:
+		assert version == 42
+		ifd_pos, = struct.unpack('<I', f.read(4))
+		head, entry, inline = '<H', '<HHI', 4
+	fmts = {3: 'H', 4: 'I', 16: 'Q'}
+	f.seek(ifd_pos)
+	n, = struct.unpack(head, f.read(struct.calcsize(head)))
+	tags = {}
+	for _i in xrange(n):
+		tag, typ, count = struct.unpack(entry, f.read(struct.calcsize(entry)))
+		raw = f.read(inline)
+		size = struct.calcsize('<%d%s' % (count, fmts[typ]))
+		if size > inline:
+			here = f.tell()
+			f.seek(struct.unpack('<Q' if big else '<I', raw)[0])
+			raw = f.read(size)
+			f.seek(here)
+		tags[tag] = struct.unpack('<%d%s' % (count, fmts[typ]), raw[0:size])
+	data = ''
+	for offset, count in zip(tags[273], tags[279]):
+		f.seek(offset)
+		strip = f.read(count)
+		if tags[259][0] == 8:
+			strip = zlib.decompress(strip)
+		data += strip
+	return big, (tags[256][0], tags[257][0]), data
+
+class SingleTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp(prefix='pr0nsingle_test_')
+		r = random.Random(1)
+		self.fns = []
+		# Overlapping supertiles, odd sizes so bands don't line up with them
+		for y in (0, 90, 180):
+			for x in (0, 110):
+				im = Image.new('RGB', (130, 100))
+				im.putdata([(r.randint(0, 255), r.randint(0, 255), r.randint(0, 255)) for _i in xrange(130 * 100)])
+				fn = os.path.join(self.dir, 'st_%06dx_%06dy.jpg' % (x + 7, y + 3))
+				im.save(fn, quality=90)
+				self.fns.append(fn)
+		# In memory canvas path
+		fn = os.path.join(self.dir, 'canvas.png')
+		singlify(self.fns, fn)
+		self.canvas = Image.open(fn)
+		self.canvas.load()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def stream(self, compress=False, bigtiff=None):
+		fn = os.path.join(self.dir, 'out.tif')
+		s = StreamSingle(self.fns, fn, band_height=64, compress=compress)
+		s.bigtiff = bigtiff
+		s.run(7, 3, 240, 280, 'RGB')
+		return fn
+
+	def test_stream(self):
+		self.assertEqual(self.canvas.size, (240, 280))
+		fn = self.stream()
+		big, size, data = read_tiff(fn)
+		self.assertFalse(big)
+		self.assertEqual(size, (240, 280))
+		self.assertEqual(data, self.canvas.tobytes())
+
+		im = Image.open(fn)
+		self.assertEqual(im.tobytes(), self.canvas.tobytes())
+		# Partial decode of the uncompressed strips
+		band = pimage.open_band(fn, 100, 150)
+		self.assertEqual(band.tobytes(), self.canvas.crop((0, 100, 240, 150)).tobytes())
+
+	def test_singlify_tif(self):
+		fn = os.path.join(self.dir, 'single.tif')
+		singlify(self.fns, fn)
+		self.assertEqual(Image.open(fn).tobytes(), self.canvas.tobytes())
+
+	def test_compress(self):
+		fn = self.stream(compress=True)
+		_big, _size, data = read_tiff(fn)
+		self.assertEqual(data, self.canvas.tobytes())
+		self.assertEqual(Image.open(fn).tobytes(), self.canvas.tobytes())
+		# Compressed strips can't be partially decoded
+		self.assertEqual(pimage.open_band(fn, 0, 10), None)
+
+	def test_bigtiff(self):
+		for compress in (False, True):
+			fn = self.stream(compress=compress, bigtiff=True)
+			big, size, data = read_tiff(fn)
+			self.assertTrue(big)
+			self.assertEqual(size, (240, 280))
+			self.assertEqual(data, self.canvas.tobytes())
+
+if __name__ == '__main__':
+	unittest.main()
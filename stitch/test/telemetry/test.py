@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+from pr0ntools import telemetry
+import shutil
+import tempfile
+import threading
+import unittest
+
+class TelemetryTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp(prefix='pr0ntelemetry_test_')
+		telemetry.open_log(telemetry.log_fn(self.dir, 'w00'), proc='w00')
+
+	def tearDown(self):
+		telemetry.close_log()
+		shutil.rmtree(self.dir)
+
+	def stages(self):
+		telemetry.close_log()
+		return dict([(r['stage'], r) for r in telemetry.load([self.dir])])
+
+	def test_nested(self):
+		with telemetry.span('supertile', st='000000x_000000y'):
+			with telemetry.span('blend', blender='multiband'):
+				pass
+		try:
+			with telemetry.span('remap'):
+				raise ValueError()
+		except ValueError:
+			pass
+		recs = self.stages()
+		self.assertEqual(sorted(recs.keys()), ['blend', 'remap', 'supertile'])
+		# Inherits the enclosing supertile
+		self.assertEqual(recs['blend']['st'], '000000x_000000y')
+		self.assertEqual(recs['blend']['blender'], 'multiband')
+		self.assertEqual(recs['blend']['proc'], 'w00')
+		self.assertTrue(recs['supertile']['ok'])
+		self.assertFalse(recs['remap']['ok'])
+		self.assertFalse('st' in recs['remap'])
+		self.assertTrue(recs['supertile']['wall'] >= recs['blend']['wall'])
+
+	def test_extra(self):
+		with telemetry.span('remap') as rec:
+			rec.update({'exe': 'nona', 'exe_rc': 0})
+			with telemetry.span('load'):
+				pass
+		recs = self.stages()
+		self.assertEqual((recs['remap']['exe'], recs['remap']['exe_rc']), ('nona', 0))
+		# Not inherited
+		self.assertFalse('exe' in recs['load'])
+		# Still usable while disabled
+		with telemetry.span('remap') as rec:
+			rec['exe'] = 'nona'
+
+	def test_threads(self):
+		inside = threading.Event()
+		done = threading.Event()
+		def other():
+			with telemetry.span('supertile', st='a'):
+				inside.set()
+				done.wait(5)
+		t = threading.Thread(target=other)
+		t.start()
+		inside.wait(5)
+		# Another thread's open span isn't our parent
+		with telemetry.span('tiles'):
+			pass
+		done.set()
+		t.join()
+		recs = self.stages()
+		self.assertEqual(recs['supertile']['st'], 'a')
+		self.assertFalse('st' in recs['tiles'])
+
+	def test_report(self):
+		for _i in xrange(3):
+			with telemetry.span('pair'):
+				pass
+		with telemetry.span('merge'):
+			pass
+		telemetry.close_log()
+		# Disabled, not recorded
+		with telemetry.span('pair'):
+			pass
+		recs = telemetry.load([self.dir])
+		s = telemetry.summarize(recs)
+		self.assertEqual(s['pair'].n, 3)
+		self.assertEqual(s['merge'].n, 1)
+		report = telemetry.report(recs)
+		self.assertTrue(report.startswith('4 spans'))
+		self.assertTrue('proc w00' in report)
+		self.assertEqual(telemetry.report([]), 'No telemetry')
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+from pr0ntools import temp_file
+from pr0ntools.temp_file import ManagedTempFile, ManagedTempDir, TempFile, TempScope
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+def touch(fn):
+	open(fn, 'w').close()
+	return fn
+
+class TempFileTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp(prefix='pr0ntemp_test_')
+		self.prefix = os.path.join(self.dir, 'x_')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_unique_str(self):
+		names = set([TempFile.unique_str() for _i in xrange(1000)])
+		self.assertEqual(len(names), 1000)
+		for name in names:
+			self.assertEqual(len(name), 16)
+			int(name, 16)
+		# Forked children pick a new base
+		r, w = os.pipe()
+		pid = os.fork()
+		if pid == 0:
+			os.write(w, TempFile.unique_str())
+			os._exit(0)
+		os.waitpid(pid, 0)
+		child = os.read(r, 16)
+		self.assertNotEqual(child[0:8], TempFile.unique_str()[0:8])
+
+	def test_gc(self):
+		t = ManagedTempFile.get(self.prefix, '.txt')
+		fn = touch(t.file_name)
+		del t
+		self.assertFalse(os.path.exists(fn))
+
+	def test_scope(self):
+		with TempScope(prefix=self.prefix) as scope:
+			a = ManagedTempFile.get(None, '.txt')
+			b = ManagedTempFile.get(None, '.txt')
+			c = ManagedTempFile.get(None, '.txt', scoped=False)
+			d = ManagedTempFile.get(None, '.txt')
+			for t in (a, b, d):
+				self.assertTrue(t.file_name.startswith(self.prefix))
+				touch(t.file_name)
+			# Outlives the scope in the default dir
+			self.assertTrue(c.file_name.startswith(TempFile.default_prefix()))
+			touch(c.file_name)
+			kept = d.detach()
+			self.assertEqual(scope.files, [a, b, d])
+			# Never created
+			ManagedTempFile.get(None, '.txt')
+		self.assertFalse(os.path.exists(a.file_name))
+		self.assertFalse(os.path.exists(b.file_name))
+		self.assertTrue(os.path.exists(c.file_name))
+		self.assertTrue(os.path.exists(kept))
+		# Already deleted, GC doesn't try again
+		self.assertFalse(a.managed)
+		del d
+		self.assertTrue(os.path.exists(kept))
+		fn = c.file_name
+		del c
+		self.assertFalse(os.path.exists(fn))
+
+	def test_nested(self):
+		with TempScope(prefix=self.prefix):
+			a = ManagedTempFile.get(None, '.txt')
+			# Inherits the prefix
+			with TempScope():
+				b = ManagedTempFile.get(None, '.txt')
+				self.assertTrue(b.file_name.startswith(self.prefix))
+				touch(b.file_name)
+			self.assertFalse(os.path.exists(b.file_name))
+			touch(a.file_name)
+		self.assertFalse(os.path.exists(a.file_name))
+		self.assertEqual(temp_file.g_scopes, [])
+
+	def test_dir(self):
+		d = ManagedTempDir.get(self.prefix + 'dir')
+		touch(d.get_file_name(suffix='.txt'))
+		fn = d.file_name
+		del d
+		self.assertFalse(os.path.exists(fn))
+
+	def test_exit(self):
+		# Default dir is gone after a normal interpreter exit
+		out = subprocess.check_output([sys.executable, '-c',
+				'from pr0ntools.temp_file import TempFile; print TempFile.default_prefix()'])
+		d = out.strip().split('\n')[-2]
+		self.assertTrue(d.startswith(temp_file.PREFIX_BASE))
+		self.assertFalse(os.path.exists(d))
+		self.assertTrue('Deleted temp dir' in out)
+		self.assertFalse('WARNING' in out)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -1,6 +1,18 @@
 all:
+	cd stitch/test/blend/ && python test.py
+	cd stitch/test/cpbench/ && python test.py
+	cd stitch/test/execute/ && python test.py
+	cd stitch/test/icm/ && python test.py
+	cd stitch/test/map/ && python test.py
 	cd stitch/test/optimize/ && python test.py
 #	cd stitch/test/remapper/ && python test.py
+	cd stitch/test/qlog/ && python test.py
+	cd stitch/test/remote/ && python test.py
+	cd stitch/test/roi/ && python test.py
+	cd stitch/test/scratch/ && python test.py
+	cd stitch/test/single/ && python test.py
+	cd stitch/test/telemetry/ && python test.py
+	cd stitch/test/temp/ && python test.py
 	cd stitch/test/tile/ && python test.py
 	cd stitch/test/util/ && python test.py
 	